@@ -0,0 +1,182 @@
+"""Compares the scores and the speed of the CPU precisions of the REMi evaluator with the float16 model on a fixed sample set.
+
+By default it runs the tiny stand-in model, to check the plumbing. Point `--model-cache` to a cache with the real models to measure what
+bfloat16 and int8 cost in accuracy, the float16 reference can run on a GPU with `--reference-device cuda`.
+
+    python benchmarks/accuracy.py --model-cache ~/.cache/nuclia-eval --reference-device cuda --output accuracy.json
+"""
+
+import argparse
+import json
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from tiny_model import write_tiny_model_cache
+
+from nuclia_eval.models.remi import REMiEvaluator
+from nuclia_eval.settings import Settings
+
+SAMPLES: List[Tuple[str, str, List[str]]] = [
+    (
+        "What is the capital of France?",
+        "The capital of France is Paris.",
+        [
+            "Paris is the capital and largest city of France.",
+            "Lyon is the third largest city of France, known for its cuisine.",
+        ],
+    ),
+    (
+        "When was the Eiffel Tower built?",
+        "It was built between 1887 and 1889.",
+        [
+            "The Eiffel Tower was constructed from 1887 to 1889 as the entrance to the 1889 World's Fair.",
+            "The Louvre is the world's most visited museum.",
+        ],
+    ),
+    (
+        "How many octaves can I shift my keyboard?",
+        "You can shift the keyboard up to 3 octaves in each direction.",
+        [
+            "Press the Octave buttons to shift the keyboard range up or down by up to three octaves.",
+        ],
+    ),
+    (
+        "What does photosynthesis produce?",
+        "Photosynthesis produces glucose and oxygen from carbon dioxide and water.",
+        [
+            "Photosynthesis converts light energy into chemical energy, producing glucose and releasing oxygen.",
+            "Cellular respiration breaks down glucose to release energy.",
+        ],
+    ),
+    (
+        "Who wrote Don Quixote?",
+        "Don Quixote was written by William Shakespeare.",
+        [
+            "Don Quixote is a Spanish novel by Miguel de Cervantes, published in two parts in 1605 and 1615.",
+        ],
+    ),
+    (
+        "What is the boiling point of water at sea level?",
+        "I don't know.",
+        [
+            "At sea level, water boils at 100 degrees Celsius.",
+            "Water freezes at 0 degrees Celsius.",
+        ],
+    ),
+]
+
+PRECISIONS: Dict[str, Dict[str, Any]] = {
+    "bfloat16": {"dtype": "bfloat16"},
+    "int8": {"quantization": "int8"},
+}
+
+
+def evaluate(evaluator: REMiEvaluator) -> Tuple[List[int], float]:
+    """Scores of every metric of the samples, flattened, and the seconds it took"""
+    start = time.perf_counter()
+    results = evaluator.evaluate_rag_batch(SAMPLES)
+    seconds = time.perf_counter() - start
+    scores = []
+    for answer_relevance, context_relevances, groundednesses in results:
+        scores.append(answer_relevance.score)
+        scores.extend(result.score for result in context_relevances)
+        scores.extend(result.score for result in groundednesses)
+    return scores, seconds
+
+
+def compare(
+    settings: Settings,
+    reference_device: str,
+    device: str,
+    precisions: List[str],
+) -> Dict[str, Any]:
+    reference = REMiEvaluator(settings=settings, device=reference_device)
+    evaluate(reference)  # warmup
+    reference_scores, reference_seconds = evaluate(reference)
+    del reference
+    report: Dict[str, Any] = {
+        "samples": len(reference_scores),
+        "float16": {"device": reference_device, "seconds": reference_seconds},
+    }
+    for precision in precisions:
+        evaluator = REMiEvaluator(
+            settings=settings.model_copy(update=PRECISIONS[precision]), device=device
+        )
+        evaluate(evaluator)
+        scores, seconds = evaluate(evaluator)
+        del evaluator
+        differences = [abs(a - b) for a, b in zip(scores, reference_scores)]
+        report[precision] = {
+            "device": device,
+            "seconds": seconds,
+            "speedup": reference_seconds / seconds if seconds > 0 else None,
+            "agreement": sum(d == 0 for d in differences) / len(differences),
+            "mean_abs_diff": statistics.fmean(differences),
+            "max_abs_diff": max(differences),
+        }
+    return report
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--model-cache",
+        default=None,
+        help="Model cache with the real models, the tiny stand-in model by default",
+    )
+    parser.add_argument(
+        "--reference-device", default="cpu", help="Device of the float16 reference"
+    )
+    parser.add_argument("--device", default="cpu", help="Device of the CPU precisions")
+    parser.add_argument(
+        "--precisions",
+        nargs="*",
+        default=list(PRECISIONS),
+        choices=list(PRECISIONS),
+        help="Precisions compared with the float16 reference",
+    )
+    parser.add_argument(
+        "--max-mean-diff",
+        type=float,
+        default=None,
+        help="Exit with 1 if the mean absolute score difference of a precision is above this",
+    )
+    parser.add_argument("--output", default=None, help="Path of the JSON report")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp_path:
+        model_cache = args.model_cache or str(write_tiny_model_cache(Path(tmp_path)))
+        settings = Settings(
+            nuclia_model_cache=model_cache,
+            constrained_decoding=True,
+            merged_checkpoint="off" if args.model_cache is None else "load",
+        )
+        report = compare(settings, args.reference_device, args.device, args.precisions)
+
+    print(
+        f"float16 on {args.reference_device}: {report['float16']['seconds']:.2f}s for {report['samples']} scores"
+    )
+    failed = False
+    for precision in args.precisions:
+        result = report[precision]
+        print(
+            f"{precision:10} {result['seconds']:.2f}s, {result['speedup']:.2f}x, "
+            f"agreement {result['agreement']:.0%}, mean abs diff {result['mean_abs_diff']:.2f}, max abs diff {result['max_abs_diff']}"
+        )
+        if (
+            args.max_mean_diff is not None
+            and result["mean_abs_diff"] > args.max_mean_diff
+        ):
+            failed = True
+    if args.output is not None:
+        Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Report written to {args.output}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
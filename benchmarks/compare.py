@@ -0,0 +1,54 @@
+"""Compares two results of `run.py`, reporting the change of the median time of each benchmark.
+
+    python benchmarks/compare.py base.json new.json --threshold 0.1
+
+Exits with 1 if any benchmark is slower than the baseline by more than the threshold.
+"""
+
+import argparse
+import json
+from pathlib import Path
+from typing import List, Optional
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline", help="Results of the reference commit")
+    parser.add_argument("candidate", help="Results to compare with the baseline")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Relative slowdown of the median time that counts as a regression",
+    )
+    args = parser.parse_args(argv)
+    baseline = json.loads(Path(args.baseline).read_text())
+    candidate = json.loads(Path(args.candidate).read_text())
+    print(
+        f"Baseline {baseline.get('commit') or args.baseline}, candidate {candidate.get('commit') or args.candidate}"
+    )
+
+    regressions = []
+    for name, result in candidate["benchmarks"].items():
+        if name not in baseline["benchmarks"]:
+            print(f"{name:60} {result['median_s'] * 1000:10.2f} ms  (new)")
+            continue
+        before = baseline["benchmarks"][name]["median_s"]
+        change = result["median_s"] / before - 1 if before > 0 else 0.0
+        flag = ""
+        if change > args.threshold:
+            flag = "  REGRESSION"
+            regressions.append(name)
+        print(
+            f"{name:60} {before * 1000:10.2f} ms -> {result['median_s'] * 1000:10.2f} ms  {change:+7.1%}{flag}"
+        )
+    if regressions:
+        print(
+            f"{len(regressions)} benchmarks are more than {args.threshold:.0%} slower"
+        )
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
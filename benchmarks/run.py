@@ -0,0 +1,238 @@
+"""Benchmarks of the REMi evaluator on CPU with a tiny stand-in model.
+
+The model is randomly initialized, so its outputs are meaningless, but every other part of the evaluation is the real one: the tokenizer,
+prompt construction, adapter merge, batching, decoding and parsing. Constrained decoding is enabled so the random model always produces a
+valid tool call. Results are written as JSON, compare two runs with `compare.py`.
+
+    python benchmarks/run.py --output results.json
+"""
+
+import argparse
+import functools
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+from tiny_model import TINY_PARAMS, write_tiny_model_cache
+
+from nuclia_eval.instrumentation import CallStats
+from nuclia_eval.metrics import ContextRelevance, Groundedness
+from nuclia_eval.models.prompts import PromptEncoder
+from nuclia_eval.models.remi import REMiEvaluator
+from nuclia_eval.settings import Settings
+
+QUERY = "What is the capital of France and when did it become the capital?"
+ANSWER = "Paris is the capital of France, it became the capital in 987 when Hugh Capet made it the seat of his government."
+CONTEXT = (
+    "Paris is the capital and largest city of France. "
+    "With an estimated population of over two million residents, it is the centre of the Ile-de-France region. "
+    "Hugh Capet, the first king of the Capetian dynasty, made the city his capital in 987. "
+) * 4
+
+
+def measure(
+    fn: Callable[[], Any], repeat: int, warmup: int = 1, items: int = 1
+) -> Dict[str, Any]:
+    """Runs `fn` `warmup` times and then `repeat` more times, returning statistics of the timed runs in seconds"""
+    for _ in range(warmup):
+        fn()
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        seconds.append(time.perf_counter() - start)
+    median = statistics.median(seconds)
+    return {
+        "runs": repeat,
+        "median_s": median,
+        "mean_s": statistics.fmean(seconds),
+        "min_s": min(seconds),
+        "max_s": max(seconds),
+        "items_per_s": items / median if median > 0 else None,
+    }
+
+
+def _contexts(n: int) -> List[str]:
+    return [f"Document {i}. {CONTEXT}" for i in range(n)]
+
+
+def run(
+    repeat: int,
+    cache_path: Path,
+    only: Optional[List[str]] = None,
+    threads: int = 0,
+) -> Dict[str, Any]:
+    write_tiny_model_cache(cache_path)
+    settings = Settings(
+        nuclia_model_cache=str(cache_path),
+        constrained_decoding=True,
+        merged_checkpoint="off",
+        cpu_threads=threads,
+    )
+    results: Dict[str, Any] = {}
+
+    def selected(name: str) -> bool:
+        return only is None or any(name.startswith(prefix) for prefix in only)
+
+    def new_evaluator(**overrides: Any) -> REMiEvaluator:
+        return REMiEvaluator(
+            settings=settings.model_copy(update=overrides), device="cpu"
+        )
+
+    if selected("startup"):
+        results["startup/adapter_merge"] = measure(new_evaluator, repeat)
+        new_evaluator().bake_merged_checkpoint()
+        results["startup/merged_checkpoint"] = measure(
+            lambda: new_evaluator(merged_checkpoint="load"), repeat
+        )
+
+    evaluator = new_evaluator()
+    stats: List[CallStats] = []
+    evaluator.add_callback(stats.append)
+
+    if selected("prompts"):
+        inputs = [{"query": QUERY, "context": context} for context in _contexts(64)]
+        tool = evaluator._get_tool(ContextRelevance)
+
+        def spliced() -> None:
+            encoder = PromptEncoder(
+                evaluator.tokenizer, evaluator._get_system_message()
+            )
+            for fields in inputs:
+                encoder.encode(ContextRelevance, tool, fields)
+
+        def full() -> None:
+            encoder = evaluator._get_prompt_encoder()
+            for fields in inputs:
+                encoder.encode_chat_completion(ContextRelevance, tool, fields)
+
+        # A context scored by a second metric is served from the tokenized lines cache
+        groundedness_tool = evaluator._get_tool(Groundedness)
+        warm_encoder = PromptEncoder(
+            evaluator.tokenizer, evaluator._get_system_message()
+        )
+        for fields in inputs:
+            warm_encoder.encode(ContextRelevance, tool, fields)
+
+        def cached() -> None:
+            for fields in inputs:
+                warm_encoder.encode(
+                    Groundedness,
+                    groundedness_tool,
+                    {"answer": ANSWER, "context": fields["context"]},
+                )
+
+        results["prompts/full_encoding"] = measure(full, repeat, items=len(inputs))
+        results["prompts/spliced"] = measure(spliced, repeat, items=len(inputs))
+        results["prompts/spliced_cached_lines"] = measure(
+            cached, repeat, items=len(inputs)
+        )
+
+    if selected("metric"):
+        context = _contexts(1)
+        results["metric/answer_relevance"] = measure(
+            lambda: evaluator.answer_relevance(QUERY, ANSWER), repeat
+        )
+        results["metric/context_relevance"] = measure(
+            lambda: evaluator.context_relevance(QUERY, context), repeat
+        )
+        results["metric/groundedness"] = measure(
+            lambda: evaluator.groundedness(ANSWER, context), repeat
+        )
+
+    if selected("evaluate_rag"):
+        contexts = _contexts(4)
+        stats.clear()
+        results["evaluate_rag/4_contexts"] = measure(
+            lambda: evaluator.evaluate_rag(QUERY, ANSWER, contexts), repeat
+        )
+        # Where the time goes, from the instrumentation of the timed runs
+        results["evaluate_rag/4_contexts"]["stages_s"] = {
+            stage: statistics.median(s.stages.get(stage, 0.0) for s in stats[1:])
+            for stage in sorted({stage for s in stats for stage in s.stages})
+        }
+        results["evaluate_rag/4_contexts"]["tokens_per_s"] = statistics.median(
+            s.tokens_per_second for s in stats[1:]
+        )
+
+    if selected("batching"):
+        contexts = _contexts(16)
+        for batch_size in (1, 8):
+            batch_evaluator = new_evaluator(max_batch_size=batch_size)
+            results[f"batching/context_relevance_16/max_batch_size_{batch_size}"] = (
+                measure(
+                    functools.partial(
+                        batch_evaluator.context_relevance, QUERY, contexts
+                    ),
+                    repeat,
+                    items=len(contexts),
+                )
+            )
+    return results
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--output", default="benchmark-results.json", help="Path of the JSON results"
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Timed runs of each benchmark"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=None,
+        help="Torch threads, the CPUs the process may run on by default",
+    )
+    parser.add_argument(
+        "--only",
+        nargs="*",
+        default=None,
+        help="Run only the benchmarks whose name starts with one of these prefixes, e.g. `startup metric`",
+    )
+    args = parser.parse_args(argv)
+    torch.manual_seed(0)
+
+    with tempfile.TemporaryDirectory() as cache_path:
+        benchmarks = run(args.repeat, Path(cache_path), args.only, args.threads or 0)
+    report = {
+        "commit": _git_commit(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": sys.version.split()[0],
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "threads": torch.get_num_threads(),
+        "model": TINY_PARAMS,
+        "benchmarks": benchmarks,
+    }
+    Path(args.output).write_text(json.dumps(report, indent=2) + "\n")
+    for name, result in benchmarks.items():
+        print(f"{name:60} {result['median_s'] * 1000:10.2f} ms")
+    print(f"Results written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,57 @@
+"""A tiny REMi stand-in that runs on CPU: a randomly initialized model, a LoRA adapter for it and the real v3 tokenizer, laid out like the model cache."""
+
+import json
+import shutil
+from pathlib import Path
+
+import mistral_common
+import safetensors.torch
+import torch
+
+TINY_PARAMS = dict(
+    dim=64,
+    n_layers=2,
+    head_dim=16,
+    hidden_dim=128,
+    n_heads=4,
+    n_kv_heads=2,
+    norm_eps=1e-5,
+    # The vocabulary of the v3 tokenizer
+    vocab_size=32768,
+)
+LORA_RANK = 4
+
+
+def write_tiny_model_cache(cache_path: Path, seed: int = 0) -> Path:
+    """Writes the tiny base model, its REMi adapter and the tokenizer where `REMiEvaluator` expects them in the model cache"""
+    from mistral_inference.args import TransformerArgs
+    from mistral_inference.transformer import Transformer
+
+    torch.manual_seed(seed)
+    model = Transformer(TransformerArgs(**TINY_PARAMS)).to(torch.float16)
+    base_path = cache_path / "Mistral-7B-Instruct-v0.3"
+    adapter_path = cache_path / "REMi-v0"
+    base_path.mkdir(parents=True, exist_ok=True)
+    adapter_path.mkdir(parents=True, exist_ok=True)
+    (base_path / "params.json").write_text(json.dumps(TINY_PARAMS))
+    safetensors.torch.save_file(
+        {name: tensor.contiguous() for name, tensor in model.state_dict().items()},
+        base_path / "consolidated.safetensors",
+    )
+    shutil.copy(
+        Path(mistral_common.__file__).parent
+        / "data"
+        / "mistral_instruct_tokenizer_240323.model.v3",
+        base_path / "tokenizer.model.v3",
+    )
+    lora = {}
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.Linear) and name != "output":
+            lora[f"{name}.lora_A.weight"] = (
+                torch.randn(LORA_RANK, module.in_features) * 0.01
+            ).half()
+            lora[f"{name}.lora_B.weight"] = (
+                torch.randn(module.out_features, LORA_RANK) * 0.01
+            ).half()
+    safetensors.torch.save_file(lora, adapter_path / "lora.safetensors")
+    return cache_path
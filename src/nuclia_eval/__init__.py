@@ -1,9 +1,32 @@
 """nuclia-eval is a library that simplifies evaluating the RAG experience using nuclia's models."""
 
+import importlib
 import logging
+from typing import TYPE_CHECKING, Any
 
 logger = logging.getLogger(__name__)
 
-from nuclia_eval.models.remi import REMiEvaluator as REMi  # noqa: E402
+if TYPE_CHECKING:  # pragma: no cover
+    from nuclia_eval.models.async_remi import AsyncREMiEvaluator as AsyncREMi
+    from nuclia_eval.models.remi import REMiEvaluator as REMi
 
-__all__ = ["REMi"]
+# The evaluators pull in torch and the model stack, they are only imported when first accessed
+_LAZY_ATTRIBUTES = {
+    "AsyncREMi": ("nuclia_eval.models.async_remi", "AsyncREMiEvaluator"),
+    "REMi": ("nuclia_eval.models.remi", "REMiEvaluator"),
+}
+
+__all__ = ["AsyncREMi", "REMi"]
+
+
+def __getattr__(name: str) -> Any:
+    if name in _LAZY_ATTRIBUTES:
+        module, attribute = _LAZY_ATTRIBUTES[name]
+        value = getattr(importlib.import_module(module), attribute)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list[str]:
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
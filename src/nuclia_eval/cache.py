@@ -0,0 +1,181 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence
+
+from nuclia_eval import logger
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    last_access REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_access ON results (last_access);
+-- The total size of the values, kept up to date by the triggers in the transaction of each write
+CREATE TABLE IF NOT EXISTS results_size (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    total INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO results_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM results;
+CREATE TRIGGER IF NOT EXISTS results_insert AFTER INSERT ON results BEGIN
+    UPDATE results_size SET total = total + NEW.size;
+END;
+CREATE TRIGGER IF NOT EXISTS results_delete AFTER DELETE ON results BEGIN
+    UPDATE results_size SET total = total - OLD.size;
+END;
+"""
+
+
+def result_key(**parts: Any) -> str:
+    """Returns a content address for a result, the sha256 of the canonical json of everything it depends on"""
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """Persistent cache of metric results, stored in a SQLite database.
+
+    Results are looked up by a key built with `result_key`, and the least recently used ones are evicted when the
+    values stored exceed `max_bytes`. Several processes can share the same database, SQLite serializes the writes
+    and the database is opened in WAL mode so readers do not block them.
+    """
+
+    def __init__(self, path: str, max_bytes: int, timeout: float = 30.0) -> None:
+        self.path = Path(path).expanduser()
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Transactions are handled explicitly, see `_write`
+        self._connection = sqlite3.connect(
+            str(self.path),
+            timeout=timeout,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        # The rows replaced by `INSERT OR REPLACE` only fire the delete trigger with recursive triggers
+        self._connection.execute("PRAGMA recursive_triggers=ON")
+        # In a transaction, so the size of the results of an existing database is counted before any other write
+        self._connection.executescript(f"BEGIN IMMEDIATE;{_SCHEMA}COMMIT;")
+
+    def get_many(self, keys: Sequence[str]) -> List[Optional[str]]:
+        """Returns the stored value of each key, None for the keys that are not cached"""
+        if not keys:
+            return []
+        found: Dict[str, str] = {}
+        unique_keys = list(dict.fromkeys(keys))
+        # Stay well below the SQLite limit of parameters per statement
+        for start in range(0, len(unique_keys), 500):
+            chunk = unique_keys[start : start + 500]
+            with self._lock:
+                rows = self._connection.execute(
+                    f"SELECT key, value FROM results WHERE key IN ({', '.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+            found.update(rows)
+        values = [found.get(key) for key in keys]
+        hits = sum(value is not None for value in values)
+        self.hits += hits
+        self.misses += len(values) - hits
+        if found:
+            now = time.time()
+            self._write(
+                lambda: self._connection.executemany(
+                    "UPDATE results SET last_access = ? WHERE key = ?",
+                    [(now, key) for key in found],
+                )
+            )
+        return values
+
+    def get(self, key: str) -> Optional[str]:
+        return self.get_many([key])[0]
+
+    def put_many(self, items: Dict[str, str]) -> None:
+        """Stores the values of several keys, evicting the least recently used results to stay within budget"""
+        now = time.time()
+        rows = [
+            (key, value, len(value.encode("utf-8")), now)
+            for key, value in items.items()
+            if len(value.encode("utf-8")) <= self.max_bytes
+        ]
+        if len(rows) < len(items):
+            logger.debug(
+                "Some results exceed the result cache budget, not storing them"
+            )
+        if not rows:
+            return
+
+        def insert_and_evict() -> None:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO results (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                rows,
+            )
+            (total,) = self._connection.execute(
+                "SELECT total FROM results_size"
+            ).fetchone()
+            if total <= self.max_bytes:
+                return
+            evicted = []
+            for key, size in self._connection.execute(
+                "SELECT key, size FROM results ORDER BY last_access, key"
+            ):
+                if total <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                total -= size
+            self._connection.executemany("DELETE FROM results WHERE key = ?", evicted)
+            logger.debug(f"Evicted {len(evicted)} results from the result cache")
+
+        self._write(insert_and_evict)
+
+    def put(self, key: str, value: str) -> None:
+        self.put_many({key: value})
+
+    @property
+    def nbytes(self) -> int:
+        """Total size of the values stored"""
+        with self._lock:
+            (total,) = self._connection.execute(
+                "SELECT total FROM results_size"
+            ).fetchone()
+        return total
+
+    def __len__(self) -> int:
+        with self._lock:
+            (count,) = self._connection.execute(
+                "SELECT COUNT(*) FROM results"
+            ).fetchone()
+        return count
+
+    def stats(self) -> Dict[str, int]:
+        """Returns the hit and miss counters of this process, and the number and size of the results stored"""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self),
+            "bytes": self.nbytes,
+        }
+
+    def clear(self) -> None:
+        self._write(lambda: self._connection.execute("DELETE FROM results"))
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _write(self, operation) -> None:
+        """Runs the operation in a transaction that takes the write lock upfront, so concurrent writers wait for each other instead of failing to upgrade their locks"""
+        with self._lock:
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                operation()
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+            self._connection.execute("COMMIT")
@@ -0,0 +1,294 @@
+import argparse
+import json
+import logging
+from typing import Dict, List, Optional, Tuple
+
+from nuclia_eval.dataset import FORMATS, evaluate_dataset, read_rows
+from nuclia_eval.prefilter import overlap_scores, threshold_stats, tune_threshold
+from nuclia_eval.settings import Settings
+
+# The evaluators and the daemon are imported by the commands that use them, so the others do not load torch and the model stack
+
+
+def _evaluate(args: argparse.Namespace) -> int:
+    from nuclia_eval.models.remi import REMiEvaluator
+
+    evaluator = REMiEvaluator(device=args.device)
+    stats = evaluate_dataset(
+        evaluator,
+        read_rows(args.input, args.format),
+        args.output,
+        chunk_size=args.chunk_size,
+        resume=not args.no_resume,
+    )
+    print(
+        f"Evaluated {stats.evaluated} rows, {stats.failed} failed, {stats.skipped} already evaluated by a previous run"
+    )
+    return 1 if stats.failed else 0
+
+
+def _estimate(args: argparse.Namespace) -> int:
+    from nuclia_eval.estimation import estimate_metrics
+    from nuclia_eval.models.remi import REMiEvaluator
+
+    evaluator = REMiEvaluator(device=args.device)
+    estimates = {}
+    for estimates in estimate_metrics(
+        evaluator,
+        read_rows(args.input, args.format),
+        target_width=args.target_width,
+        confidence=args.confidence,
+        method=args.method,
+        batch_size=args.batch_size,
+        max_rows=args.max_rows,
+        seed=args.seed,
+    ):
+        print(
+            ", ".join(
+                f"{name} {e.mean:.2f} [{e.low:.2f}, {e.high:.2f}] ({e.samples}/{e.population})"
+                for name, e in estimates.items()
+            )
+        )
+    if not estimates:
+        print("No rows to estimate the metrics with")
+        return 1
+    return 0
+
+
+def _bake(args: argparse.Namespace) -> int:
+    from nuclia_eval.models.remi import REMiEvaluator
+
+    evaluator = REMiEvaluator(
+        settings=Settings(merged_checkpoint="bake"), device=args.device
+    )
+    print(f"Merged REMi model at {evaluator.bake_merged_checkpoint()}")
+    return 0
+
+
+def _serve(args: argparse.Namespace) -> int:
+    from nuclia_eval.models.daemon import DEFAULT_ADDRESS, EvaluatorServer
+    from nuclia_eval.models.remi import REMiEvaluator
+
+    # The server accepts connections while the model loads, the requests wait for it
+    evaluator = REMiEvaluator(
+        settings=Settings(background_loading=True), device=args.device
+    )
+    with EvaluatorServer(
+        evaluator,
+        args.address or DEFAULT_ADDRESS,
+        max_batch_requests=args.max_batch_requests,
+        allow_remote=args.allow_remote,
+    ) as server:
+        print(f"Serving on {server.address}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    return 0
+
+
+def _tune_prefilter(args: argparse.Namespace) -> int:
+    # The prefilter scores and the recorded scores of the pairs the model evaluated, per metric
+    pairs: Dict[str, Tuple[List[float], List[int]]] = {
+        "context_relevance": ([], []),
+        "groundedness": ([], []),
+    }
+    with open(args.results) as f:
+        records = (json.loads(line) for line in f if line.strip())
+        for row, record in zip(read_rows(args.dataset, args.format), records):
+            if record.get("id") != row.id:
+                raise ValueError(
+                    f"The results do not match the dataset, found the results of {record.get('id')!r} for the row {row.id!r}"
+                )
+            if "error" in record:
+                continue
+            for metric, reference in (
+                ("context_relevance", row.query),
+                ("groundedness", row.answer),
+            ):
+                overlaps, scores = pairs[metric]
+                for overlap, result in zip(
+                    overlap_scores(reference, row.contexts, args.ngram).tolist(),
+                    record[metric],
+                ):
+                    if "score" in result and "prefilter_score" not in result:
+                        overlaps.append(overlap)
+                        scores.append(result["score"])
+
+    thresholds = [round(0.05 * i, 2) for i in range(1, 11)]
+    recommended = []
+    for metric, (overlaps, scores) in pairs.items():
+        print(f"{metric}: {len(overlaps)} pairs")
+        for stats in threshold_stats(overlaps, scores, thresholds, args.min_score):
+            print(
+                f"  threshold {stats.threshold:.2f}: skips {stats.skip_rate:.1%}, misses {stats.miss_rate:.1%}"
+            )
+        if overlaps:
+            best = tune_threshold(overlaps, scores, args.max_miss_rate, args.min_score)
+            recommended.append(best.threshold)
+            print(
+                f"  highest threshold missing at most {args.max_miss_rate:.1%}: {best.threshold:.4f}, skips {best.skip_rate:.1%}"
+            )
+    if not recommended:
+        print("No recorded results to tune the prefilter with")
+        return 1
+    # The threshold applies to both metrics, so it must miss few pairs of either
+    print(f"Recommended prefilter_threshold: {min(recommended):.4f}")
+    return 0
+
+
+def build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="nuclia-eval",
+        description="Evaluate RAG experiences with nuclia's models. Settings are read from the environment, see `nuclia_eval.settings.Settings`.",
+    )
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    evaluate = subparsers.add_parser(
+        "evaluate",
+        help="Evaluate every row of a dataset, resuming from the last checkpoint of a previous run",
+    )
+    evaluate.add_argument(
+        "input",
+        help="Dataset with a `query`, an `answer` and a list of `contexts` per row, and optionally an `id`",
+    )
+    evaluate.add_argument("output", help="Path of the jsonl results")
+    evaluate.add_argument(
+        "--format",
+        choices=FORMATS,
+        default=None,
+        help="Format of the dataset, detected from its extension by default",
+    )
+    evaluate.add_argument(
+        "--chunk-size",
+        type=int,
+        default=32,
+        help="How many rows are evaluated together between checkpoints",
+    )
+    evaluate.add_argument(
+        "--no-resume",
+        action="store_true",
+        help="Ignore the checkpoint of a previous run and overwrite the output",
+    )
+    evaluate.add_argument("--device", default="cuda", help="Device to run the model on")
+    evaluate.set_defaults(func=_evaluate)
+
+    estimate = subparsers.add_parser(
+        "estimate",
+        help="Estimate the mean of every metric over a dataset, with confidence intervals, by scoring a random sample of it",
+    )
+    estimate.add_argument(
+        "input",
+        help="Dataset with a `query`, an `answer` and a list of `contexts` per row",
+    )
+    estimate.add_argument(
+        "--format",
+        choices=FORMATS,
+        default=None,
+        help="Format of the dataset, detected from its extension by default",
+    )
+    estimate.add_argument(
+        "--target-width",
+        type=float,
+        default=0.2,
+        help="Sampling stops once the intervals are narrower than this, on the 0 to 5 scale of the scores",
+    )
+    estimate.add_argument(
+        "--confidence",
+        type=float,
+        default=0.95,
+        help="Confidence level of the intervals",
+    )
+    estimate.add_argument(
+        "--method",
+        choices=("wilson", "bootstrap"),
+        default="wilson",
+        help="How the intervals are computed, bootstrap requires numpy",
+    )
+    estimate.add_argument(
+        "--batch-size",
+        type=int,
+        default=32,
+        help="How many items of each metric are scored between estimates",
+    )
+    estimate.add_argument(
+        "--max-rows",
+        type=int,
+        default=100_000,
+        help="The rows are sampled down to this many before scoring",
+    )
+    estimate.add_argument("--seed", type=int, default=None, help="Seed of the sampling")
+    estimate.add_argument("--device", default="cuda", help="Device to run the model on")
+    estimate.set_defaults(func=_estimate)
+
+    bake = subparsers.add_parser(
+        "bake",
+        help="Merge the REMi adapter into the base model once and store the result in the model cache, so later startups skip the merge",
+    )
+    bake.add_argument("--device", default="cuda", help="Device to merge the adapter on")
+    bake.set_defaults(func=_bake)
+
+    serve = subparsers.add_parser(
+        "serve",
+        help="Keep the model loaded and evaluate the requests of `DaemonEvaluator` clients, sent over a Unix socket or TCP",
+    )
+    serve.add_argument(
+        "--address",
+        default=None,
+        help="unix:PATH, tcp://HOST:PORT or HOST:PORT to serve on, set the same `daemon_address` in the clients. Defaults to a Unix socket of the user in the temporary directory",
+    )
+    serve.add_argument(
+        "--max-batch-requests",
+        type=int,
+        default=32,
+        help="The most queued `evaluate_rag` requests evaluated together",
+    )
+    serve.add_argument(
+        "--allow-remote",
+        action="store_true",
+        help="Serve on a TCP host other machines can connect to, e.g. 0.0.0.0, the daemon has no authentication",
+    )
+    serve.add_argument("--device", default="cuda", help="Device to run the model on")
+    serve.set_defaults(func=_serve)
+
+    tune_prefilter = subparsers.add_parser(
+        "tune-prefilter",
+        help="Measure how many contexts the prefilter would skip, and how many the model found relevant, for the results of a previous evaluation",
+    )
+    tune_prefilter.add_argument("dataset", help="The evaluated dataset")
+    tune_prefilter.add_argument(
+        "results", help="The jsonl results of `nuclia-eval evaluate` for the dataset"
+    )
+    tune_prefilter.add_argument(
+        "--format",
+        choices=FORMATS,
+        default=None,
+        help="Format of the dataset, detected from its extension by default",
+    )
+    tune_prefilter.add_argument(
+        "--ngram", type=int, default=1, help="The `prefilter_ngram` setting to tune for"
+    )
+    tune_prefilter.add_argument(
+        "--max-miss-rate",
+        type=float,
+        default=0.01,
+        help="Fraction of the relevant contexts the recommended threshold may skip",
+    )
+    tune_prefilter.add_argument(
+        "--min-score",
+        type=int,
+        default=1,
+        help="Lowest model score of a context that counts as relevant",
+    )
+    tune_prefilter.set_defaults(func=_tune_prefilter)
+    return parser
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    logging.basicConfig(level=logging.INFO)
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    raise SystemExit(main())
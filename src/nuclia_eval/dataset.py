@@ -0,0 +1,228 @@
+import csv
+import hashlib
+import json
+import os
+from dataclasses import dataclass
+from itertools import chain, islice
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from nuclia_eval import logger
+from nuclia_eval.exceptions import ModelException
+from nuclia_eval.models.base import RAGEvaluator
+
+FORMATS = ("jsonl", "csv", "parquet")
+
+# The first rows of a dataset are hashed into its checkpoint, so a run only resumes the checkpoint of the same input
+FINGERPRINT_ROWS = 16
+
+
+@dataclass
+class DatasetRow:
+    """A RAG experience to evaluate, `id` is copied to the results to match them with the input"""
+
+    query: str
+    answer: str
+    contexts: List[str]
+    id: Optional[Any] = None
+
+    @classmethod
+    def from_record(cls, record: Dict[str, Any]) -> "DatasetRow":
+        contexts = record["contexts"]
+        # CSV cells can only hold strings, so contexts are stored as a json list
+        if isinstance(contexts, str):
+            contexts = json.loads(contexts)
+        return cls(
+            query=record["query"],
+            answer=record["answer"],
+            contexts=list(contexts),
+            id=record.get("id"),
+        )
+
+
+@dataclass
+class DatasetStats:
+    """Counters of a dataset evaluation, `skipped` are the rows already evaluated by a previous run"""
+
+    skipped: int = 0
+    evaluated: int = 0
+    failed: int = 0
+
+
+def detect_format(path: str) -> str:
+    suffix = Path(path).suffix.lower().lstrip(".")
+    if suffix in ("jsonl", "ndjson"):
+        return "jsonl"
+    if suffix in FORMATS:
+        return suffix
+    raise ValueError(f"Can not detect the format of {path}, expected one of {FORMATS}")
+
+
+def read_rows(path: str, format: Optional[str] = None) -> Iterator[DatasetRow]:
+    """Streams the rows of a dataset file, each row must have a `query`, an `answer` and a list of `contexts`, and optionally an `id`.
+
+    Args:
+        path (str): Path to the dataset
+        format (Optional[str], optional): One of `jsonl`, `csv` or `parquet`. Defaults to None, detecting it from the file extension.
+
+    Yields:
+        DatasetRow: The rows, in the order they appear in the file
+    """
+    format = format or detect_format(path)
+    if format == "jsonl":
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield DatasetRow.from_record(json.loads(line))
+    elif format == "csv":
+        with open(path, encoding="utf-8", newline="") as f:
+            for record in csv.DictReader(f):
+                yield DatasetRow.from_record(record)
+    elif format == "parquet":
+        try:
+            import pyarrow.parquet as pq
+        except ImportError as e:  # pragma: no cover
+            raise ImportError(
+                "Reading parquet datasets requires pyarrow, install it with `pip install pyarrow`"
+            ) from e
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches():
+            for record in batch.to_pylist():
+                yield DatasetRow.from_record(record)
+    else:
+        raise ValueError(f"Unsupported format {format}, expected one of {FORMATS}")
+
+
+def _fingerprint(rows: List[DatasetRow]) -> str:
+    digest = hashlib.sha256()
+    for row in rows:
+        record = [row.query, row.answer, row.contexts, row.id]
+        digest.update(json.dumps(record, default=str).encode("utf-8") + b"\n")
+    return digest.hexdigest()
+
+
+def _read_checkpoint(checkpoint_path: Path) -> Tuple[int, int, Optional[str]]:
+    if not checkpoint_path.exists():
+        return 0, 0, None
+    checkpoint = json.loads(checkpoint_path.read_text())
+    return checkpoint["rows"], checkpoint["output_bytes"], checkpoint.get("input")
+
+
+def _write_checkpoint(
+    checkpoint_path: Path, rows: int, output_bytes: int, fingerprint: str
+) -> None:
+    """Replaces the checkpoint atomically, so a crash leaves either the previous or the new checkpoint"""
+    tmp_path = checkpoint_path.with_name(checkpoint_path.name + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump({"rows": rows, "output_bytes": output_bytes, "input": fingerprint}, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, checkpoint_path)
+
+
+def _result_record(row: DatasetRow, result) -> Dict[str, Any]:
+    answer_relevance, context_relevance, groundedness = result
+    return {
+        "id": row.id,
+        "answer_relevance": answer_relevance.model_dump(exclude_none=True),
+        "context_relevance": [
+            cr.model_dump(exclude_none=True) for cr in context_relevance
+        ],
+        "groundedness": [g.model_dump(exclude_none=True) for g in groundedness],
+    }
+
+
+def evaluate_dataset(
+    evaluator: RAGEvaluator,
+    rows: Iterable[DatasetRow],
+    output_path: str,
+    *,
+    chunk_size: int = 32,
+    resume: bool = True,
+) -> DatasetStats:
+    """Evaluates a stream of rows, writing one json line per row to `output_path` as soon as its chunk is evaluated.
+
+    Rows are evaluated in chunks of `chunk_size` with `RAGEvaluator.evaluate_rag_batch`, so the metric prompts of all the rows in a chunk are batched together,
+    and only one chunk is held in memory at a time. After each chunk the number of rows done is saved to a checkpoint next to the output, `<output_path>.checkpoint`,
+    so when `resume` is True a job that was interrupted continues after the last chunk it completed. The checkpoint records a hash of the first rows, and
+    a run refuses to resume the checkpoint of another input, or one whose output is shorter than what the checkpoint says was written. Rows that can not be evaluated are written with an `error` instead of their results.
+
+    Args:
+        evaluator (RAGEvaluator): The evaluator used for every row
+        rows (Iterable[DatasetRow]): The rows to evaluate, in the same order on every run
+        output_path (str): Path of the jsonl results
+        chunk_size (int, optional): How many rows are evaluated together. Defaults to 32.
+        resume (bool, optional): Whether to continue from the checkpoint of a previous run, otherwise the output is overwritten. Defaults to True.
+
+    Returns:
+        DatasetStats: Counters of the rows evaluated in this run
+
+    Raises:
+        ValueError: If the checkpoint to resume is not of the same input, or the output lost results the checkpoint counts as done
+    """
+    output = Path(output_path)
+    checkpoint_path = output.with_name(output.name + ".checkpoint")
+    rows = iter(rows)
+    head = list(islice(rows, FINGERPRINT_ROWS))
+    fingerprint = _fingerprint(head)
+    rows = chain(head, rows)
+    done, output_bytes, checkpoint_fingerprint = (
+        _read_checkpoint(checkpoint_path) if resume else (0, 0, None)
+    )
+    if done:
+        if checkpoint_fingerprint != fingerprint:
+            raise ValueError(
+                f"The checkpoint {checkpoint_path} is of another input, evaluate without resuming to overwrite {output}"
+            )
+        output_size = output.stat().st_size if output.exists() else 0
+        if output_size < output_bytes:
+            raise ValueError(
+                f"{output} has {output_size} bytes but the checkpoint {checkpoint_path} counts {output_bytes}, evaluate without resuming to overwrite it"
+            )
+        logger.info(f"Resuming from row {done} of a previous run")
+    stats = DatasetStats(skipped=done)
+
+    for _ in islice(rows, done):
+        pass
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "r+b" if done else "wb") as f:
+        # Drop any results written after the last checkpoint
+        f.seek(output_bytes)
+        f.truncate()
+        while True:
+            chunk = list(islice(rows, chunk_size))
+            if not chunk:
+                break
+            for offset, record in enumerate(_evaluate_chunk(evaluator, chunk)):
+                index = done + offset
+                if "error" in record:
+                    stats.failed += 1
+                    logger.warning(f"Row {index} failed: {record['error']}")
+                else:
+                    stats.evaluated += 1
+                f.write(
+                    (
+                        json.dumps({"row": index, **record}, ensure_ascii=False) + "\n"
+                    ).encode("utf-8")
+                )
+            f.flush()
+            os.fsync(f.fileno())
+            done += len(chunk)
+            _write_checkpoint(checkpoint_path, done, f.tell(), fingerprint)
+            logger.info(f"Evaluated {done} rows")
+    return stats
+
+
+def _evaluate_chunk(
+    evaluator: RAGEvaluator, chunk: List[DatasetRow]
+) -> List[Dict[str, Any]]:
+    """Evaluates the rows of a chunk together, falling back to one row at a time to isolate the rows that fail"""
+    try:
+        results = evaluator.evaluate_rag_batch(
+            [(row.query, row.answer, row.contexts) for row in chunk]
+        )
+        return [_result_record(row, result) for row, result in zip(chunk, results)]
+    except ModelException as e:
+        if len(chunk) == 1:
+            return [{"id": chunk[0].id, "error": f"{type(e).__name__}: {e}"}]
+    return [record for row in chunk for record in _evaluate_chunk(evaluator, [row])]
@@ -0,0 +1,47 @@
+import json
+import unicodedata
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from pydantic import BaseModel
+
+
+def normalize_text(text: str) -> str:
+    """Normalizes the text with NFKC, collapses every run of whitespace into a single space and strips it"""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def dedup_key(metric_name: str, fields: Dict[str, str], normalize: bool) -> str:
+    """Returns the key under which the inputs of a metric are considered the same, optionally after normalizing the template fields"""
+    if normalize:
+        fields = {name: normalize_text(value) for name, value in fields.items()}
+    return json.dumps([metric_name, fields], sort_keys=True, ensure_ascii=False)
+
+
+class ResultMemo:
+    """In memory LRU of the most recent metric results, keyed by `dedup_key`. It stores and returns copies, so callers may change their results"""
+
+    def __init__(self, max_entries: int) -> None:
+        self.max_entries = max_entries
+        self._entries: OrderedDict[str, BaseModel] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[BaseModel]:
+        result = self._entries.get(key)
+        if result is None:
+            return None
+        self._entries.move_to_end(key)
+        return result.model_copy(deep=True)
+
+    def put(self, key: str, result: BaseModel) -> None:
+        if self.max_entries <= 0:
+            return
+        self._entries[key] = result.model_copy(deep=True)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        self._entries.clear()
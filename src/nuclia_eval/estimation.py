@@ -0,0 +1,278 @@
+import math
+import random
+from dataclasses import dataclass
+from statistics import NormalDist, fmean
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+)
+
+from nuclia_eval.dataset import DatasetRow
+from nuclia_eval.metrics import AnswerRelevance, ContextRelevance, Groundedness
+from nuclia_eval.metrics.base import InvalidToolCallResponse, Metric
+
+if TYPE_CHECKING:  # pragma: no cover
+    from nuclia_eval.models.remi import REMiEvaluator
+
+# Highest score of the metrics, the Wilson interval is computed on the scores scaled to [0, 1]
+MAX_SCORE = 5
+
+BOOTSTRAP_RESAMPLES = 1000
+
+# Context positions from this one on are in the same stratum
+POSITION_STRATA = 4
+
+
+@dataclass
+class MetricEstimate:
+    """Estimate of the mean score of a metric over a dataset, from the items scored so far.
+
+    `population` is the number of items the sample is drawn from, the rows for answer relevance and the (row, context) pairs for the rest,
+    and `done` is set once the interval is narrower than the target or every item has been scored.
+    """
+
+    mean: float
+    low: float
+    high: float
+    samples: int
+    population: int
+    done: bool = False
+
+    @property
+    def width(self) -> float:
+        return self.high - self.low
+
+
+class _Stratum:
+    def __init__(self, items: List[Tuple[Any, ...]]) -> None:
+        self.pending = items
+        self.size = len(items)
+        self.scores: List[int] = []
+
+
+class _MetricSampler:
+    """Draws the items of a metric from its strata with proportional allocation and keeps their scores"""
+
+    def __init__(self, metric: Metric, strata: Dict[Hashable, List[Tuple[Any, ...]]]):
+        self.metric = metric
+        self.strata = [_Stratum(items) for items in strata.values() if items]
+        self.population = sum(stratum.size for stratum in self.strata)
+        self.drawn = 0
+
+    @property
+    def samples(self) -> int:
+        return sum(len(stratum.scores) for stratum in self.strata)
+
+    @property
+    def exhausted(self) -> bool:
+        return self.drawn == self.population
+
+    def draw(self, n: int) -> List[Tuple[_Stratum, Tuple[Any, ...]]]:
+        drawn = []
+        for _ in range(min(n, self.population - self.drawn)):
+            # The stratum sampled the least relative to its size, so the sample keeps the proportions of the population
+            stratum = min(
+                (stratum for stratum in self.strata if stratum.pending),
+                key=lambda stratum: (
+                    (stratum.size - len(stratum.pending)) / stratum.size
+                ),
+            )
+            drawn.append((stratum, stratum.pending.pop()))
+            self.drawn += 1
+        return drawn
+
+    def estimate(
+        self,
+        method: Literal["wilson", "bootstrap"],
+        confidence: float,
+        finite: bool,
+        rng: random.Random,
+    ) -> MetricEstimate:
+        sampled = [stratum for stratum in self.strata if stratum.scores]
+        samples = self.samples
+        if not sampled:
+            return MetricEstimate(0.0, 0.0, float(MAX_SCORE), 0, self.population)
+        total = sum(stratum.size for stratum in sampled)
+        weights = [stratum.size / total for stratum in sampled]
+        mean = sum(
+            weight * fmean(stratum.scores) for weight, stratum in zip(weights, sampled)
+        )
+        if finite and samples == self.population:
+            return MetricEstimate(mean, mean, mean, samples, self.population)
+        if method == "bootstrap":
+            low, high = _bootstrap_interval(
+                [stratum.scores for stratum in sampled], weights, confidence, rng
+            )
+        else:
+            # Without replacement from a finite population the sample counts for more, up to the whole population
+            effective = float(samples)
+            if finite:
+                effective = (
+                    samples * (self.population - 1) / (self.population - samples)
+                )
+            low, high = _wilson_interval(mean / MAX_SCORE, effective, confidence)
+            low, high = low * MAX_SCORE, high * MAX_SCORE
+        return MetricEstimate(mean, low, high, samples, self.population)
+
+
+def _wilson_interval(p: float, n: float, confidence: float) -> Tuple[float, float]:
+    """Wilson score interval of a proportion, which for the mean of a variable bounded in [0, 1] is conservative, as its variance is at most p(1 - p)"""
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    denominator = 1 + z**2 / n
+    center = (p + z**2 / (2 * n)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / n + z**2 / (4 * n**2)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def _bootstrap_interval(
+    strata_scores: List[List[int]],
+    weights: List[float],
+    confidence: float,
+    rng: random.Random,
+) -> Tuple[float, float]:
+    """Percentile interval of the stratified mean, resampling the scores of each stratum with replacement"""
+    try:
+        import numpy as np
+    except ImportError as e:  # pragma: no cover
+        raise ImportError(
+            "Bootstrap intervals require numpy, install it with `pip install numpy`"
+        ) from e
+    generator = np.random.default_rng(rng.getrandbits(64))
+    means = np.zeros(BOOTSTRAP_RESAMPLES)
+    for scores, weight in zip(strata_scores, weights):
+        values = np.asarray(scores, dtype=float)
+        resampled = generator.integers(
+            0, len(values), (BOOTSTRAP_RESAMPLES, len(values))
+        )
+        means += weight * values[resampled].mean(axis=1)
+    alpha = (1 - confidence) / 2
+    low, high = np.quantile(means, [alpha, 1 - alpha])
+    return float(low), float(high)
+
+
+def _reservoir(
+    rows: Iterable[DatasetRow], max_rows: int, rng: random.Random
+) -> Tuple[List[DatasetRow], bool]:
+    """A uniform sample of at most `max_rows` of the rows, in one pass, and whether it holds all of them"""
+    sample: List[DatasetRow] = []
+    seen = 0
+    for row in rows:
+        seen += 1
+        if len(sample) < max_rows:
+            sample.append(row)
+        else:
+            i = rng.randrange(seen)
+            if i < max_rows:
+                sample[i] = row
+    return sample, seen <= max_rows
+
+
+def estimate_metrics(
+    evaluator: "REMiEvaluator",
+    rows: Iterable[DatasetRow],
+    *,
+    target_width: float = 0.2,
+    confidence: float = 0.95,
+    method: Literal["wilson", "bootstrap"] = "wilson",
+    batch_size: int = 32,
+    min_samples: int = 30,
+    max_rows: int = 100_000,
+    stratify: Optional[Callable[[DatasetRow], Hashable]] = None,
+    seed: Optional[int] = None,
+) -> Iterator[Dict[str, MetricEstimate]]:
+    """Estimates the mean answer relevance, context relevance and groundedness of a dataset by scoring a random sample of it, until their
+    confidence intervals are narrower than `target_width`.
+
+    The (query, answer) of the rows and their (query, context) and (answer, context) pairs are sampled without replacement and scored in
+    rounds of `batch_size` items per metric, whose prompts are batched together. The items are stratified by the position of the context,
+    and by `stratify` of their row if given, and drawn in proportion to the size of each stratum. After every round the running estimates
+    are yielded, the metrics whose interval is narrow enough stop being sampled, and the iteration ends once all of them are done or the
+    dataset is exhausted. Intervals are Wilson score intervals of the scores scaled to [0, 1], conservative as the scores are bounded, or
+    percentile bootstrap intervals of the stratified mean, which require numpy. Items whose tool call is invalid are left out of the sample.
+
+    Args:
+        evaluator (REMiEvaluator): The evaluator that scores the sampled items
+        rows (Iterable[DatasetRow]): The rows of the dataset
+        target_width (float, optional): The width, on the 0 to 5 scale of the scores, of the intervals to reach. Defaults to 0.2.
+        confidence (float, optional): The confidence level of the intervals. Defaults to 0.95.
+        method (Literal["wilson", "bootstrap"], optional): How the intervals are computed. Defaults to "wilson".
+        batch_size (int, optional): How many items of each metric are scored per round. Defaults to 32.
+        min_samples (int, optional): Items of a metric scored before its interval is trusted to stop. Defaults to 30.
+        max_rows (int, optional): The rows are reservoir sampled down to this many in one pass, which bounds the memory for datasets of any size. Defaults to 100_000.
+        stratify (Optional[Callable[[DatasetRow], Hashable]], optional): The stratum of a row, e.g. its source or topic. Defaults to None.
+        seed (Optional[int], optional): Seed of the sampling, for reproducible estimates. Defaults to None.
+
+    Yields:
+        Dict[str, MetricEstimate]: The estimate of each metric, by metric name, after each round
+    """
+    rng = random.Random(seed)
+    sample, finite = _reservoir(rows, max_rows, rng)
+    answer_strata: Dict[Hashable, List[Tuple[Any, ...]]] = {}
+    context_strata: Dict[Hashable, List[Tuple[Any, ...]]] = {}
+    for row in sample:
+        row_stratum = stratify(row) if stratify is not None else None
+        answer_strata.setdefault(row_stratum, []).append((row,))
+        for position, context in enumerate(row.contexts):
+            context_strata.setdefault(
+                (row_stratum, min(position, POSITION_STRATA - 1)), []
+            ).append((row, context))
+    for items in (*answer_strata.values(), *context_strata.values()):
+        rng.shuffle(items)
+    samplers = {
+        "answer_relevance": _MetricSampler(AnswerRelevance, answer_strata),
+        # Both context metrics are drawn from their own copy of the pairs, so each one stops on its own
+        "context_relevance": _MetricSampler(
+            ContextRelevance, {k: list(v) for k, v in context_strata.items()}
+        ),
+        "groundedness": _MetricSampler(
+            Groundedness, {k: list(v) for k, v in context_strata.items()}
+        ),
+    }
+    estimates = {
+        name: MetricEstimate(
+            0.0, 0.0, float(MAX_SCORE), 0, sampler.population, sampler.exhausted
+        )
+        for name, sampler in samplers.items()
+    }
+
+    while not all(estimate.done for estimate in estimates.values()):
+        draws = {
+            name: sampler.draw(batch_size)
+            for name, sampler in samplers.items()
+            if not estimates[name].done
+        }
+        results = evaluator._evaluate_metrics(
+            [
+                (samplers[name].metric, [_fields(name, item) for _, item in drawn])
+                for name, drawn in draws.items()
+            ]
+        )
+        for (name, drawn), metric_results in zip(draws.items(), results):
+            for (stratum, _), result in zip(drawn, metric_results):
+                if not isinstance(result, InvalidToolCallResponse):
+                    stratum.scores.append(result.score)  # type: ignore
+            sampler = samplers[name]
+            estimate = sampler.estimate(method, confidence, finite, rng)
+            estimate.done = sampler.exhausted or (
+                estimate.samples >= min_samples and estimate.width <= target_width
+            )
+            estimates[name] = estimate
+        yield dict(estimates)
+
+
+def _fields(name: str, item: Tuple[Any, ...]) -> Dict[str, str]:
+    row = item[0]
+    if name == "answer_relevance":
+        return {"query": row.query, "answer": row.answer}
+    if name == "context_relevance":
+        return {"query": row.query, "context": item[1]}
+    return {"answer": row.answer, "context": item[1]}
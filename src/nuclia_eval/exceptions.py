@@ -8,3 +8,21 @@ class InvalidToolCallException(ModelException):
     """Exception for when a model does not generate an output that can be mapped to the desired metric."""
 
     pass
+
+
+class PromptTooLongException(ModelException):
+    """Exception for when the inputs of a metric do not fit in the token budget of the prompt."""
+
+    pass
+
+
+class ModelNotReadyException(ModelException):
+    """Exception for when an evaluator is used before its model, loaded in the background, is ready."""
+
+    pass
+
+
+class ModelCacheException(Exception):
+    """Exception for when a model is not in the model cache and can not be downloaded, or its download is not valid."""
+
+    pass
@@ -0,0 +1,258 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+
+from nuclia_eval import logger
+
+# Stages where the model runs, their time is the denominator of `tokens_per_second`
+MODEL_STAGES = ("prefill", "decode", "score", "engine")
+
+_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+_BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64)
+
+
+@dataclass
+class CallStats:
+    """Measurements of a call to an evaluator, or of the loading of its model when `operation` is `load`.
+
+    `stages` holds the seconds spent in each stage of the call: `cache_lookup`, `prefilter`, `tokenize`, `prefill`, `decode`, `score`, `engine` and `parse`
+    for evaluations, and the startup steps for `load`. `prompts` counts the inputs of each metric, `cached` those served by the result cache
+    and `deduplicated` those that repeat another input of the call or one evaluated recently. `prefiltered` counts the contexts scored 0 by
+    the prefilter without running the model, and `recovered` the invalid tool calls that were repaired or decoded again.
+    """
+
+    operation: str
+    prompts: Dict[str, int] = field(default_factory=dict)
+    cached: int = 0
+    deduplicated: int = 0
+    prefiltered: int = 0
+    batch_sizes: List[int] = field(default_factory=list)
+    prompt_tokens: int = 0
+    generated_tokens: int = 0
+    parse_failures: int = 0
+    recovered: int = 0
+    stages: Dict[str, float] = field(default_factory=dict)
+    seconds: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def tokens_per_second(self) -> float:
+        """Prompt and generated tokens processed per second of the stages that run the model"""
+        model_seconds = sum(self.stages.get(stage, 0.0) for stage in MODEL_STAGES)
+        if model_seconds == 0:
+            return 0.0
+        return (self.prompt_tokens + self.generated_tokens) / model_seconds
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """Adds the time spent in the block to the stage"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+
+Callback = Callable[[CallStats], None]
+
+
+def emit(callbacks: List[Callback], stats: CallStats) -> None:
+    """Sends the stats to every callback, a failing callback is logged and does not affect the others or the evaluation"""
+    for callback in callbacks:
+        try:
+            callback(stats)
+        except Exception as e:
+            logger.warning(f"Instrumentation callback {callback!r} failed: {e!r}")
+
+
+class _Histogram:
+    def __init__(self, buckets: Tuple[float, ...]) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class PrometheusExporter:
+    """Callback that aggregates the stats of the calls and renders them in the Prometheus text exposition format.
+
+    Serve the output of `render` from a metrics endpoint, or write it to a file for the textfile collector of the node exporter.
+
+    Args:
+        namespace (str, optional): Prefix of the metric names. Defaults to "nuclia_eval".
+    """
+
+    def __init__(self, namespace: str = "nuclia_eval") -> None:
+        self.namespace = namespace
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], float] = {}
+        self._histograms: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], _Histogram] = {}
+
+    def __call__(self, stats: CallStats) -> None:
+        operation = (("operation", stats.operation),)
+        with self._lock:
+            self._inc("calls_total", operation)
+            if stats.error is not None:
+                self._inc("errors_total", operation + (("error", stats.error),))
+            for metric, prompts in stats.prompts.items():
+                self._inc("prompts_total", (("metric", metric),), prompts)
+            self._inc("cached_results_total", (), stats.cached)
+            self._inc("deduplicated_total", (), stats.deduplicated)
+            self._inc("prefiltered_total", (), stats.prefiltered)
+            self._inc("prompt_tokens_total", (), stats.prompt_tokens)
+            self._inc("generated_tokens_total", (), stats.generated_tokens)
+            self._inc("parse_failures_total", (), stats.parse_failures)
+            self._inc("recovered_total", (), stats.recovered)
+            for stage, seconds in stats.stages.items():
+                self._inc(
+                    "stage_seconds_total", operation + (("stage", stage),), seconds
+                )
+            self._observe("call_seconds", operation, stats.seconds, _SECONDS_BUCKETS)
+            for batch_size in stats.batch_sizes:
+                self._observe("batch_size", (), batch_size, _BATCH_SIZE_BUCKETS)
+
+    def render(self) -> str:
+        """Returns the aggregated metrics in the Prometheus text exposition format"""
+        lines: List[str] = []
+        with self._lock:
+            for name in sorted({name for name, _ in self._counters}):
+                lines.append(f"# TYPE {self.namespace}_{name} counter")
+                for (counter, labels), value in sorted(self._counters.items()):
+                    if counter == name:
+                        lines.append(
+                            f"{self.namespace}_{name}{_labels(labels)} {value:g}"
+                        )
+            for name in sorted({name for name, _ in self._histograms}):
+                lines.append(f"# TYPE {self.namespace}_{name} histogram")
+                for (histogram_name, labels), histogram in sorted(
+                    self._histograms.items(), key=lambda item: item[0]
+                ):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bucket, count in zip(
+                        histogram.buckets + (float("inf"),), histogram.counts
+                    ):
+                        cumulative += count
+                        le = "+Inf" if bucket == float("inf") else f"{bucket:g}"
+                        lines.append(
+                            f"{self.namespace}_{name}_bucket{_labels(labels + (('le', le),))} {cumulative}"
+                        )
+                    lines.append(
+                        f"{self.namespace}_{name}_sum{_labels(labels)} {histogram.sum:g}"
+                    )
+                    lines.append(
+                        f"{self.namespace}_{name}_count{_labels(labels)} {histogram.count}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def _inc(
+        self, name: str, labels: Tuple[Tuple[str, str], ...], value: float = 1
+    ) -> None:
+        self._counters[(name, labels)] = self._counters.get((name, labels), 0) + value
+
+    def _observe(
+        self,
+        name: str,
+        labels: Tuple[Tuple[str, str], ...],
+        value: float,
+        buckets: Tuple[float, ...],
+    ) -> None:
+        if (name, labels) not in self._histograms:
+            self._histograms[(name, labels)] = _Histogram(buckets)
+        self._histograms[(name, labels)].observe(value)
+
+
+def _labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (
+        (name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class OpenTelemetryExporter:
+    """Callback that records the stats of the calls as OpenTelemetry metrics, it requires `opentelemetry-api`.
+
+    Args:
+        meter (Optional[Any], optional): The meter the instruments are created with, by default the one of the global meter provider. Defaults to None.
+    """
+
+    def __init__(self, meter: Optional[Any] = None) -> None:
+        if meter is None:
+            try:
+                from opentelemetry import metrics
+            except ImportError as e:  # pragma: no cover
+                raise ImportError(
+                    "Exporting to OpenTelemetry requires opentelemetry-api, install it with `pip install opentelemetry-api`"
+                ) from e
+            meter = metrics.get_meter("nuclia_eval")
+        self._calls = meter.create_counter("nuclia_eval.calls", description="Calls")
+        self._errors = meter.create_counter(
+            "nuclia_eval.errors", description="Calls that raised an error"
+        )
+        self._prompts = meter.create_counter(
+            "nuclia_eval.prompts", description="Metric inputs evaluated"
+        )
+        self._cached = meter.create_counter(
+            "nuclia_eval.cached_results",
+            description="Metric inputs served by the result cache",
+        )
+        self._deduplicated = meter.create_counter(
+            "nuclia_eval.deduplicated",
+            description="Metric inputs that repeat another one",
+        )
+        self._prefiltered = meter.create_counter(
+            "nuclia_eval.prefiltered",
+            description="Contexts scored 0 by the prefilter without running the model",
+        )
+        self._tokens = meter.create_counter(
+            "nuclia_eval.tokens", unit="{token}", description="Tokens processed"
+        )
+        self._parse_failures = meter.create_counter(
+            "nuclia_eval.parse_failures",
+            description="Generations that are not a valid tool call",
+        )
+        self._recovered = meter.create_counter(
+            "nuclia_eval.recovered",
+            description="Invalid tool calls that were repaired or decoded again",
+        )
+        self._stage_duration = meter.create_histogram(
+            "nuclia_eval.stage.duration", unit="s", description="Time spent per stage"
+        )
+        self._call_duration = meter.create_histogram(
+            "nuclia_eval.call.duration", unit="s", description="Time spent per call"
+        )
+        self._batch_size = meter.create_histogram(
+            "nuclia_eval.batch_size", description="Prompts per model batch"
+        )
+
+    def __call__(self, stats: CallStats) -> None:
+        attributes = {"operation": stats.operation}
+        self._calls.add(1, attributes)
+        if stats.error is not None:
+            self._errors.add(1, {**attributes, "error": stats.error})
+        for metric, prompts in stats.prompts.items():
+            self._prompts.add(prompts, {"metric": metric})
+        self._cached.add(stats.cached)
+        self._deduplicated.add(stats.deduplicated)
+        self._prefiltered.add(stats.prefiltered)
+        self._tokens.add(stats.prompt_tokens, {"kind": "prompt"})
+        self._tokens.add(stats.generated_tokens, {"kind": "generated"})
+        self._parse_failures.add(stats.parse_failures)
+        self._recovered.add(stats.recovered)
+        for stage, seconds in stats.stages.items():
+            self._stage_duration.record(seconds, {**attributes, "stage": stage})
+        self._call_duration.record(stats.seconds, attributes)
+        for batch_size in stats.batch_sizes:
+            self._batch_size.record(batch_size)
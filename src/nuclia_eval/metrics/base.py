@@ -1,6 +1,7 @@
-from typing import Any, Type
+from typing import Any, Literal, Optional, Type, Union
 
 from pydantic import BaseModel, Field
+from pydantic.json_schema import SkipJsonSchema
 
 
 class Metric(BaseModel):
@@ -17,13 +18,68 @@ class Metric(BaseModel):
     )
 
 
+class PromptBudgetInfo(BaseModel):
+    """How the inputs of a metric were fitted in the token budget of the prompt"""
+
+    policy: Literal["truncate", "chunk"] = Field(
+        description="The policy applied to the inputs that did not fit"
+    )
+    prompt_tokens: int = Field(
+        description="The tokens of the prompt with the whole inputs"
+    )
+    truncated_tokens: int = Field(
+        default=0, description="The tokens removed from the end of the inputs"
+    )
+    chunks: int = Field(
+        default=1, description="The number of chunks the input was evaluated in"
+    )
+    chunk_scores: list[int] = Field(
+        default_factory=list,
+        description="The score of each chunk, aggregated into the score of the metric",
+    )
+
+
 class DiscreteScoreResponse(BaseModel):
     score: int = Field(
         ge=0, le=5, description="The score of the metric, on a scale of 0 to 5"
     )
+    # Set by the evaluator, they are not part of the tool the model calls
+    prompt_budget: SkipJsonSchema[Optional[PromptBudgetInfo]] = Field(
+        default=None,
+        description="How the inputs were fitted in the token budget of the prompt, None when they fit as they are",
+    )
+    recovery: SkipJsonSchema[Optional[Literal["repaired", "regenerated"]]] = Field(
+        default=None,
+        description="How the result was recovered from an invalid tool call, `repaired` if it was parsed leniently from the generated text and `regenerated` if the prompt was decoded again with constrained decoding, None when the tool call was valid",
+    )
+    prefilter_score: SkipJsonSchema[Optional[float]] = Field(
+        default=None,
+        description="The lexical overlap of the context when the prefilter scored it 0 without running the model, None when the model evaluated it",
+    )
 
 
 class DiscreteScoreReasonResponse(DiscreteScoreResponse):
     reason: str = Field(
         description="The reason for the score, limited to 150 characters"
     )
+
+
+class DiscreteScoreDistributionResponse(DiscreteScoreResponse):
+    probabilities: list[float] = Field(
+        description="The probability of each score, from 0 to 5, according to the model"
+    )
+    expected_score: float = Field(
+        ge=0, le=5, description="The mean of the scores weighted by their probability"
+    )
+
+
+class InvalidToolCallResponse(BaseModel):
+    """Result of an input whose tool call could not be recovered, returned instead of raising an `InvalidToolCallException` when the `on_invalid_tool_call` setting is `report`"""
+
+    error: str = Field(description="Why the tool call is not valid")
+    output: str = Field(description="The text generated by the model")
+
+
+# The result of a metric for an input, an `InvalidToolCallResponse` in place of the response of the metric when the evaluator reports the invalid tool calls
+ScoreResult = Union[DiscreteScoreResponse, InvalidToolCallResponse]
+ScoreReasonResult = Union[DiscreteScoreReasonResponse, InvalidToolCallResponse]
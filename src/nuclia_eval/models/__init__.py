@@ -1,5 +1,40 @@
 """This module contains the ML models used to evaluate the quality of the RAG experience."""
 
-from nuclia_eval.models.remi import REMiEvaluator
+import importlib
+from typing import TYPE_CHECKING, Any
 
-__all__ = ["REMiEvaluator"]
+if TYPE_CHECKING:  # pragma: no cover
+    from nuclia_eval.models.async_remi import AsyncREMiEvaluator
+    from nuclia_eval.models.daemon import DaemonEvaluator
+    from nuclia_eval.models.http import HTTPEvaluator
+    from nuclia_eval.models.pool import EvaluatorPool
+    from nuclia_eval.models.remi import REMiEvaluator
+
+# The evaluators pull in torch and the model stack, they are only imported when first accessed
+_LAZY_ATTRIBUTES = {
+    "AsyncREMiEvaluator": "nuclia_eval.models.async_remi",
+    "DaemonEvaluator": "nuclia_eval.models.daemon",
+    "EvaluatorPool": "nuclia_eval.models.pool",
+    "HTTPEvaluator": "nuclia_eval.models.http",
+    "REMiEvaluator": "nuclia_eval.models.remi",
+}
+
+__all__ = [
+    "AsyncREMiEvaluator",
+    "DaemonEvaluator",
+    "EvaluatorPool",
+    "HTTPEvaluator",
+    "REMiEvaluator",
+]
+
+
+def __getattr__(name: str) -> Any:
+    if name in _LAZY_ATTRIBUTES:
+        value = getattr(importlib.import_module(_LAZY_ATTRIBUTES[name]), name)
+        globals()[name] = value
+        return value
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__() -> list[str]:
+    return sorted(list(globals()) + list(_LAZY_ATTRIBUTES))
@@ -0,0 +1,166 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Optional, Tuple, cast
+
+from pydantic import BaseModel
+
+from nuclia_eval import logger
+from nuclia_eval.exceptions import ModelException
+from nuclia_eval.metrics import AnswerRelevance, ContextRelevance, Groundedness
+from nuclia_eval.metrics.base import Metric, ScoreReasonResult, ScoreResult
+from nuclia_eval.models.base import AsyncRAGEvaluator
+from nuclia_eval.models.remi import REMiEvaluator
+
+
+@dataclass
+class _MetricRequest:
+    metric: Metric
+    inputs: list[dict[str, str]]
+    future: "asyncio.Future[list[BaseModel]]"
+
+
+class AsyncREMiEvaluator(AsyncRAGEvaluator):
+    """Async evaluator that coalesces the requests of many coroutines into micro-batches for a `REMiEvaluator`.
+
+    Requests are queued and, once the first one arrives, the evaluator waits up to the `async_batch_window` setting for more,
+    or until `max_batch_size` prompts are queued. The prompts of each metric are then evaluated together in a worker thread,
+    so the event loop stays responsive while the model runs, and each caller gets its own results.
+    """
+
+    def __init__(self, evaluator: REMiEvaluator) -> None:
+        self.evaluator = evaluator
+        self.batch_window = evaluator.settings.async_batch_window
+        self.max_batch_size = evaluator.settings.max_batch_size
+        # A single worker, the model evaluates one batch at a time
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="nuclia-eval"
+        )
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional["asyncio.Queue[_MetricRequest]"] = None
+        self._dispatcher: Optional["asyncio.Task[None]"] = None
+
+    async def evaluate_rag(
+        self, query: str, answer: str, contexts: list[str]
+    ) -> Tuple[ScoreReasonResult, list[ScoreResult], list[ScoreResult]]:
+        answer_relevance, context_relevance, groundedness = await asyncio.gather(
+            self.answer_relevance(query, answer),
+            self.context_relevance(query, contexts),
+            self.groundedness(answer, contexts),
+        )
+        return answer_relevance, context_relevance, groundedness
+
+    async def answer_relevance(self, query: str, answer: str) -> ScoreReasonResult:
+        results = await self._submit(
+            AnswerRelevance, [{"query": query, "answer": answer}]
+        )
+        return cast(ScoreReasonResult, results[0])
+
+    async def context_relevance(
+        self, query: str, contexts: list[str]
+    ) -> list[ScoreResult]:
+        results = await self._submit(
+            ContextRelevance,
+            [{"query": query, "context": context} for context in contexts],
+        )
+        return cast(list[ScoreResult], results)
+
+    async def groundedness(self, answer: str, contexts: list[str]) -> list[ScoreResult]:
+        results = await self._submit(
+            Groundedness,
+            [{"answer": answer, "context": context} for context in contexts],
+        )
+        return cast(list[ScoreResult], results)
+
+    async def aclose(self) -> None:
+        """Stops dispatching requests, the requests still queued are cancelled"""
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            try:
+                await self._dispatcher
+            except asyncio.CancelledError:
+                pass
+            self._dispatcher = None
+        if self._queue is not None:
+            while not self._queue.empty():
+                self._queue.get_nowait().future.cancel()
+            self._queue = None
+        self._executor.shutdown(wait=False)
+
+    async def __aenter__(self) -> "AsyncREMiEvaluator":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def _submit(
+        self, metric: Metric, inputs: list[dict[str, str]]
+    ) -> list[BaseModel]:
+        if not inputs:
+            return []
+        loop = asyncio.get_running_loop()
+        # The queue and the dispatcher belong to the event loop they were created in
+        if self._queue is None or self._loop is not loop:
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._dispatcher = None
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = loop.create_task(self._dispatch())
+        future: "asyncio.Future[list[BaseModel]]" = loop.create_future()
+        self._queue.put_nowait(_MetricRequest(metric, inputs, future))
+        return await future
+
+    async def _dispatch(self) -> None:
+        assert self._queue is not None
+        loop = asyncio.get_running_loop()
+        while True:
+            pending = [await self._queue.get()]
+            size = len(pending[0].inputs)
+            deadline = loop.time() + self.batch_window
+            while size < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    request = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                pending.append(request)
+                size += len(request.inputs)
+
+            # Group the requests by metric, keeping their arrival order
+            groups: dict[str, list[_MetricRequest]] = {}
+            for request in pending:
+                if not request.future.done():
+                    groups.setdefault(
+                        request.metric.tool["function"]["name"], []
+                    ).append(request)
+            for requests in groups.values():
+                await self._run(requests)
+
+    async def _run(self, requests: list[_MetricRequest]) -> None:
+        """Evaluates the requests of a metric together, if that fails each request is evaluated on its own so only the requests that fail get the error"""
+        loop = asyncio.get_running_loop()
+        inputs = [fields for request in requests for fields in request.inputs]
+        logger.debug(
+            f"Evaluating {len(inputs)} {requests[0].metric.tool['function']['name']} prompts from {len(requests)} requests"
+        )
+        try:
+            results = await loop.run_in_executor(
+                self._executor, self.evaluator._evaluate, requests[0].metric, inputs
+            )
+        except Exception as e:
+            if len(requests) > 1 and isinstance(e, ModelException):
+                for request in requests:
+                    await self._run([request])
+                return
+            for request in requests:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            return
+        start = 0
+        for request in requests:
+            end = start + len(request.inputs)
+            if not request.future.done():
+                request.future.set_result(results[start:end])
+            start = end
@@ -1,7 +1,7 @@
 from abc import ABC, abstractmethod
 from typing import Tuple
 
-from nuclia_eval.metrics.base import DiscreteScoreReasonResponse, DiscreteScoreResponse
+from nuclia_eval.metrics.base import ScoreReasonResult, ScoreResult
 
 
 class RAGEvaluator(ABC):  # pragma: no cover
@@ -11,9 +11,9 @@ class RAGEvaluator(ABC):  # pragma: no cover
     def evaluate_rag(
         self, query: str, answer: str, contexts: list[str]
     ) -> Tuple[
-        DiscreteScoreReasonResponse,
-        list[DiscreteScoreResponse],
-        list[DiscreteScoreResponse],
+        ScoreReasonResult,
+        list[ScoreResult],
+        list[ScoreResult],
     ]:
         """This method evaluates a whole RAG experience, given the user's query, the model's answer and contexts retrieved at the retrieval phase it computes the answer relevance, context relevance and groundedness.
 
@@ -30,16 +30,38 @@ class RAGEvaluator(ABC):  # pragma: no cover
             contexts (list[str]): The contexts retrieved at the retrieval phase that were used to generate the answer
 
         Returns:
-            Tuple[ DiscreteScoreReasonResponse, list[DiscreteScoreResponse], list[DiscreteScoreResponse], ]: A tuple containing the evaluation result for the answer relevance, the context relevance results and groundedness results
+            Tuple[ ScoreReasonResult, list[ScoreResult], list[ScoreResult], ]: A tuple containing the evaluation result for the answer relevance, the context relevance results and groundedness results. An input whose tool call is reported as invalid, see the `on_invalid_tool_call` setting, has an `InvalidToolCallResponse` as its result
         """
         ...
 
+    def evaluate_rag_batch(
+        self, items: list[Tuple[str, str, list[str]]]
+    ) -> list[
+        Tuple[
+            ScoreReasonResult,
+            list[ScoreResult],
+            list[ScoreResult],
+        ]
+    ]:
+        """This method evaluates several RAG experiences, see `evaluate_rag`. Evaluators that can batch the metrics of several experiences together override it, by default each one is evaluated on its own.
+
+        Args:
+            items (list[Tuple[str, str, list[str]]]): The (query, answer, contexts) of each RAG experience
+
+        Returns:
+            list[Tuple[ ScoreReasonResult, list[ScoreResult], list[ScoreResult], ]]: The result of `evaluate_rag` for each RAG experience, in the same order
+        """
+        return [
+            self.evaluate_rag(query, answer, contexts)
+            for query, answer, contexts in items
+        ]
+
     @abstractmethod
     def answer_relevance(
         self,
         query: str,
         answer: str,
-    ) -> DiscreteScoreReasonResponse:
+    ) -> ScoreReasonResult:
         """This method evaluates the relevance of the model's answer to the user's query.
 
         Answer relevance refers to the directness and appropriateness of the response in addressing the specific question asked, providing accurate, complete, and contextually suitable information.
@@ -51,14 +73,12 @@ class RAGEvaluator(ABC):  # pragma: no cover
             answer (str): The model's answer to the user's query
 
         Returns:
-            DiscreteScoreReasonResponse: The evaluation result for the answer relevance
+            ScoreReasonResult: The evaluation result for the answer relevance, or an `InvalidToolCallResponse` if its tool call is reported as invalid
         """
         ...
 
     @abstractmethod
-    def context_relevance(
-        self, query: str, contexts: list[str]
-    ) -> list[DiscreteScoreResponse]:
+    def context_relevance(self, query: str, contexts: list[str]) -> list[ScoreResult]:
         """This method evaluates the relevance of the contexts retrieved at the retrieval phase to the user's query.
 
         The context relevance is the relevance of the **context** to the **question**, on a scale of 0 to 5.
@@ -70,14 +90,12 @@ class RAGEvaluator(ABC):  # pragma: no cover
             contexts (list[str]): The contexts retrieved at the retrieval phase
 
         Returns:
-            list[DiscreteScoreResponse]: The evaluation results for the context relevance
+            list[ScoreResult]: The evaluation results for the context relevance, an `InvalidToolCallResponse` for each context whose tool call is reported as invalid
         """
         ...
 
     @abstractmethod
-    def groundedness(
-        self, answer: str, contexts: list[str]
-    ) -> list[DiscreteScoreResponse]:
+    def groundedness(self, answer: str, contexts: list[str]) -> list[ScoreResult]:
         """This method evaluates the groundedness of the model's answer to the contexts retrieved at the retrieval phase.
         Groundedness is defined as the degree of information overlap to which the **answer** contains information that is substantially similar or identical to that in the **context** piece. The scores are between 0 and 5.
         For more information on groundedness, see the metric's definition at nuclia-eval/src/nuclia_eval/metrics/groundedness.py
@@ -87,6 +105,42 @@ class RAGEvaluator(ABC):  # pragma: no cover
             contexts (list[str]): The contexts retrieved at the retrieval phase
 
         Returns:
-            list[DiscreteScoreResponse]: The evaluation results for the groundedness
+            list[ScoreResult]: The evaluation results for the groundedness, an `InvalidToolCallResponse` for each context whose tool call is reported as invalid
         """
         ...
+
+
+class AsyncRAGEvaluator(ABC):  # pragma: no cover
+    """Base class for all RAG evaluators that can be awaited from an event loop, see `RAGEvaluator` for the definition of each method"""
+
+    @abstractmethod
+    async def evaluate_rag(
+        self, query: str, answer: str, contexts: list[str]
+    ) -> Tuple[
+        ScoreReasonResult,
+        list[ScoreResult],
+        list[ScoreResult],
+    ]:
+        """Async version of `RAGEvaluator.evaluate_rag`"""
+        ...
+
+    @abstractmethod
+    async def answer_relevance(
+        self,
+        query: str,
+        answer: str,
+    ) -> ScoreReasonResult:
+        """Async version of `RAGEvaluator.answer_relevance`"""
+        ...
+
+    @abstractmethod
+    async def context_relevance(
+        self, query: str, contexts: list[str]
+    ) -> list[ScoreResult]:
+        """Async version of `RAGEvaluator.context_relevance`"""
+        ...
+
+    @abstractmethod
+    async def groundedness(self, answer: str, contexts: list[str]) -> list[ScoreResult]:
+        """Async version of `RAGEvaluator.groundedness`"""
+        ...
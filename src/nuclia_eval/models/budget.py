@@ -0,0 +1,172 @@
+from statistics import fmean
+from typing import Literal, Optional, Tuple
+
+from mistral_common.protocol.instruct.tool_calls import Tool
+from pydantic import BaseModel
+
+from nuclia_eval.exceptions import PromptTooLongException
+from nuclia_eval.metrics.base import (
+    DiscreteScoreDistributionResponse,
+    InvalidToolCallResponse,
+    Metric,
+    PromptBudgetInfo,
+)
+from nuclia_eval.models.prompts import PromptEncoder
+
+# Template fields that can be shortened, in the order they are chunked, the query is always kept whole
+BUDGETED_FIELDS = ("context", "answer")
+
+
+class PromptBudget:
+    """Fits the prompts of the metrics in a maximum number of tokens.
+
+    The prompts that do not fit are handled with a policy: `truncate` removes tokens from the end of the longest context or answer until the
+    prompt fits, `chunk` splits the context, or the answer when there is no context, into overlapping windows that are evaluated on their own,
+    and `reject` raises a `PromptTooLongException`.
+
+    Args:
+        encoder (PromptEncoder): The encoder of the prompts
+        max_tokens (int): The maximum number of tokens of a prompt
+        policy (Literal["truncate", "chunk", "reject"]): What to do with the prompts that do not fit
+        overlap (int, optional): Tokens shared by consecutive chunks. Defaults to 64.
+    """
+
+    def __init__(
+        self,
+        encoder: PromptEncoder,
+        max_tokens: int,
+        policy: Literal["truncate", "chunk", "reject"],
+        overlap: int = 64,
+    ) -> None:
+        self.encoder = encoder
+        self.max_tokens = max_tokens
+        self.policy = policy
+        self.overlap = overlap
+        self._raw_tokenizer = encoder.tokenizer.instruct_tokenizer.tokenizer
+
+    def fit(
+        self, metric: Metric, tool: Tool, fields: dict[str, str]
+    ) -> Tuple[list[dict[str, str]], Optional[PromptBudgetInfo]]:
+        """Returns the template fields to evaluate for an input, a single set unless it is chunked, and how they were fitted, None if the prompt already fits
+
+        Raises:
+            PromptTooLongException: If the policy is `reject`, or the prompt can not fit even without the context and answer
+        """
+        prompt_tokens = self._prompt_length(metric, tool, fields)
+        if prompt_tokens <= self.max_tokens:
+            return [fields], None
+        if self.policy == "reject":
+            raise PromptTooLongException(
+                f"The {tool.function.name} prompt has {prompt_tokens} tokens, more than the maximum of {self.max_tokens}"
+            )
+        chunked = next((name for name in BUDGETED_FIELDS if name in fields), None)
+        if self.policy == "truncate" or chunked is None:
+            truncated, truncated_tokens = self._truncate(
+                metric,
+                tool,
+                fields,
+                [name for name in BUDGETED_FIELDS if name in fields],
+            )
+            return [truncated], PromptBudgetInfo(
+                policy="truncate",
+                prompt_tokens=prompt_tokens,
+                truncated_tokens=truncated_tokens,
+            )
+
+        # The other fields are truncated first if they leave no room for the chunks
+        others, truncated_tokens = self._truncate(
+            metric,
+            tool,
+            {**fields, chunked: ""},
+            [name for name in BUDGETED_FIELDS if name in fields and name != chunked],
+            reserved=self.overlap + 1,
+        )
+        window = self.max_tokens - self._prompt_length(metric, tool, others)
+        stride = window - self.overlap
+        tokens = self._encode(fields[chunked])
+        all_chunks = []
+        for start in range(0, max(len(tokens) - self.overlap, 1), stride):
+            # The decoded text may not tokenize back the same, which is fixed by truncating a few more tokens
+            chunk, chunk_truncated = self._truncate(
+                metric,
+                tool,
+                {**others, chunked: self._decode(tokens[start : start + window])},
+                [chunked],
+            )
+            truncated_tokens += chunk_truncated
+            all_chunks.append(chunk)
+        return all_chunks, PromptBudgetInfo(
+            policy="chunk",
+            prompt_tokens=prompt_tokens,
+            truncated_tokens=truncated_tokens,
+            chunks=len(all_chunks),
+        )
+
+    def _truncate(
+        self,
+        metric: Metric,
+        tool: Tool,
+        fields: dict[str, str],
+        names: list[str],
+        reserved: int = 0,
+    ) -> Tuple[dict[str, str], int]:
+        """Removes tokens from the end of the longest of the named fields until the prompt fits, with `reserved` tokens to spare, returning the fields and the tokens removed"""
+        fields = dict(fields)
+        max_tokens = self.max_tokens - reserved
+        truncated_tokens = 0
+        while True:
+            overflow = self._prompt_length(metric, tool, fields) - max_tokens
+            if overflow <= 0:
+                return fields, truncated_tokens
+            candidates = [
+                (len(tokens), name, tokens)
+                for name in names
+                if (tokens := self._encode(fields[name]))
+            ]
+            if not candidates:
+                raise PromptTooLongException(
+                    f"The {tool.function.name} prompt does not fit in {max_tokens} tokens even without its {' and '.join(names) or 'inputs'}"
+                )
+            length, name, tokens = max(candidates, key=lambda candidate: candidate[0])
+            keep = max(0, min(length - overflow, length - 1))
+            fields[name] = self._decode(tokens[:keep])
+            truncated_tokens += length - keep
+
+    def _prompt_length(self, metric: Metric, tool: Tool, fields: dict[str, str]) -> int:
+        return len(self.encoder.encode(metric, tool, fields))
+
+    def _encode(self, text: str) -> list[int]:
+        return self._raw_tokenizer.encode(text, bos=False, eos=False)
+
+    def _decode(self, tokens: list[int]) -> str:
+        return self._raw_tokenizer.decode(tokens) if tokens else ""
+
+
+def aggregate_chunks(
+    results: list[BaseModel], aggregation: Literal["max", "mean"]
+) -> BaseModel:
+    """Aggregates the results of the chunks of an input into one, with the highest score or the mean score.
+
+    The mean of score distributions averages the probabilities, other results take the rounded mean score and the rest of the result of
+    the chunk closest to it, e.g. its reason. Chunks whose tool call was invalid are left out, unless all of them are.
+    """
+    valid = [r for r in results if not isinstance(r, InvalidToolCallResponse)]
+    if not valid:
+        return results[0]
+    results = valid
+    scores = [result.score for result in results]  # type: ignore
+    if aggregation == "max":
+        return results[scores.index(max(scores))].model_copy()
+    if isinstance(results[0], DiscreteScoreDistributionResponse):
+        probabilities = [
+            fmean(column)
+            for column in zip(*(result.probabilities for result in results))  # type: ignore
+        ]
+        return DiscreteScoreDistributionResponse(
+            score=max(range(len(probabilities)), key=probabilities.__getitem__),
+            probabilities=probabilities,
+            expected_score=sum(i * p for i, p in enumerate(probabilities)),
+        )
+    mean = fmean(scores)
+    closest = min(range(len(scores)), key=lambda i: abs(scores[i] - mean))
+    return results[closest].model_copy(update={"score": round(mean)})
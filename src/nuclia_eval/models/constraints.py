@@ -0,0 +1,263 @@
+import json
+import re
+from collections import defaultdict
+from itertools import permutations
+from typing import Dict, Iterator, List, Optional, Sequence, Set, Tuple, Type, Union
+
+import torch
+from mistral_common.tokens.tokenizers.base import Tokenizer
+from pydantic import BaseModel
+
+# The reason is documented to be limited to 150 characters, see `DiscreteScoreReasonResponse`
+MAX_STRING_LENGTH = 150
+
+_BYTE_PIECE = re.compile(r"<0x([0-9A-F]{2})>")
+_ESCAPES = '"\\/bfnrt'
+
+
+class _Digit:
+    """A single digit integer argument"""
+
+    def __init__(self, minimum: int, maximum: int) -> None:
+        self.values = "".join(str(value) for value in range(minimum, maximum + 1))
+
+
+class _String:
+    """A string argument, without its quotes"""
+
+    def __init__(self, max_length: int) -> None:
+        self.max_length = max_length
+
+
+_Part = Union[str, _Digit, _String]
+
+
+class ToolCallGrammar:
+    """Character level grammar of the tool calls a metric expects from the model.
+
+    The tool calls are the json dump of a list with a single call, the same format used to encode the tool calls the model was trained on, e.g.
+    `[{"name": "groundedness", "arguments": {"score": 3}}]`. The arguments can come in any order.
+    Only single digit integer and string arguments are supported, which covers `DiscreteScoreResponse` and `DiscreteScoreReasonResponse`.
+    """
+
+    def __init__(
+        self,
+        tool_name: str,
+        response_model: Type[BaseModel],
+        max_string_length: int = MAX_STRING_LENGTH,
+    ) -> None:
+        schema = response_model.model_json_schema()
+        arguments: list[tuple[str, _Part]] = []
+        for name, definition in schema["properties"].items():
+            if definition.get("type") == "integer":
+                minimum, maximum = definition.get("minimum"), definition.get("maximum")
+                if (
+                    minimum is None
+                    or maximum is None
+                    or not 0 <= minimum <= maximum <= 9
+                ):
+                    raise ValueError(f"Argument {name} is not a single digit integer")
+                arguments.append((name, _Digit(minimum, maximum)))
+            elif definition.get("type") == "string":
+                arguments.append((name, _String(max_string_length)))
+            else:
+                raise ValueError(f"Unsupported type for argument {name}: {definition}")
+
+        call_start = json.dumps([{"name": tool_name, "arguments": {}}])[: -len("}}]")]
+        self._templates: list[list[_Part]] = []
+        for order in permutations(arguments):
+            parts: list[_Part] = [call_start]
+            for i, (name, value) in enumerate(order):
+                separator = ", " if i > 0 else ""
+                if isinstance(value, _String):
+                    parts.extend([f'{separator}"{name}": "', value, '"'])
+                else:
+                    parts.extend([f'{separator}"{name}": ', value])
+            parts.append("}}]")
+            self._templates.append(parts)
+
+    @property
+    def max_length(self) -> int:
+        """The maximum length of a valid tool call, with every escape sequence taking two characters"""
+        return 1 + max(
+            sum(
+                len(part)
+                if isinstance(part, str)
+                else 1
+                if isinstance(part, _Digit)
+                else 2 * part.max_length
+                for part in parts
+            )
+            for parts in self._templates
+        )
+
+    def match(self, text: str) -> Optional[bool]:
+        """Returns True if the text is a complete tool call, False if it is the beginning of one and None if it can not be completed into a valid one"""
+        return self._walk(text)[0]
+
+    def next_chars(self, text: str) -> Optional[str]:
+        """Returns the characters that can follow a valid beginning of a tool call, None if almost any character can"""
+        state, chars = self._walk(text)
+        if state is not False:
+            return ""
+        # The tool call is encoded with the leading space of the first piece
+        return chars + " " if text == "" and chars is not None else chars
+
+    def _walk(self, text: str) -> Tuple[Optional[bool], Optional[str]]:
+        if text.startswith(" "):
+            text = text[1:]
+        results = [_match(parts, text) for parts in self._templates]
+        if any(state is True for state, _ in results):
+            return True, ""
+        expected: Set[str] = set()
+        for state, chars in results:
+            if state is False:
+                if chars is None:
+                    return False, None
+                expected.update(chars)
+        if not expected:
+            return None, ""
+        return False, "".join(sorted(expected))
+
+
+def _match(parts: Sequence[_Part], text: str) -> Tuple[Optional[bool], Optional[str]]:
+    """Matches the text against a template, returning its state and the characters that can follow it"""
+    position = 0
+    for part in parts:
+        if isinstance(part, str):
+            chunk = text[position : position + len(part)]
+            if not part.startswith(chunk):
+                return None, ""
+            if len(chunk) < len(part):
+                return False, part[len(chunk)]
+            position += len(part)
+        elif isinstance(part, _Digit):
+            if position == len(text):
+                return False, part.values
+            if text[position] not in part.values:
+                return None, ""
+            position += 1
+        else:
+            length = 0
+            while True:
+                if position == len(text):
+                    return False, '"' if length == part.max_length else None
+                char = text[position]
+                if char == '"':
+                    break
+                if ord(char) < 0x20:
+                    return None, ""
+                length += 1
+                if length > part.max_length:
+                    return None, ""
+                if char == "\\":
+                    if position + 1 == len(text):
+                        return False, _ESCAPES
+                    if text[position + 1] not in _ESCAPES:
+                        return None, ""
+                    position += 1
+                position += 1
+    return (True, "") if position == len(text) else (None, "")
+
+
+def token_texts(tokenizer: Tokenizer) -> List[Optional[str]]:
+    """Returns the text each token of the vocabulary adds to a decoded output, None for control tokens.
+
+    Bytes outside of the ASCII range are mapped to a replacement character, as they only make sense together with the other bytes of their character.
+    """
+    texts: List[Optional[str]] = []
+    for token, piece in enumerate(tokenizer.vocab()):
+        byte = _BYTE_PIECE.fullmatch(piece)
+        if byte is not None:
+            value = int(byte.group(1), 16)
+            texts.append(chr(value) if value < 0x80 else "�")
+        elif piece != "▁" and not tokenizer.decode([token]):
+            texts.append(None)
+        else:
+            texts.append(piece.replace("▁", " "))
+    return texts
+
+
+class TokenTexts:
+    """The text of each token of a vocabulary, see `token_texts`, indexed by first character"""
+
+    def __init__(self, tokenizer: Tokenizer) -> None:
+        self.texts = token_texts(tokenizer)
+        starting_with: Dict[str, List[int]] = defaultdict(list)
+        for token, text in enumerate(self.texts):
+            if text:
+                starting_with[text[0]].append(token)
+        self.starting_with = {
+            char: torch.tensor(tokens) for char, tokens in starting_with.items()
+        }
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def __getitem__(self, token: int) -> Optional[str]:
+        return self.texts[token]
+
+
+class ToolCallConstraint:
+    """Greedy decoding state of a sequence that must generate a valid tool call.
+
+    The first token is forced to be the tool calls token, after that each step picks the most likely token that keeps the output a valid beginning of a tool call according to the grammar.
+    The sequence is done as soon as the tool call is complete, or as soon as no token can continue it, leaving an invalid tool call for the caller to report.
+    """
+
+    def __init__(
+        self,
+        grammar: ToolCallGrammar,
+        texts: TokenTexts,
+        tool_calls_token: int,
+        top_k: int = 16,
+    ) -> None:
+        self.grammar = grammar
+        self.texts = texts
+        self.tool_calls_token = tool_calls_token
+        self.top_k = top_k
+        self.text = ""
+        self.started = False
+        self.done = False
+
+    def next_token(self, logits: torch.Tensor) -> Optional[int]:
+        """The next token of the sequence, None when no token can continue the tool call"""
+        if not self.started:
+            self.started = True
+            return self.tool_calls_token
+        for token in self._candidates(logits, self.grammar.next_chars(self.text)):
+            token_text = self.texts[token]
+            if token_text is None:
+                continue
+            state = self.grammar.match(self.text + token_text)
+            if state is not None:
+                self.text += token_text
+                self.done = state
+                return token
+        self.done = True
+        return None
+
+    def _candidates(
+        self, logits: torch.Tensor, next_chars: Optional[str]
+    ) -> Iterator[int]:
+        """Yields tokens from the most to the least likely.
+
+        Only the tokens starting with one of `next_chars` are considered when the grammar restricts them, otherwise the greedy
+        token is almost always valid so the whole vocabulary is only sorted when needed.
+        """
+        if next_chars is not None:
+            indexed = [
+                self.texts.starting_with[c]
+                for c in next_chars
+                if c in self.texts.starting_with
+            ]
+            if not indexed:
+                return
+            tokens = torch.cat(indexed)
+            order = torch.argsort(
+                logits[tokens.to(logits.device)].float(), descending=True
+            )
+            yield from tokens[order.cpu()].tolist()
+            return
+        yield from torch.topk(logits, self.top_k).indices.tolist()
+        yield from torch.argsort(logits, descending=True).tolist()
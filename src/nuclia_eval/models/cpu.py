@@ -0,0 +1,110 @@
+import os
+
+import torch
+import torch.nn.functional as F
+from mistral_inference.transformer import Transformer
+
+from nuclia_eval import logger
+from nuclia_eval.exceptions import ModelException
+
+
+def cpu_attention(xq, key, val, attn_bias=None):
+    """Plain PyTorch replacement for xformers' `memory_efficient_attention`, which has no CPU kernels.
+
+    Like xformers, it attends within each sequence of a block diagonal mask instead of materializing the mask of the whole batch, so the cost
+    of a batch grows linearly with its number of sequences. Queries are the last positions of their sequence, which covers the causal masks of
+    mistral_inference and of the continuous batching engine.
+    """
+    if attn_bias is None:
+        return _attend(xq, key, val)
+    q_starts = attn_bias.q_seqinfo.seqstart_py
+    k_starts = attn_bias.k_seqinfo.seqstart_py
+    k_lengths = getattr(attn_bias.k_seqinfo, "seqlen_py", None) or [
+        end - start for start, end in zip(k_starts, k_starts[1:])
+    ]
+    outputs = [
+        _attend(
+            xq[:, q_start:q_end],
+            key[:, k_start : k_start + k_length],
+            val[:, k_start : k_start + k_length],
+            causal=True,
+        )
+        for q_start, q_end, k_start, k_length in zip(
+            q_starts, q_starts[1:], k_starts, k_lengths
+        )
+    ]
+    return torch.cat(outputs, dim=1)
+
+
+def _attend(q, k, v, causal=False):
+    q, k, v = (x.transpose(1, 2) for x in (q, k, v))
+    mask = None
+    if causal:
+        q_length, k_length = q.shape[-2], k.shape[-2]
+        mask = torch.ones(q_length, k_length, dtype=torch.bool, device=q.device).tril(
+            k_length - q_length
+        )
+    return F.scaled_dot_product_attention(q, k, v, attn_mask=mask).transpose(1, 2)
+
+
+def use_cpu_attention() -> None:
+    """Runs the attention of the mistral_inference transformer with `cpu_attention` for the tensors on CPU, and with xformers for the rest.
+
+    The attention is a global of mistral_inference, so it is replaced once for the whole process, but the evaluators on other devices keep
+    running xformers. A replacement of the attention installed before, e.g. by tests, is kept.
+    """
+    import mistral_inference.transformer
+    from xformers.ops import memory_efficient_attention
+
+    current = getattr(mistral_inference.transformer, "memory_efficient_attention", None)
+    if current is None:
+        raise ModelException(
+            "CPU inference is not supported by this version of mistral_inference, install mistral-inference<1.4"
+        )
+    if getattr(current, "_cpu_dispatch", False):
+        return
+    if current is not memory_efficient_attention:
+        logger.info("Keeping the replacement of the mistral_inference attention")
+        return
+
+    def attention(xq, key, val, attn_bias=None):
+        if xq.device.type == "cpu":
+            return cpu_attention(xq, key, val, attn_bias)
+        return memory_efficient_attention(xq, key, val, attn_bias)
+
+    attention._cpu_dispatch = True  # type: ignore[attr-defined]
+    mistral_inference.transformer.memory_efficient_attention = attention
+    logger.info(
+        "The mistral_inference attention runs in plain PyTorch for the tensors on CPU, in this process"
+    )
+
+
+def default_cpu_threads() -> int:
+    """The number of CPUs the process may run on, which unlike the default of torch accounts for CPU affinity, e.g. of containers pinned to some cores"""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def quantize_int8(model: Transformer) -> Transformer:
+    """Quantizes the weights of the linear layers of the model to int8 in place, activations are quantized dynamically and the rest of the model runs in float32.
+
+    The layers are converted one at a time, so the peak memory stays close to the size of the float16 model instead of its float32 copy.
+    """
+    for module in model.children():
+        if isinstance(module, torch.nn.ModuleDict):
+            for layer in module.values():
+                _quantize_module(layer)
+        else:
+            module.float()
+    # Swaps the linear layers that are direct children of the model, e.g. the output projection
+    _quantize_module(model)
+    logger.info("Linear layers quantized to int8")
+    return model
+
+
+def _quantize_module(module: torch.nn.Module) -> None:
+    module.float()
+    torch.ao.quantization.quantize_dynamic(
+        module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True
+    )
@@ -0,0 +1,514 @@
+import ipaddress
+import itertools
+import json
+import os
+import queue
+import socket
+import socketserver
+import tempfile
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple, Type, Union
+
+from pydantic import BaseModel
+
+from nuclia_eval import exceptions, logger
+from nuclia_eval.exceptions import ModelException
+from nuclia_eval.metrics.base import (
+    DiscreteScoreDistributionResponse,
+    DiscreteScoreReasonResponse,
+    DiscreteScoreResponse,
+    InvalidToolCallResponse,
+    ScoreReasonResult,
+    ScoreResult,
+)
+from nuclia_eval.models.base import RAGEvaluator
+from nuclia_eval.settings import Settings
+
+DEFAULT_ADDRESS = (
+    f"unix:{os.path.join(tempfile.gettempdir(), f'nuclia-eval-{os.getuid()}.sock')}"
+)
+
+# The methods of `RAGEvaluator` that can be called through the daemon, and `ready`, which is answered without waiting for the model
+METHODS = (
+    "evaluate_rag",
+    "evaluate_rag_batch",
+    "answer_relevance",
+    "context_relevance",
+    "groundedness",
+    "ready",
+)
+
+_RESPONSE_MODELS: Dict[str, Type[BaseModel]] = {
+    model.__name__: model
+    for model in (
+        DiscreteScoreResponse,
+        DiscreteScoreReasonResponse,
+        DiscreteScoreDistributionResponse,
+        InvalidToolCallResponse,
+    )
+}
+
+Address = Union[str, Tuple[str, int]]
+
+
+def parse_address(address: str) -> Tuple[int, Address]:
+    """The socket family and address of `unix:PATH`, `tcp://HOST:PORT` or `HOST:PORT`, with IPv6 hosts in brackets, e.g. `[::1]:PORT`"""
+    if address.startswith("unix:"):
+        return socket.AF_UNIX, address[len("unix:") :]
+    host, _, port = address.removeprefix("tcp://").rpartition(":")
+    family = socket.AF_INET
+    if host.startswith("[") and host.endswith("]"):
+        host = host[1:-1]
+        family = socket.AF_INET6
+    elif ":" in host:
+        # An IPv6 host without brackets, its last group would be taken for the port
+        host = ""
+    if not host or not port.isdigit():
+        raise ValueError(
+            f"Invalid address {address}, expected unix:PATH, tcp://HOST:PORT or HOST:PORT"
+        )
+    return family, (host, int(port))
+
+
+def is_loopback(host: str) -> bool:
+    """Whether a host only accepts connections from the same machine"""
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def _encode(value: Any) -> Any:
+    """Results as json, with the name of the response model of each one so the client rebuilds the same type"""
+    if isinstance(value, BaseModel):
+        return {"type": type(value).__name__, "value": value.model_dump()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(item) for item in value]
+    return value
+
+
+def _decode(value: Any) -> Any:
+    if isinstance(value, dict) and value.get("type") in _RESPONSE_MODELS:
+        return _RESPONSE_MODELS[value["type"]].model_validate(value["value"])
+    if isinstance(value, list):
+        return [_decode(item) for item in value]
+    return value
+
+
+def _dumps(message: Dict[str, Any]) -> bytes:
+    return (json.dumps(message, separators=(",", ":")) + "\n").encode("utf-8")
+
+
+class _Connection:
+    """The writing end of a client connection, shared by the connection handler and the worker"""
+
+    def __init__(self, wfile) -> None:
+        self._wfile = wfile
+        self._lock = threading.Lock()
+
+    def send(self, message: Dict[str, Any]) -> None:
+        try:
+            with self._lock:
+                self._wfile.write(_dumps(message))
+                self._wfile.flush()
+        except (OSError, ValueError):
+            # The client is gone, its pending results are dropped
+            pass
+
+    def reply(self, request_id: Any, result: Any) -> None:
+        self.send({"id": request_id, "result": _encode(result)})
+
+    def fail(self, request_id: Any, error: BaseException) -> None:
+        self.send(
+            {
+                "id": request_id,
+                "error": {"type": type(error).__name__, "message": str(error)},
+            }
+        )
+
+
+class _Request:
+    def __init__(
+        self,
+        connection: _Connection,
+        request_id: Any,
+        method: str,
+        params: Dict[str, Any],
+    ):
+        self.connection = connection
+        self.id = request_id
+        self.method = method
+        self.params = params
+
+    @property
+    def items(self) -> List[Tuple[str, str, List[str]]]:
+        """The RAG experiences of an `evaluate_rag` or `evaluate_rag_batch` request"""
+        if self.method == "evaluate_rag":
+            return [
+                (self.params["query"], self.params["answer"], self.params["contexts"])
+            ]
+        return [tuple(item) for item in self.params["items"]]  # type: ignore
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    server: "_UnixServer"
+
+    def handle(self) -> None:
+        evaluator_server: EvaluatorServer = self.server.evaluator_server
+        connection = _Connection(self.wfile)
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            request_id = None
+            try:
+                message = json.loads(line)
+                request_id = message.get("id")
+                method = message["method"]
+                if method not in METHODS:
+                    raise ValueError(f"Unknown method {method}")
+            except (ValueError, KeyError, AttributeError) as e:
+                connection.fail(request_id, ValueError(f"Invalid request: {e}"))
+                continue
+            if method == "ready":
+                connection.reply(request_id, evaluator_server.ready)
+            else:
+                evaluator_server.submit(
+                    _Request(
+                        connection, request_id, method, message.get("params") or {}
+                    )
+                )
+
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    evaluator_server: "EvaluatorServer"
+
+
+class _TCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    evaluator_server: "EvaluatorServer"
+
+
+class _TCP6Server(_TCPServer):
+    address_family = socket.AF_INET6
+
+
+class EvaluatorServer:
+    """Serves an evaluator loaded once to short-lived client processes, over a Unix domain socket or a TCP port, see `DaemonEvaluator`.
+
+    Requests and responses are json objects, one per line, matched by their `id`, so a client can pipeline many requests on a connection and
+    receive their results as they are ready. A request is `{"id": 1, "method": "evaluate_rag", "params": {"query": ..., "answer": ...,
+    "contexts": [...]}}`, with any method of `RAGEvaluator` and its arguments as params, and its response is `{"id": 1, "result": ...}`, or
+    `{"id": 1, "error": {"type": ..., "message": ...}}`. The `ready` method tells whether the model is loaded without waiting for it.
+
+    A single worker runs the evaluator, the `evaluate_rag` and `evaluate_rag_batch` requests waiting for it, of every connection, are evaluated
+    together with `evaluate_rag_batch`, up to `max_batch_requests` at a time, and a batch that fails is evaluated again one request at a time,
+    so an error only fails its own request. The Unix socket is only accessible to its owner, and is replaced if a previous server left it behind.
+    The protocol has no authentication, so the TCP port is only served on a loopback host unless `allow_remote` is set.
+
+    Args:
+        evaluator (RAGEvaluator): The evaluator of the requests
+        address (str, optional): `unix:PATH`, `tcp://HOST:PORT` or `HOST:PORT`. Defaults to a Unix socket of the user in the temporary directory.
+        max_batch_requests (int, optional): The most requests evaluated together. Defaults to 32.
+        allow_remote (bool, optional): Serve on hosts other machines can connect to, e.g. `0.0.0.0`. Defaults to False.
+    """
+
+    def __init__(
+        self,
+        evaluator: RAGEvaluator,
+        address: str = DEFAULT_ADDRESS,
+        max_batch_requests: int = 32,
+        allow_remote: bool = False,
+    ) -> None:
+        self.evaluator = evaluator
+        self.max_batch_requests = max_batch_requests
+        family, target = parse_address(address)
+        self._path: Optional[str] = None
+        self._server: Union[_UnixServer, _TCPServer]
+        if family == socket.AF_UNIX:
+            assert isinstance(target, str)
+            _remove_stale_socket(target)
+            self._server = _UnixServer(target, _Handler)
+            os.chmod(target, 0o600)
+            self._path = target
+        else:
+            assert isinstance(target, tuple)
+            if not allow_remote and not is_loopback(target[0]):
+                raise ValueError(
+                    f"Refusing to serve on {address}, which other machines can connect to, serve on a loopback host or allow remote clients"
+                )
+            server_type = _TCP6Server if family == socket.AF_INET6 else _TCPServer
+            self._server = server_type(target, _Handler)
+        self._server.evaluator_server = self
+        self._queue: "queue.Queue[Optional[_Request]]" = queue.Queue()
+        self._worker = threading.Thread(
+            target=self._run, name="nuclia-eval-daemon", daemon=True
+        )
+
+    @property
+    def address(self) -> str:
+        if self._path is not None:
+            return f"unix:{self._path}"
+        server_address = self._server.server_address
+        assert isinstance(server_address, tuple)
+        host, port = server_address[:2]
+        if isinstance(self._server, _TCP6Server):
+            return f"tcp://[{str(host)}]:{port}"
+        return f"tcp://{str(host)}:{port}"
+
+    @property
+    def ready(self) -> bool:
+        return getattr(self.evaluator, "ready", True)
+
+    def serve_forever(self) -> None:
+        """Accepts connections until `shutdown` is called"""
+        if not self._worker.is_alive():
+            self._worker.start()
+        self._server.serve_forever()
+
+    def shutdown(self) -> None:
+        """Stops `serve_forever` from another thread, the requests being evaluated are finished"""
+        self._server.shutdown()
+        self._queue.put(None)
+
+    def close(self) -> None:
+        self._server.server_close()
+        if self._path is not None:
+            try:
+                os.unlink(self._path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self) -> "EvaluatorServer":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self._queue.put(None)
+        self.close()
+
+    def submit(self, request: _Request) -> None:
+        self._queue.put(request)
+
+    def _run(self) -> None:
+        while True:
+            request = self._queue.get()
+            if request is None:
+                return
+            requests = [request]
+            # Everything that arrived while the previous requests were evaluated is evaluated together
+            while len(requests) < self.max_batch_requests:
+                try:
+                    request = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self._queue.put(None)
+                    break
+                requests.append(request)
+            rag_requests = [r for r in requests if r.method.startswith("evaluate_rag")]
+            if rag_requests:
+                self._evaluate_rag(rag_requests)
+            for request in requests:
+                if not request.method.startswith("evaluate_rag"):
+                    self._call(request)
+
+    def _evaluate_rag(self, requests: List[_Request]) -> None:
+        if len(requests) > 1:
+            try:
+                items = [item for request in requests for item in request.items]
+                results = self.evaluator.evaluate_rag_batch(items)
+            except Exception:
+                # Isolates the requests that fail
+                for request in requests:
+                    self._evaluate_rag([request])
+                return
+            start = 0
+            for request in requests:
+                end = start + len(request.items)
+                self._reply(request, results[start:end])
+                start = end
+            return
+        request = requests[0]
+        try:
+            results = self.evaluator.evaluate_rag_batch(request.items)
+        except Exception as e:
+            request.connection.fail(request.id, e)
+        else:
+            self._reply(request, results)
+
+    def _reply(self, request: _Request, results: List[Any]) -> None:
+        if request.method == "evaluate_rag":
+            request.connection.reply(request.id, results[0])
+        else:
+            request.connection.reply(request.id, results)
+
+    def _call(self, request: _Request) -> None:
+        try:
+            result = getattr(self.evaluator, request.method)(**request.params)
+        except Exception as e:
+            request.connection.fail(request.id, e)
+        else:
+            request.connection.reply(request.id, result)
+
+
+def _remove_stale_socket(path: str) -> None:
+    """Removes the socket of a server that is no longer running, e.g. one that was killed"""
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+        try:
+            probe.connect(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            logger.info(f"Removing the stale socket {path}")
+            os.unlink(path)
+            return
+    raise OSError(f"Another nuclia-eval daemon is already serving on {path}")
+
+
+class DaemonEvaluator(RAGEvaluator):
+    """Evaluator that sends the requests to a `nuclia-eval serve` daemon, which keeps the model loaded between processes, see `EvaluatorServer`.
+
+    The client is thread safe and pipelines the requests, the calls of several threads share the connection and `submit` sends a request
+    without waiting for the previous ones. It only imports the standard library and pydantic, so it is cheap to start.
+
+    Args:
+        address (str, optional): The address the daemon serves on. Defaults to its default Unix socket.
+        timeout (Optional[float], optional): The seconds to wait for each result. Defaults to None, waiting until it is ready.
+    """
+
+    def __init__(
+        self, address: str = DEFAULT_ADDRESS, timeout: Optional[float] = None
+    ) -> None:
+        family, target = parse_address(address)
+        self.address = address
+        self.timeout = timeout
+        self._socket = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            self._socket.connect(target)
+        except OSError as e:
+            self._socket.close()
+            raise ModelException(
+                f"Could not connect to the nuclia-eval daemon at {address}, start it with `nuclia-eval serve`: {e}"
+            ) from e
+        self._rfile = self._socket.makefile("rb")
+        self._send_lock = threading.Lock()
+        self._pending: Dict[int, Future] = {}
+        self._ids = itertools.count()
+        self._closed = False
+        self._reader = threading.Thread(
+            target=self._read, name="nuclia-eval-daemon-client", daemon=True
+        )
+        self._reader.start()
+
+    def close(self) -> None:
+        """Closes the connection, the results not received yet fail"""
+        self._closed = True
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._socket.close()
+        self._reader.join()
+
+    def __enter__(self) -> "DaemonEvaluator":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def submit(self, method: str, **params: Any) -> "Future[Any]":
+        """Sends a request without waiting for its result, e.g. `submit("evaluate_rag", query=..., answer=..., contexts=...)`.
+
+        Returns:
+            Future[Any]: The result of the method, as returned by the evaluator of the daemon
+        """
+        future: "Future[Any]" = Future()
+        with self._send_lock:
+            if self._closed:
+                raise ModelException(f"The connection to {self.address} is closed")
+            request_id = next(self._ids)
+            self._pending[request_id] = future
+            try:
+                self._socket.sendall(
+                    _dumps({"id": request_id, "method": method, "params": params})
+                )
+            except OSError as e:
+                del self._pending[request_id]
+                raise ModelException(f"Request to {self.address} failed: {e}") from e
+        return future
+
+    def is_ready(self) -> bool:
+        """Whether the model of the daemon is loaded"""
+        return self._call("ready")
+
+    def evaluate_rag(
+        self, query: str, answer: str, contexts: list[str]
+    ) -> Tuple[ScoreReasonResult, list[ScoreResult], list[ScoreResult]]:
+        return tuple(  # type: ignore
+            self._call("evaluate_rag", query=query, answer=answer, contexts=contexts)
+        )
+
+    def evaluate_rag_batch(
+        self, items: list[Tuple[str, str, list[str]]]
+    ) -> list[Tuple[ScoreReasonResult, list[ScoreResult], list[ScoreResult]]]:
+        results = self._call("evaluate_rag_batch", items=[list(item) for item in items])
+        return [tuple(result) for result in results]  # type: ignore
+
+    def answer_relevance(self, query: str, answer: str) -> ScoreReasonResult:
+        return self._call("answer_relevance", query=query, answer=answer)
+
+    def context_relevance(self, query: str, contexts: list[str]) -> list[ScoreResult]:
+        return self._call("context_relevance", query=query, contexts=contexts)
+
+    def groundedness(self, answer: str, contexts: list[str]) -> list[ScoreResult]:
+        return self._call("groundedness", answer=answer, contexts=contexts)
+
+    def _call(self, method: str, **params: Any) -> Any:
+        return self.submit(method, **params).result(self.timeout)
+
+    def _read(self) -> None:
+        try:
+            for line in self._rfile:
+                message = json.loads(line)
+                future = self._pending.pop(message.get("id"), None)
+                if future is None:
+                    continue
+                if "error" in message:
+                    future.set_exception(_error(message["error"]))
+                else:
+                    future.set_result(_decode(message["result"]))
+        except (OSError, ValueError):
+            pass
+        finally:
+            with self._send_lock:
+                self._closed = True
+                pending, self._pending = self._pending, {}
+            for future in pending.values():
+                future.set_exception(
+                    ModelException(f"The connection to {self.address} was closed")
+                )
+
+
+def _error(error: Dict[str, str]) -> Exception:
+    """The exception of an error response, of the same type if it is one of the exceptions of nuclia_eval"""
+    exception_type = getattr(exceptions, error.get("type", ""), None)
+    if isinstance(exception_type, type) and issubclass(exception_type, Exception):
+        return exception_type(error["message"])
+    return ModelException(f"{error.get('type')}: {error.get('message')}")
+
+
+def evaluator_from_settings(
+    settings: Optional[Settings] = None, device: str = "cuda"
+) -> RAGEvaluator:
+    """A `DaemonEvaluator` connected to the `daemon_address` of the settings when it is set, otherwise a `REMiEvaluator` loaded in process, so
+    the same code can use either by configuration"""
+    settings = settings or Settings()
+    if settings.daemon_address is not None:
+        return DaemonEvaluator(settings.daemon_address)
+    from nuclia_eval.models.remi import REMiEvaluator
+
+    return REMiEvaluator(settings=settings, device=device)
@@ -0,0 +1,392 @@
+import itertools
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+
+import torch
+from mistral_inference.cache import CacheInputMetadata
+from mistral_inference.transformer import Transformer
+from xformers.ops.fmha.attn_bias import (  # type: ignore
+    BlockDiagonalCausalFromBottomRightMask,
+    BlockDiagonalGappyKeysMask,
+)
+
+from nuclia_eval import logger
+from nuclia_eval.models.constraints import ToolCallConstraint
+from nuclia_eval.models.generation import KVState, PrefixCache
+
+
+class _SlotCacheView:
+    """The cache of one layer for the slots that take part in a forward pass, with the interface the attention layers expect"""
+
+    def __init__(
+        self,
+        cache_k: torch.Tensor,
+        cache_v: torch.Tensor,
+        metadata: CacheInputMetadata,
+        slots: List[int],
+        lengths: List[int],
+    ) -> None:
+        self.cache_k = cache_k
+        self.cache_v = cache_v
+        self.metadata = metadata
+        self.slots = slots
+        self.lengths = lengths
+        self._written = False
+
+    @property
+    def prefill(self) -> bool:
+        # The attention layers always take the keys and values from `interleave_kv`, which supports any mix of prompts and decoded tokens
+        return True
+
+    @property
+    def mask(self):
+        return self.metadata.mask
+
+    def update(self, xk: torch.Tensor, xv: torch.Tensor) -> None:
+        if self._written:
+            # Decode steps write them before attending, in `interleave_kv`
+            return
+        n_kv_heads, head_dim = self.cache_k.shape[-2:]
+        self.cache_k.view(-1, n_kv_heads, head_dim).index_copy_(
+            0, self.metadata.cache_positions, xk
+        )
+        self.cache_v.view(-1, n_kv_heads, head_dim).index_copy_(
+            0, self.metadata.cache_positions, xv
+        )
+
+    def interleave_kv(
+        self, xk: torch.Tensor, xv: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        if not self.metadata.prefill:
+            # Every sequence decodes a single token, its keys and values are attended in place in the slots from the first to the
+            # last selected one, the mask of the metadata skips the rest of them
+            self.update(xk, xv)
+            self._written = True
+            n_kv_heads, head_dim = self.cache_k.shape[-2:]
+            first, last = min(self.slots), max(self.slots)
+            return (
+                self.cache_k[first : last + 1].view(-1, n_kv_heads, head_dim),
+                self.cache_v[first : last + 1].view(-1, n_kv_heads, head_dim),
+            )
+        keys, values = [], []
+        for slot, length, k, v in zip(
+            self.slots,
+            self.lengths,
+            torch.split(xk, self.metadata.seqlens),
+            torch.split(xv, self.metadata.seqlens),
+        ):
+            keys.extend([self.cache_k[slot, :length], k])
+            values.extend([self.cache_v[slot, :length], v])
+        return torch.cat(keys), torch.cat(values)
+
+
+class SlotCache:
+    """KV cache with a fixed number of slots, each one holding the keys and values of a single sequence.
+
+    Unlike `mistral_inference.cache.BufferCache`, a forward pass can run on any subset of the slots, set with `select`,
+    and each slot can be at a different position, so sequences can join and leave the running batch at any step.
+    """
+
+    def __init__(
+        self,
+        n_layers: int,
+        n_slots: int,
+        max_seq_len: int,
+        n_kv_heads: int,
+        head_dim: int,
+    ) -> None:
+        self.max_seq_len = max_seq_len
+        self.cache_k = torch.empty(
+            (n_layers, n_slots, max_seq_len, n_kv_heads, head_dim)
+        )
+        self.cache_v = torch.empty(
+            (n_layers, n_slots, max_seq_len, n_kv_heads, head_dim)
+        )
+        self.lengths = [0] * n_slots
+        self._slots: List[int] = []
+
+    @property
+    def device(self) -> torch.device:
+        return self.cache_k.device
+
+    def to(self, device: torch.device, dtype: torch.dtype) -> "SlotCache":
+        self.cache_k = self.cache_k.to(device=device, dtype=dtype)
+        self.cache_v = self.cache_v.to(device=device, dtype=dtype)
+        return self
+
+    def select(self, slots: List[int]) -> None:
+        """Sets the slots of the next forward pass, in the same order as its sequences"""
+        self._slots = slots
+
+    def load(self, slot: int, state: KVState) -> None:
+        """Fills a slot with the KV state of a prefix"""
+        k, v = state
+        length = k.shape[1]
+        self.cache_k[:, slot, :length] = k
+        self.cache_v[:, slot, :length] = v
+        self.lengths[slot] = length
+
+    def free(self, slot: int) -> None:
+        self.lengths[slot] = 0
+
+    def get_input_metadata(self, seqlens: List[int]) -> CacheInputMetadata:
+        assert len(seqlens) == len(self._slots), "Select the slots before the forward"
+        lengths = [self.lengths[slot] for slot in self._slots]
+        positions = torch.cat(
+            [
+                torch.arange(length, length + seqlen)
+                for length, seqlen in zip(lengths, seqlens)
+            ]
+        ).to(device=self.device, dtype=torch.long)
+        slot_offsets = torch.tensor(
+            list(
+                itertools.chain.from_iterable(
+                    [slot] * seqlen for slot, seqlen in zip(self._slots, seqlens)
+                )
+            ),
+            device=self.device,
+            dtype=torch.long,
+        )
+        kv_seqlen = [length + seqlen for length, seqlen in zip(lengths, seqlens)]
+        # Steps that only decode attend over the cache in place, each sequence over its slot
+        decode = all(seqlen == 1 for seqlen in seqlens)
+        if decode:
+            first, last = min(self._slots), max(self._slots)
+            mask = BlockDiagonalGappyKeysMask.from_seqlens(
+                q_seqlen=seqlens,
+                kv_seqstarts=[(slot - first) * self.max_seq_len for slot in self._slots]
+                + [(last + 1 - first) * self.max_seq_len],
+                kv_seqlen=kv_seqlen,
+            )
+        else:
+            mask = BlockDiagonalCausalFromBottomRightMask.from_seqlens(
+                q_seqlen=seqlens, kv_seqlen=kv_seqlen
+            )
+        return CacheInputMetadata(
+            positions=positions,
+            cache_positions=positions + slot_offsets * self.max_seq_len,
+            prefill=not decode,
+            mask=mask,
+            seqlens=seqlens,
+        )
+
+    def get_view(self, layer_id: int, metadata: CacheInputMetadata) -> _SlotCacheView:
+        return _SlotCacheView(
+            self.cache_k[layer_id],
+            self.cache_v[layer_id],
+            metadata,
+            self._slots,
+            [self.lengths[slot] for slot in self._slots],
+        )
+
+    def update_seqlens(self, seqlens: List[int]) -> None:
+        for slot, seqlen in zip(self._slots, seqlens):
+            self.lengths[slot] += seqlen
+
+
+@dataclass
+class GenerationRequest:
+    """A prompt to decode greedily, with the same options as `nuclia_eval.models.generation.generate`.
+
+    `output` holds the generated tokens, without the EOS token, once `done` is set.
+    """
+
+    tokens: List[int]
+    max_tokens: int
+    eos_id: Optional[int] = None
+    constraint: Optional[ToolCallConstraint] = None
+    prefix_length: int = 0
+    output: List[int] = field(default_factory=list)
+    done: bool = False
+    error: Optional[Exception] = None
+
+
+@dataclass
+class EngineStats:
+    """Counters of a `GenerationEngine`, `queue_depth` and `running` are the number of requests waiting and being decoded"""
+
+    queue_depth: int = 0
+    running: int = 0
+    finished: int = 0
+    steps: int = 0
+    prompt_tokens: int = 0
+    generated_tokens: int = 0
+    busy_seconds: float = 0.0
+
+    @property
+    def tokens_per_second(self) -> float:
+        """Prompt and generated tokens processed per second of forward passes"""
+        if self.busy_seconds == 0:
+            return 0.0
+        return (self.prompt_tokens + self.generated_tokens) / self.busy_seconds
+
+
+class GenerationEngine:
+    """Continuous batching engine, a new request joins the running batch as soon as a slot is free instead of waiting for the whole batch to finish.
+
+    Each step runs a single forward pass over every running sequence, the prompts of the requests admitted in that step and the last token of the
+    sequences already decoding, so short generations are not held back by long ones. Requests whose prompt and `max_tokens` do not fit in a slot are rejected on `submit`.
+
+    Args:
+        model (Transformer): The model used to decode the requests
+        max_batch_size (int): Number of slots, at most `model.args.max_batch_size`
+        max_seq_len (int): Maximum number of prompt and generated tokens of a request
+        prefix_cache (Optional[PrefixCache], optional): Cache with the KV states of shared prompt prefixes, used for requests with a `prefix_length`. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        model: Transformer,
+        *,
+        max_batch_size: int,
+        max_seq_len: int,
+        prefix_cache: Optional[PrefixCache] = None,
+    ) -> None:
+        self.model = model
+        self.max_batch_size = min(max_batch_size, model.args.max_batch_size)
+        self.max_seq_len = max_seq_len
+        self.prefix_cache = prefix_cache
+        self.stats = EngineStats()
+        self._waiting: Deque[GenerationRequest] = deque()
+        self._running: Dict[int, GenerationRequest] = {}
+        # Tokens each running slot feeds to the next forward pass
+        self._pending: Dict[int, List[int]] = {}
+        self._cache: Optional[SlotCache] = None
+
+    def submit(self, request: GenerationRequest) -> GenerationRequest:
+        if not self.fits(request.tokens, request.max_tokens):
+            raise ValueError(
+                f"Request with {len(request.tokens)} prompt tokens and {request.max_tokens} max tokens does not fit in {self.max_seq_len} tokens"
+            )
+        if not request.tokens:
+            raise ValueError("Empty prompt")
+        self._waiting.append(request)
+        self.stats.queue_depth = len(self._waiting)
+        return request
+
+    def fits(self, tokens: Sequence[int], max_tokens: int) -> bool:
+        """Whether a request with this prompt and `max_tokens` fits in a slot"""
+        return len(tokens) + max_tokens <= self.max_seq_len
+
+    def has_work(self) -> bool:
+        return bool(self._waiting or self._running)
+
+    def run(self, requests: List[GenerationRequest]) -> List[GenerationRequest]:
+        """Submits the requests and steps the engine until all of them are done"""
+        for request in requests:
+            self.submit(request)
+        while not all(request.done for request in requests):
+            self.step()
+        return requests
+
+    @torch.inference_mode()
+    def step(self) -> List[GenerationRequest]:
+        """Admits waiting requests into the free slots and decodes one token for every running request, returning the requests finished in this step"""
+        self._admit()
+        if not self._running:
+            return []
+        start = time.perf_counter()
+        cache = self._get_cache()
+        slots = list(self._running)
+        inputs = [self._pending[slot] for slot in slots]
+        cache.select(slots)
+        prelogits = self.model.forward(
+            torch.tensor(
+                list(itertools.chain.from_iterable(inputs)),
+                device=self.model.device,
+                dtype=torch.long,
+            ),
+            seqlens=[len(tokens) for tokens in inputs],
+            cache=cache,  # type: ignore
+        )
+        last_token_prelogits = prelogits.index_select(
+            0,
+            torch.tensor([len(tokens) for tokens in inputs], device=prelogits.device)
+            .cumsum(dim=0)
+            .sub(1),
+        )
+        finished = []
+        for slot, logits in zip(slots, last_token_prelogits):
+            request = self._running[slot]
+            try:
+                token = (
+                    request.constraint.next_token(logits)
+                    if request.constraint is not None
+                    else int(torch.argmax(logits))
+                )
+            except Exception as e:
+                request.error = e
+                self._finish(slot)
+                finished.append(request)
+                continue
+            if token is None or token == request.eos_id:
+                self._finish(slot)
+                finished.append(request)
+                continue
+            request.output.append(token)
+            self.stats.generated_tokens += 1
+            if (
+                len(request.output) >= request.max_tokens
+                or request.constraint is not None
+                and request.constraint.done
+            ):
+                self._finish(slot)
+                finished.append(request)
+            else:
+                self._pending[slot] = [token]
+        self.stats.steps += 1
+        self.stats.busy_seconds += time.perf_counter() - start
+        self.stats.running = len(self._running)
+        return finished
+
+    def _admit(self) -> None:
+        free_slots = [
+            slot for slot in range(self.max_batch_size) if slot not in self._running
+        ]
+        while self._waiting and free_slots:
+            request = self._waiting.popleft()
+            if request.max_tokens == 0:
+                request.done = True
+                self.stats.finished += 1
+                continue
+            slot = free_slots.pop(0)
+            cache = self._get_cache()
+            cache.free(slot)
+            # At least the last prompt token must go through the model to get its logits
+            prefix_length = min(request.prefix_length, len(request.tokens) - 1)
+            if self.prefix_cache is not None and prefix_length > 0:
+                cache.load(
+                    slot,
+                    self.prefix_cache.prefill(
+                        self.model, request.tokens[:prefix_length]
+                    ),
+                )
+            else:
+                prefix_length = 0
+            self._running[slot] = request
+            self._pending[slot] = request.tokens[prefix_length:]
+            self.stats.prompt_tokens += len(self._pending[slot])
+        self.stats.queue_depth = len(self._waiting)
+        self.stats.running = len(self._running)
+
+    def _finish(self, slot: int) -> None:
+        request = self._running.pop(slot)
+        self._pending.pop(slot)
+        request.done = True
+        self.stats.finished += 1
+        logger.debug(
+            f"Request finished in slot {slot} with {len(request.output)} tokens"
+        )
+
+    def _get_cache(self) -> SlotCache:
+        if self._cache is None:
+            self._cache = SlotCache(
+                self.model.n_local_layers,
+                self.max_batch_size,
+                self.max_seq_len,
+                self.model.args.n_kv_heads,
+                self.model.args.head_dim,
+            ).to(device=self.model.device, dtype=self.model.dtype)
+        return self._cache
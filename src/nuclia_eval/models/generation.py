@@ -0,0 +1,299 @@
+import itertools
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+from mistral_inference.cache import BufferCache
+from mistral_inference.transformer import Transformer
+
+from nuclia_eval import logger
+from nuclia_eval.models.constraints import ToolCallConstraint
+
+KVState = Tuple[torch.Tensor, torch.Tensor]
+
+
+class PrefixCache:
+    """LRU cache of the KV states of prompt prefixes, bounded by a memory budget.
+
+    Each entry holds the keys and values of every layer for a prefix of tokens, with shape
+    `(n_layers, prefix_length, n_kv_heads, head_dim)`. Prefixes are prefilled once and reused by every
+    prompt that starts with them, so only the rest of the prompt has to go through the model.
+    """
+
+    def __init__(self, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries: OrderedDict[Tuple[int, ...], KVState] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, prefix: Sequence[int]) -> bool:
+        return tuple(prefix) in self._entries
+
+    def longest_prefix(self, tokens: Sequence[int]) -> Tuple[int, Optional[KVState]]:
+        """Returns the longest cached prefix of `tokens` as a tuple of its length and KV state"""
+        best_key: Tuple[int, ...] = ()
+        for key in self._entries:
+            if (
+                len(best_key) < len(key) <= len(tokens)
+                and tuple(tokens[: len(key)]) == key
+            ):
+                best_key = key
+        if not best_key:
+            return 0, None
+        self._entries.move_to_end(best_key)
+        return len(best_key), self._entries[best_key]
+
+    def put(self, prefix: Sequence[int], state: KVState) -> None:
+        """Stores the KV state of a prefix, evicting the least recently used prefixes to stay within budget"""
+        key = tuple(prefix)
+        size = sum(t.numel() * t.element_size() for t in state)
+        if size > self.max_bytes:
+            logger.debug(
+                f"Prefix of {len(key)} tokens needs {size} bytes, which exceeds the prefix cache budget"
+            )
+            return
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        while self._entries and self.nbytes + size > self.max_bytes:
+            _, (k, v) = self._entries.popitem(last=False)
+            self.nbytes -= k.numel() * k.element_size() + v.numel() * v.element_size()
+        self._entries[key] = state
+        self.nbytes += size
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.nbytes = 0
+
+    @torch.inference_mode()
+    def prefill(self, model: Transformer, prefix: Sequence[int]) -> KVState:
+        """Returns the KV state for `prefix`, prefilling only the tokens that are not already cached"""
+        cached_length, state = self.longest_prefix(prefix)
+        if state is not None and cached_length == len(prefix):
+            return state
+        cache = _new_cache(model, 1, len(prefix))
+        cache.init_kvseqlens(1)
+        if state is not None:
+            _copy_state(cache, state, 1)
+        model.forward(
+            torch.tensor(prefix[cached_length:], device=model.device, dtype=torch.long),
+            seqlens=[len(prefix) - cached_length],
+            cache=cache,
+        )
+        state = (
+            cache.cache_k[:, 0, : len(prefix)].clone(),
+            cache.cache_v[:, 0, : len(prefix)].clone(),
+        )
+        self.put(prefix, state)
+        return state
+
+
+def common_prefix_length(sequences: Sequence[Sequence[int]]) -> int:
+    """Returns the length of the longest prefix shared by all the sequences"""
+    if not sequences:
+        return 0
+    first = sequences[0]
+    length = min(len(s) for s in sequences)
+    for i in range(length):
+        if any(s[i] != first[i] for s in sequences[1:]):
+            return i
+    return length
+
+
+def _new_cache(model: Transformer, batch_size: int, max_seq_len: int) -> BufferCache:
+    cache = BufferCache(
+        model.n_local_layers,
+        batch_size,
+        max_seq_len,
+        model.args.n_kv_heads,
+        model.args.head_dim,
+    )
+    cache.to(device=model.device, dtype=model.dtype)
+    cache.reset()
+    return cache
+
+
+def _copy_state(cache: BufferCache, state: KVState, batch_size: int) -> None:
+    """Copies a prefix KV state into the first rows of a cache and marks it as already processed"""
+    k, v = state
+    prefix_length = k.shape[1]
+    cache.cache_k[:, :batch_size, :prefix_length] = k[:, None]
+    cache.cache_v[:, :batch_size, :prefix_length] = v[:, None]
+    assert cache.kv_seqlens is not None
+    cache.kv_seqlens.fill_(prefix_length)
+
+
+def _prefill(
+    encoded_prompts: List[List[int]],
+    model: Transformer,
+    *,
+    max_tokens: int,
+    prefix_cache: Optional[PrefixCache],
+    prefix_length: int,
+) -> Tuple[BufferCache, torch.Tensor]:
+    """Runs all the prompts through the model in a single forward pass, serving their shared prefix from the `prefix_cache`.
+
+    Returns the KV cache, with room for `max_tokens` more tokens per prompt, and the prelogits of the last token of each prompt.
+    """
+    batch_size = len(encoded_prompts)
+    seqlens = [len(prompt) for prompt in encoded_prompts]
+    cache = _new_cache(model, batch_size, max(seqlens) + max_tokens)
+    # At least the last token of each prompt must go through the model to get its logits
+    prefix_length = min(
+        prefix_length, common_prefix_length(encoded_prompts), min(seqlens) - 1
+    )
+    if prefix_cache is not None and prefix_length > 0:
+        state = prefix_cache.prefill(model, encoded_prompts[0][:prefix_length])
+        cache.init_kvseqlens(batch_size)
+        _copy_state(cache, state, batch_size)
+        encoded_prompts = [prompt[prefix_length:] for prompt in encoded_prompts]
+        seqlens = [seqlen - prefix_length for seqlen in seqlens]
+
+    prelogits = model.forward(
+        torch.tensor(
+            list(itertools.chain.from_iterable(encoded_prompts)),
+            device=model.device,
+            dtype=torch.long,
+        ),
+        seqlens=seqlens,
+        cache=cache,
+    )
+    last_token_prelogits = prelogits.index_select(
+        0, torch.tensor(seqlens, device=prelogits.device).cumsum(dim=0) - 1
+    )
+    return cache, last_token_prelogits
+
+
+@torch.inference_mode()
+def generate(
+    encoded_prompts: List[List[int]],
+    model: Transformer,
+    *,
+    max_tokens: int,
+    eos_id: Optional[int] = None,
+    prefix_cache: Optional[PrefixCache] = None,
+    prefix_length: int = 0,
+    constraints: Optional[List[ToolCallConstraint]] = None,
+    timings: Optional[Dict[str, float]] = None,
+) -> List[List[int]]:
+    """Greedily decodes a batch of prompts sharing a single KV cache.
+
+    Unlike `mistral_inference.generate.generate`, each sequence stops at its own EOS token, and the
+    returned tokens exclude the EOS token and anything decoded after it, so the output of a sequence
+    does not depend on the other sequences it was batched with.
+
+    Args:
+        encoded_prompts (List[List[int]]): The tokenized prompts, at most `model.args.max_batch_size` of them
+        model (Transformer): The model used to decode the prompts
+        max_tokens (int): The maximum number of tokens generated for each prompt
+        eos_id (Optional[int], optional): The token that ends a sequence. Defaults to None.
+        prefix_cache (Optional[PrefixCache], optional): Cache with the KV states of shared prompt prefixes. Defaults to None.
+        prefix_length (int, optional): How many leading tokens, shared by all the prompts, are served from the `prefix_cache`. Defaults to 0.
+        constraints (Optional[List[ToolCallConstraint]], optional): One constraint per prompt, restricting the tokens it can generate. A constrained sequence stops as soon as its constraint is done. Defaults to None.
+        timings (Optional[Dict[str, float]], optional): When given, the seconds spent prefilling and decoding are added to its `prefill` and `decode` entries, waiting for the device so they are accurate. Defaults to None.
+
+    Returns:
+        List[List[int]]: The generated tokens for each prompt, in the same order as the prompts
+    """
+    if not encoded_prompts:
+        return []
+    model = model.eval()
+    batch_size = len(encoded_prompts)
+    start = time.perf_counter()
+    cache, last_token_prelogits = _prefill(
+        encoded_prompts,
+        model,
+        max_tokens=max_tokens,
+        prefix_cache=prefix_cache,
+        prefix_length=prefix_length,
+    )
+    if timings is not None:
+        _synchronize(last_token_prelogits.device)
+        prefill_end = time.perf_counter()
+        timings["prefill"] = timings.get("prefill", 0.0) + prefill_end - start
+
+    generated_tokens: List[List[int]] = [[] for _ in range(batch_size)]
+    is_finished = [False] * batch_size
+    for _ in range(max_tokens):
+        tokens: List[Optional[int]]
+        if constraints is None:
+            next_token = torch.argmax(last_token_prelogits, dim=-1)
+            tokens = next_token.tolist()
+        else:
+            # A constrained sequence that can not be continued stops, without failing the rest of the batch
+            tokens = [
+                constraint.next_token(logits) if not finished else None
+                for constraint, logits, finished in zip(
+                    constraints, last_token_prelogits, is_finished
+                )
+            ]
+            next_token = torch.tensor(
+                [0 if token is None else token for token in tokens],
+                device=last_token_prelogits.device,
+            )
+        for i, token in enumerate(tokens):
+            if is_finished[i]:
+                continue
+            if token is None or token == eos_id:
+                is_finished[i] = True
+            else:
+                generated_tokens[i].append(token)
+                if constraints is not None and constraints[i].done:
+                    is_finished[i] = True
+        if all(is_finished):
+            break
+        # Finished sequences keep being fed to the model to keep the batch aligned,
+        # their outputs are discarded.
+        last_token_prelogits = model.forward(
+            next_token, seqlens=[1] * batch_size, cache=cache
+        )
+
+    if timings is not None:
+        _synchronize(last_token_prelogits.device)
+        timings["decode"] = (
+            timings.get("decode", 0.0) + time.perf_counter() - prefill_end
+        )
+    return generated_tokens
+
+
+def _synchronize(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+
+
+@torch.inference_mode()
+def score(
+    encoded_prompts: List[List[int]],
+    model: Transformer,
+    *,
+    candidate_tokens: List[int],
+    prefix_cache: Optional[PrefixCache] = None,
+    prefix_length: int = 0,
+) -> torch.Tensor:
+    """Computes, in a single forward pass, the distribution of the token that follows each prompt, restricted to the candidate tokens.
+
+    Args:
+        encoded_prompts (List[List[int]]): The tokenized prompts, at most `model.args.max_batch_size` of them
+        model (Transformer): The model used to score the prompts
+        candidate_tokens (List[int]): The tokens the distribution is computed over
+        prefix_cache (Optional[PrefixCache], optional): Cache with the KV states of shared prompt prefixes. Defaults to None.
+        prefix_length (int, optional): How many leading tokens, shared by all the prompts, are served from the `prefix_cache`. Defaults to 0.
+
+    Returns:
+        torch.Tensor: The probability of each candidate token, with shape `(len(encoded_prompts), len(candidate_tokens))`
+    """
+    if not encoded_prompts:
+        return torch.empty((0, len(candidate_tokens)))
+    model = model.eval()
+    _, last_token_prelogits = _prefill(
+        encoded_prompts,
+        model,
+        max_tokens=0,
+        prefix_cache=prefix_cache,
+        prefix_length=prefix_length,
+    )
+    candidates = torch.tensor(candidate_tokens, device=last_token_prelogits.device)
+    return torch.softmax(last_token_prelogits[:, candidates].float(), dim=-1).cpu()
@@ -0,0 +1,214 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Optional, Tuple, cast
+
+from pydantic import BaseModel
+
+from nuclia_eval.exceptions import InvalidToolCallException, ModelException
+from nuclia_eval.metrics import AnswerRelevance, ContextRelevance, Groundedness
+from nuclia_eval.metrics.base import (
+    Metric,
+    ScoreReasonResult,
+    ScoreResult,
+)
+from nuclia_eval.models.base import RAGEvaluator
+from nuclia_eval.models.tool_calls import (
+    SYSTEM_PROMPT,
+    parse_tool_calls,
+    parse_tool_calls_text,
+)
+
+# Statuses of the responses that are retried, the server is overloaded or restarting
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class HTTPEvaluator(RAGEvaluator):
+    """Evaluator that calls a REMi model served by an OpenAI compatible inference server, e.g. vLLM, instead of loading it in process.
+
+    It sends the same prompts and tool as `REMiEvaluator` as tool call chat completions, and validates the tool calls in the responses the same way.
+    The prompts of a call, e.g. one per context, are sent concurrently, up to `max_concurrency` at a time, over a pool of keep-alive connections.
+    Connection errors and the responses with a status in `RETRY_STATUSES` are retried with exponential backoff. It requires `requests`.
+
+    Args:
+        base_url (str): The base URL of the OpenAI compatible API, e.g. `http://localhost:8000/v1`
+        model (str, optional): The name of the model in the server. Defaults to "nuclia/REMi-v0".
+        api_key (Optional[str], optional): Sent as a bearer token when set. Defaults to None.
+        max_concurrency (int, optional): The maximum number of requests in flight, and of pooled connections. Defaults to 8.
+        max_retries (int, optional): How many times a failed request is retried. Defaults to 3.
+        backoff_factor (float, optional): The retries wait `backoff_factor * 2 ** (retry - 1)` seconds, or what the server asks in its `Retry-After` header. Defaults to 0.5.
+        timeout (float, optional): The seconds to wait for the server to connect and for each response. Defaults to 60.
+        max_tokens (int, optional): The maximum number of tokens of the tool calls. Defaults to 512.
+    """
+
+    def __init__(
+        self,
+        base_url: str,
+        model: str = "nuclia/REMi-v0",
+        *,
+        api_key: Optional[str] = None,
+        max_concurrency: int = 8,
+        max_retries: int = 3,
+        backoff_factor: float = 0.5,
+        timeout: float = 60.0,
+        max_tokens: int = 512,
+    ) -> None:
+        try:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+        except ImportError as e:  # pragma: no cover
+            raise ImportError(
+                "The HTTP evaluator requires requests, install it with `pip install requests`"
+            ) from e
+        if max_concurrency < 1:
+            raise ValueError("max_concurrency must be at least 1")
+        self.url = base_url.rstrip("/") + "/chat/completions"
+        self.model = model
+        self.timeout = timeout
+        self.max_tokens = max_tokens
+        self._request_exception = requests.RequestException
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_concurrency,
+            max_retries=Retry(
+                total=max_retries,
+                backoff_factor=backoff_factor,
+                status_forcelist=RETRY_STATUSES,
+                allowed_methods=frozenset({"POST"}),
+                raise_on_status=False,
+            ),
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        if api_key is not None:
+            self._session.headers["Authorization"] = f"Bearer {api_key}"
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="nuclia-eval-http"
+        )
+
+    def close(self) -> None:
+        """Waits for the requests in flight and closes the connections"""
+        self._executor.shutdown(wait=True)
+        self._session.close()
+
+    def __enter__(self) -> "HTTPEvaluator":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def evaluate_rag(
+        self, query: str, answer: str, contexts: list[str]
+    ) -> Tuple[ScoreReasonResult, list[ScoreResult], list[ScoreResult]]:
+        return self.evaluate_rag_batch([(query, answer, contexts)])[0]
+
+    def evaluate_rag_batch(
+        self, items: list[Tuple[str, str, list[str]]]
+    ) -> list[Tuple[ScoreReasonResult, list[ScoreResult], list[ScoreResult]]]:
+        # Every prompt of every item is in flight before waiting for any of them
+        futures = [
+            (
+                self._submit(AnswerRelevance, {"query": query, "answer": answer}),
+                [
+                    self._submit(ContextRelevance, {"query": query, "context": context})
+                    for context in contexts
+                ],
+                [
+                    self._submit(Groundedness, {"answer": answer, "context": context})
+                    for context in contexts
+                ],
+            )
+            for query, answer, contexts in items
+        ]
+        return [
+            (
+                cast(ScoreReasonResult, answer_relevance.result()),
+                cast(
+                    list[ScoreResult],
+                    [future.result() for future in context_relevances],
+                ),
+                cast(
+                    list[ScoreResult],
+                    [future.result() for future in groundednesses],
+                ),
+            )
+            for answer_relevance, context_relevances, groundednesses in futures
+        ]
+
+    def answer_relevance(self, query: str, answer: str) -> ScoreReasonResult:
+        return cast(
+            ScoreReasonResult,
+            self._submit(AnswerRelevance, {"query": query, "answer": answer}).result(),
+        )
+
+    def groundedness(self, answer: str, contexts: list[str]) -> list[ScoreResult]:
+        return cast(
+            list[ScoreResult],
+            self._evaluate(
+                Groundedness,
+                [{"answer": answer, "context": context} for context in contexts],
+            ),
+        )
+
+    def context_relevance(self, query: str, contexts: list[str]) -> list[ScoreResult]:
+        return cast(
+            list[ScoreResult],
+            self._evaluate(
+                ContextRelevance,
+                [{"query": query, "context": context} for context in contexts],
+            ),
+        )
+
+    def _evaluate(
+        self, metric: Metric, inputs: list[dict[str, str]]
+    ) -> list[BaseModel]:
+        """Computes a metric for each set of template fields, in the same order"""
+        futures = [self._submit(metric, fields) for fields in inputs]
+        return [future.result() for future in futures]
+
+    def _submit(self, metric: Metric, fields: dict[str, str]) -> "Future[BaseModel]":
+        return self._executor.submit(self._request, metric, fields)
+
+    def _request(self, metric: Metric, fields: dict[str, str]) -> BaseModel:
+        """Sends the prompt of a metric and validates the tool call of the response"""
+        body = {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": SYSTEM_PROMPT},
+                {"role": "user", "content": metric.template.format(**fields)},
+            ],
+            "tools": [metric.tool],
+            "tool_choice": "required",
+            "temperature": 0.0,
+            "max_tokens": self.max_tokens,
+        }
+        try:
+            response = self._session.post(self.url, json=body, timeout=self.timeout)
+        except self._request_exception as e:
+            raise ModelException(f"Request to {self.url} failed: {e}") from e
+        if response.status_code >= 400:
+            raise ModelException(
+                f"Request to {self.url} failed with status {response.status_code}: {response.text[:200]}"
+            )
+        return self._parse_response(
+            response.json(), metric.response_model, metric.tool["function"]["name"]
+        )
+
+    def _parse_response(
+        self, data: Any, target_model: type[BaseModel], desired_tool_name: str
+    ) -> BaseModel:
+        """Validates the tool call of a chat completion, from its `tool_calls` or, for servers that do not parse them, from its content"""
+        try:
+            message = data["choices"][0]["message"]
+        except (TypeError, KeyError, IndexError):
+            raise InvalidToolCallException("No output generated")
+        if message.get("tool_calls"):
+            return parse_tool_calls(
+                [call.get("function") for call in message["tool_calls"]],
+                target_model,
+                desired_tool_name,
+            )
+        content = (message.get("content") or "").strip()
+        return parse_tool_calls_text(
+            content.removeprefix("[TOOL_CALLS]"), target_model, desired_tool_name
+        )
@@ -0,0 +1,255 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Literal, Optional, Tuple
+
+from filelock import FileLock, Timeout
+from huggingface_hub import constants, snapshot_download
+
+from nuclia_eval import logger
+from nuclia_eval.exceptions import ModelCacheException
+
+# Written in a model directory once all its files are downloaded and verified, a directory without it is never used
+MANIFEST_NAME = ".nuclia-manifest.json"
+MANIFEST_VERSION = 1
+
+_SHA256 = re.compile(r"[0-9a-f]{64}")
+_HASH_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+@dataclass(frozen=True)
+class ModelSpec:
+    """A model repository and where it is stored in the model cache, `files` are the files it must have, which are verified"""
+
+    repo_id: str
+    directory: str
+    files: Tuple[str, ...]
+    allow_patterns: Optional[Tuple[str, ...]] = None
+
+
+BASE_MODEL = ModelSpec(
+    repo_id="mistralai/Mistral-7B-Instruct-v0.3",
+    directory="Mistral-7B-Instruct-v0.3",
+    files=("params.json", "consolidated.safetensors", "tokenizer.model.v3"),
+    allow_patterns=("params.json", "consolidated.safetensors", "tokenizer.model.v3"),
+)
+ADAPTER_MODEL = ModelSpec(
+    repo_id="nuclia/REMi-v0", directory="REMi-v0", files=("lora.safetensors",)
+)
+
+
+class ModelCache:
+    """Downloads models to a cache directory that many processes can share, e.g. the workers of a fleet starting at once on the same volume.
+
+    A model is downloaded to a temporary directory next to its final location, its files are checked against the checksums of the hub and
+    listed with their size and checksum in a manifest, and the directory is then renamed into place, so a model directory is either complete
+    or absent. Downloads are serialized with a file lock per model, the processes that wait for it use the model the first one published.
+    Models already in the cache are verified against their manifest, by the size of their files or, with `verify="checksum"`, by rehashing
+    them, and downloaded again if they do not match. In `offline` mode, or when `HF_HUB_OFFLINE` is set, a missing or invalid model raises a
+    `ModelCacheException` right away instead of downloading it.
+
+    Args:
+        root (str): The model cache directory
+        offline (bool, optional): Never download, only use the models already in the cache. Defaults to False.
+        verify (Literal["size", "checksum"], optional): How the models in the cache are verified. Defaults to "size".
+    """
+
+    def __init__(
+        self,
+        root: str,
+        offline: bool = False,
+        verify: Literal["size", "checksum"] = "size",
+    ) -> None:
+        self.root = Path(root)
+        self.offline = offline or bool(constants.HF_HUB_OFFLINE)
+        self.verify = verify
+
+    def path(self, spec: ModelSpec) -> Path:
+        return self.root / spec.directory
+
+    def ensure(
+        self, specs: List[ModelSpec], force_download: bool = False
+    ) -> List[Path]:
+        """Returns the directory of each model, downloading in parallel the ones missing from the cache or that do not match their manifest
+
+        Raises:
+            ModelCacheException: If a model must be downloaded in offline mode, or its download is not complete or does not match the hub checksums
+        """
+        missing = [spec for spec in specs if force_download or not self._is_valid(spec)]
+        if missing and self.offline:
+            raise ModelCacheException(
+                f"{', '.join(spec.repo_id for spec in missing)} not found in the model cache at {self.root} and downloads are disabled by the offline mode"
+            )
+        for spec in specs:
+            if spec not in missing:
+                logger.info(
+                    f"{spec.repo_id} already exists at {self.path(spec)}, skipping download"
+                )
+        if len(missing) > 1:
+            with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+                list(
+                    executor.map(
+                        lambda spec: self._download(spec, force_download), missing
+                    )
+                )
+        elif missing:
+            self._download(missing[0], force_download)
+        return [self.path(spec) for spec in specs]
+
+    def _download(self, spec: ModelSpec, force_download: bool) -> None:
+        path = self.path(spec)
+        with self._lock(spec):
+            # Another process may have published the model while this one waited for the lock
+            if not force_download and self._is_valid(spec, locked=True):
+                logger.info(f"{spec.repo_id} was downloaded by another process")
+                return
+            # Leftovers of downloads interrupted by a crash, no other process is downloading the model
+            for leftover in self.root.glob(f".{spec.directory}.*"):
+                shutil.rmtree(leftover, ignore_errors=True)
+            logger.info(
+                f"Downloading {spec.repo_id} to {path}, to override this behavior, please provide the path in the settings or as an environment variable `NUCLIA_MODEL_CACHE`"
+            )
+            start = time.perf_counter()
+            tmp_path = Path(
+                tempfile.mkdtemp(prefix=f".{spec.directory}.", dir=self.root)
+            )
+            try:
+                snapshot_download(
+                    repo_id=spec.repo_id,
+                    allow_patterns=list(spec.allow_patterns)
+                    if spec.allow_patterns is not None
+                    else None,
+                    local_dir=tmp_path,
+                )
+                self._write_manifest(spec, tmp_path, self._hash_files(spec, tmp_path))
+                self._publish(tmp_path, path)
+            finally:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+            logger.info(
+                f"{spec.repo_id} downloaded successfully in {time.perf_counter() - start:.2f}s"
+            )
+
+    def _hash_files(self, spec: ModelSpec, path: Path) -> Dict[str, Dict[str, Any]]:
+        """Size and sha256 of the files of a download, checked against the checksums the hub reported for them"""
+        files = {}
+        for name in spec.files:
+            file_path = path / name
+            if not file_path.is_file():
+                raise ModelCacheException(
+                    f"The download of {spec.repo_id} is incomplete, {name} is missing"
+                )
+            sha256 = _sha256(file_path)
+            expected = _hub_sha256(path, name)
+            if expected is not None and expected != sha256:
+                raise ModelCacheException(
+                    f"The checksum of {name} of {spec.repo_id} is {sha256}, but the hub reported {expected}"
+                )
+            files[name] = {"size": file_path.stat().st_size, "sha256": sha256}
+        return files
+
+    def _write_manifest(
+        self, spec: ModelSpec, path: Path, files: Dict[str, Dict[str, Any]]
+    ) -> None:
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "repo_id": spec.repo_id,
+            "files": files,
+        }
+        fd, tmp_path = tempfile.mkstemp(dir=path, prefix=MANIFEST_NAME, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp_path, path / MANIFEST_NAME)
+
+    def _publish(self, tmp_path: Path, path: Path) -> None:
+        """Renames the downloaded directory into place, a previous version is moved aside first and removed afterwards"""
+        stale = None
+        if path.exists():
+            stale = Path(tempfile.mkdtemp(prefix=f".{path.name}.stale.", dir=self.root))
+            os.replace(path, stale / path.name)
+        os.replace(tmp_path, path)
+        if stale is not None:
+            shutil.rmtree(stale, ignore_errors=True)
+
+    def _is_valid(self, spec: ModelSpec, locked: bool = False) -> bool:
+        """Whether the model is in the cache and matches its manifest, `locked` if the caller holds the lock of the model"""
+        path = self.path(spec)
+        try:
+            manifest = json.loads((path / MANIFEST_NAME).read_text())
+        except FileNotFoundError:
+            return self._adopt(spec, locked)
+        except ValueError:
+            logger.warning(f"The manifest of {path} is corrupted")
+            return False
+        for name in spec.files:
+            expected = manifest["files"].get(name)
+            file_path = path / name
+            if expected is None or not file_path.is_file():
+                logger.warning(f"{file_path} is missing")
+                return False
+            if file_path.stat().st_size != expected["size"]:
+                logger.warning(f"The size of {file_path} does not match its manifest")
+                return False
+            if self.verify == "checksum" and _sha256(file_path) != expected["sha256"]:
+                logger.warning(
+                    f"The checksum of {file_path} does not match its manifest"
+                )
+                return False
+        return True
+
+    def _adopt(self, spec: ModelSpec, locked: bool) -> bool:
+        """Writes the manifest of a model downloaded by a version without manifests, if it has all its files.
+
+        The hub only moves a file into place once it is fully downloaded, so the files that are present are complete.
+        """
+        path = self.path(spec)
+        if not all((path / name).is_file() for name in spec.files):
+            return False
+        with nullcontext() if locked else self._lock(spec):
+            if not (path / MANIFEST_NAME).exists():
+                logger.info(f"Writing the manifest of {path}")
+                self._write_manifest(spec, path, self._hash_files(spec, path))
+        return True
+
+    @contextmanager
+    def _lock(self, spec: ModelSpec) -> Iterator[None]:
+        """Exclusive lock of a model across processes, released by the kernel if the process dies"""
+        lock_dir = self.root / ".locks"
+        lock_dir.mkdir(parents=True, exist_ok=True)
+        lock = FileLock(lock_dir / f"{spec.directory}.lock")
+        try:
+            lock.acquire(timeout=0)
+        except Timeout:
+            logger.info(f"Waiting for another process to download {spec.repo_id}")
+            lock.acquire()
+        try:
+            yield
+        finally:
+            lock.release()
+
+
+def _sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(_HASH_CHUNK_BYTES):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _hub_sha256(path: Path, name: str) -> Optional[str]:
+    """The sha256 the hub reported for a file downloaded to a local directory, the etag recorded by huggingface_hub, which is the sha256 of
+    the files stored with git LFS. None for the other files, or if it was not recorded."""
+    metadata_path = path / ".cache" / "huggingface" / "download" / f"{name}.metadata"
+    try:
+        lines = metadata_path.read_text().splitlines()
+    except OSError:
+        return None
+    etag = lines[1].strip().strip('"') if len(lines) > 1 else ""
+    return etag if _SHA256.fullmatch(etag) else None
@@ -0,0 +1,414 @@
+import multiprocessing
+import multiprocessing.connection
+import threading
+import time
+from collections import deque
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    TypeVar,
+    Union,
+    cast,
+)
+
+from nuclia_eval import logger
+from nuclia_eval.exceptions import ModelException
+from nuclia_eval.metrics.base import ScoreReasonResult, ScoreResult
+from nuclia_eval.models.base import RAGEvaluator
+from nuclia_eval.settings import Settings
+
+T = TypeVar("T")
+
+EvaluatorFactory = Callable[[str, Optional[Settings]], RAGEvaluator]
+_Task = Tuple[int, str, tuple]
+# The kind of message, the worker, the task and the result or error of the task
+_Message = Tuple[str, int, Optional[int], Any]
+if TYPE_CHECKING:  # pragma: no cover
+    # The fork contexts are not defined on Windows
+    _Context = Union[
+        multiprocessing.context.SpawnContext,
+        multiprocessing.context.ForkContext,
+        multiprocessing.context.ForkServerContext,
+    ]
+
+
+def remi_factory(device: str, settings: Optional[Settings]) -> RAGEvaluator:
+    """Default factory of the pool workers, a `REMiEvaluator` on the given device"""
+    from nuclia_eval.models.remi import REMiEvaluator
+
+    return REMiEvaluator(settings=settings, device=device)
+
+
+def _worker_main(
+    worker_id: int,
+    device: str,
+    evaluator_factory: EvaluatorFactory,
+    settings: Optional[Settings],
+    inbox: "multiprocessing.Queue[Optional[_Task]]",
+    outbox: "multiprocessing.connection.Connection",
+) -> None:  # pragma: no cover, runs in the worker processes
+    try:
+        evaluator = evaluator_factory(device, settings)
+    except Exception as e:
+        outbox.send(("failed", worker_id, None, e))
+        return
+    outbox.send(("ready", worker_id, None, None))
+    while True:
+        task = inbox.get()
+        if task is None:
+            return
+        task_id, method, args = task
+        try:
+            outbox.send(
+                ("result", worker_id, task_id, getattr(evaluator, method)(*args))
+            )
+        except Exception as e:
+            outbox.send(("error", worker_id, task_id, e))
+
+
+class _Call:
+    """The results of the tasks of a call to the pool, `done` is set once they are all in or one failed"""
+
+    def __init__(self, first_id: int, n_tasks: int) -> None:
+        self.task_ids = range(first_id, first_id + n_tasks)
+        self.results: Dict[int, Any] = {}
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+
+class EvaluatorPool(RAGEvaluator):
+    """Evaluator that shards the metric requests across worker processes, each one with its own evaluator on an assigned device.
+
+    Requests are split into tasks of up to `chunk_size` RAG experiences or contexts, a RAG experience into the tasks of each of its metrics, and each
+    worker takes the next task as soon as it is idle, so faster workers take on more of the work and a single request runs on several workers. The
+    tasks of concurrent calls, e.g. from several threads, share the same queue, and the results are merged back in the order of the inputs. If a worker
+    dies, the task it was running is queued again and a new worker is started on the same device, a task that kills `max_task_attempts` workers fails
+    with a `ModelException`, and a device whose worker dies `max_task_attempts` times in a row while creating its evaluator is given up.
+
+    Args:
+        devices (Sequence[str]): The device of each worker, e.g. `["cuda:0", "cuda:1"]`, or `["cpu"] * 8` for a CPU only job
+        settings (Optional[Settings], optional): The settings of the evaluator of every worker. Defaults to None.
+        evaluator_factory (EvaluatorFactory, optional): Creates the evaluator of a worker from its device and the settings, it must be picklable. Defaults to `remi_factory`.
+        chunk_size (int, optional): How many RAG experiences or contexts each task holds. Defaults to 8.
+        max_task_attempts (int, optional): How many times a task is run before giving up when it makes the workers crash. Defaults to 3.
+        start_method (str, optional): The multiprocessing start method, CUDA requires `spawn`. Defaults to "spawn".
+    """
+
+    def __init__(
+        self,
+        devices: Sequence[str],
+        settings: Optional[Settings] = None,
+        *,
+        evaluator_factory: EvaluatorFactory = remi_factory,
+        chunk_size: int = 8,
+        max_task_attempts: int = 3,
+        start_method: str = "spawn",
+    ) -> None:
+        if not devices:
+            raise ValueError("The pool needs at least one device")
+        self.devices = list(devices)
+        self.settings = settings
+        self.evaluator_factory = evaluator_factory
+        self.chunk_size = chunk_size
+        self.max_task_attempts = max_task_attempts
+        self._context = cast("_Context", multiprocessing.get_context(start_method))
+        # Each worker sends its messages through its own pipe, a worker that dies while writing to a queue shared with the others would block them
+        self._outboxes: Dict[int, "multiprocessing.connection.Connection"] = {}
+        self._inboxes: Dict[int, "multiprocessing.Queue[Optional[_Task]]"] = {}
+        self._processes: Dict[int, multiprocessing.process.BaseProcess] = {}
+        # Guards the scheduling state below, which is shared by the callers and the dispatcher thread
+        self._lock = threading.Lock()
+        self._closed = False
+        self._next_task_id = 0
+        self._tasks: Deque[_Task] = deque()
+        self._calls: Dict[int, _Call] = {}
+        self._attempts: Dict[int, int] = {}
+        self._running: Dict[int, _Task] = {}
+        self._idle: List[int] = []
+        # Workers whose evaluator is loaded, and consecutive deaths of each worker before loading it
+        self._ready: set[int] = set()
+        self._startup_failures: Dict[int, int] = {}
+        self._startup_errors: Dict[int, BaseException] = {}
+        self._error: Optional[BaseException] = None
+        self.restarts = 0
+        for worker_id in range(len(self.devices)):
+            self._start_worker(worker_id)
+        self._dispatcher = threading.Thread(
+            target=self._dispatch_messages, name="nuclia-eval-pool", daemon=True
+        )
+        self._dispatcher.start()
+
+    def evaluate_rag(
+        self, query: str, answer: str, contexts: list[str]
+    ) -> Tuple[ScoreReasonResult, list[ScoreResult], list[ScoreResult]]:
+        return self.evaluate_rag_batch([(query, answer, contexts)])[0]
+
+    def evaluate_rag_batch(
+        self, items: list[Tuple[str, str, list[str]]]
+    ) -> list[Tuple[ScoreReasonResult, list[ScoreResult], list[ScoreResult]]]:
+        # The answer relevance of several experiences is evaluated together, as experiences without contexts, and the other metrics per context chunk
+        answer_chunks = self._chunks(items)
+        calls: List[Tuple[str, tuple]] = [
+            (
+                "evaluate_rag_batch",
+                ([(query, answer, []) for query, answer, _ in chunk],),
+            )
+            for chunk in answer_chunks
+        ]
+        for query, answer, contexts in items:
+            context_chunks = self._chunks(contexts)
+            calls.extend(("context_relevance", (query, c)) for c in context_chunks)
+            calls.extend(("groundedness", (answer, c)) for c in context_chunks)
+        results = iter(self._run(calls))
+        answer_relevances = [
+            result[0] for _ in answer_chunks for result in next(results)
+        ]
+        merged = []
+        for (_, _, contexts), answer_relevance in zip(items, answer_relevances):
+            n_chunks = len(self._chunks(contexts))
+            context_relevance = [r for _ in range(n_chunks) for r in next(results)]
+            groundedness = [r for _ in range(n_chunks) for r in next(results)]
+            merged.append((answer_relevance, context_relevance, groundedness))
+        return merged
+
+    def answer_relevance(self, query: str, answer: str) -> ScoreReasonResult:
+        return self._run([("answer_relevance", (query, answer))])[0]
+
+    def context_relevance(self, query: str, contexts: list[str]) -> list[ScoreResult]:
+        results = self._run(
+            [("context_relevance", (query, chunk)) for chunk in self._chunks(contexts)]
+        )
+        return [result for chunk_results in results for result in chunk_results]
+
+    def groundedness(self, answer: str, contexts: list[str]) -> list[ScoreResult]:
+        results = self._run(
+            [("groundedness", (answer, chunk)) for chunk in self._chunks(contexts)]
+        )
+        return [result for chunk_results in results for result in chunk_results]
+
+    def close(self) -> None:
+        """Stops the workers, the calls still running fail"""
+        with self._lock:
+            self._closed = True
+            self._fail_all(ModelException("The evaluator pool is closed"))
+        self._dispatcher.join()
+        for outbox in self._outboxes.values():
+            outbox.close()
+        self._outboxes.clear()
+        for worker_id, process in self._processes.items():
+            if process.is_alive():
+                self._inboxes[worker_id].put(None)
+        for process in self._processes.values():
+            process.join(timeout=10)
+            if process.is_alive():  # pragma: no cover
+                process.terminate()
+        self._processes.clear()
+
+    def __enter__(self) -> "EvaluatorPool":
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def _chunks(self, values: List[T]) -> List[List[T]]:
+        return [
+            values[start : start + self.chunk_size]
+            for start in range(0, len(values), self.chunk_size)
+        ]
+
+    def _worker_settings(self, device: str) -> Optional[Settings]:
+        """The settings of the worker on the device, the CPU workers share the cores instead of oversubscribing them unless `cpu_threads` is set"""
+        if device.split(":")[0] != "cpu":
+            return self.settings
+        settings = self.settings or Settings()
+        if settings.cpu_threads:
+            return settings
+        from nuclia_eval.models.cpu import default_cpu_threads
+
+        n_cpu_workers = sum(d.split(":")[0] == "cpu" for d in self.devices)
+        return settings.model_copy(
+            update={"cpu_threads": max(1, default_cpu_threads() // n_cpu_workers)}
+        )
+
+    def _start_worker(self, worker_id: int) -> None:
+        inbox: "multiprocessing.Queue[Optional[_Task]]" = self._context.Queue()
+        outbox, sender = self._context.Pipe(duplex=False)
+        process = self._context.Process(
+            target=_worker_main,
+            args=(
+                worker_id,
+                self.devices[worker_id],
+                self.evaluator_factory,
+                self._worker_settings(self.devices[worker_id]),
+                inbox,
+                sender,
+            ),
+            name=f"nuclia-eval-worker-{worker_id}",
+            daemon=True,
+        )
+        process.start()
+        # Only the worker writes to the pipe, so reading it fails once the worker dies
+        sender.close()
+        previous = self._outboxes.pop(worker_id, None)
+        if previous is not None:
+            previous.close()
+        self._inboxes[worker_id] = inbox
+        self._outboxes[worker_id] = outbox
+        self._processes[worker_id] = process
+
+    def _run(self, calls: List[Tuple[str, tuple]]) -> List[Any]:
+        """Runs each (method, args) call in the workers, returning their results in the same order"""
+        if not calls:
+            return []
+        with self._lock:
+            if self._closed:
+                raise ModelException("The evaluator pool is closed")
+            if self._error is not None:
+                raise self._error
+            call = _Call(self._next_task_id, len(calls))
+            self._next_task_id += len(calls)
+            for task_id, (method, args) in zip(call.task_ids, calls):
+                self._calls[task_id] = call
+                self._tasks.append((task_id, method, args))
+            self._dispatch()
+        call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return [call.results[task_id] for task_id in call.task_ids]
+
+    def _dispatch_messages(self) -> None:
+        """Routes the messages of the workers to the calls and hands the queued tasks to the idle workers, until the pool is closed"""
+        last_check = time.monotonic()
+        while True:
+            with self._lock:
+                outboxes = list(self._outboxes.values())
+            messages: List[_Message] = []
+            if outboxes:
+                ready = multiprocessing.connection.wait(outboxes, timeout=0.1)
+                for outbox in outboxes:
+                    if outbox not in ready:
+                        continue
+                    try:
+                        messages.append(outbox.recv())
+                    except (EOFError, OSError):
+                        # The worker died, it is noticed by `_check_workers`
+                        pass
+            else:
+                time.sleep(0.1)
+            with self._lock:
+                if self._closed:
+                    return
+                for message in messages:
+                    self._route(*message)
+                if not messages or time.monotonic() - last_check >= 0.1:
+                    self._check_workers()
+                    last_check = time.monotonic()
+                self._dispatch()
+
+    def _dispatch(self) -> None:
+        while self._tasks and self._idle:
+            task = self._tasks.popleft()
+            if task[0] not in self._calls:
+                # Its call already failed, or a worker that crashed returned its result before dying
+                continue
+            worker_id = self._idle.pop(0)
+            self._attempts[task[0]] = self._attempts.get(task[0], 0) + 1
+            self._running[worker_id] = task
+            self._inboxes[worker_id].put(task)
+
+    def _route(
+        self, kind: str, worker_id: int, task_id: Optional[int], payload: Any
+    ) -> None:
+        if kind == "ready":
+            self._ready.add(worker_id)
+            self._startup_failures.pop(worker_id, None)
+            self._startup_errors.pop(worker_id, None)
+            self._idle.append(worker_id)
+            return
+        if kind == "failed":
+            # The worker exits, it is restarted or given up when its death is noticed
+            self._startup_errors[worker_id] = payload
+            return
+        running = self._running.get(worker_id)
+        if running is not None and running[0] == task_id:
+            del self._running[worker_id]
+            self._idle.append(worker_id)
+        assert task_id is not None
+        self._attempts.pop(task_id, None)
+        call = self._calls.pop(task_id, None)
+        if call is None:
+            # A late message of a task whose call failed
+            return
+        if kind == "error":
+            self._fail(call, payload)
+            return
+        call.results[task_id] = payload
+        if len(call.results) == len(call.task_ids):
+            call.done.set()
+
+    def _fail(self, call: _Call, error: BaseException) -> None:
+        """Fails a call, its queued tasks are dropped and the results of its running ones ignored"""
+        for task_id in call.task_ids:
+            self._calls.pop(task_id, None)
+            self._attempts.pop(task_id, None)
+        call.error = error
+        call.done.set()
+
+    def _fail_all(self, error: BaseException) -> None:
+        for call in set(self._calls.values()):
+            self._fail(call, error)
+        self._tasks.clear()
+
+    def _check_workers(self) -> None:
+        """Restarts the workers that died, queueing their tasks again"""
+        for worker_id, process in list(self._processes.items()):
+            if process.is_alive():
+                continue
+            logger.warning(
+                f"Worker {worker_id} on {self.devices[worker_id]} died with exit code {process.exitcode}, restarting it"
+            )
+            if worker_id not in self._ready:
+                failures = self._startup_failures.get(worker_id, 0) + 1
+                self._startup_failures[worker_id] = failures
+                if failures >= self.max_task_attempts:
+                    self._give_up_worker(worker_id, failures)
+                    continue
+            self._ready.discard(worker_id)
+            if worker_id in self._idle:
+                self._idle.remove(worker_id)
+            task = self._running.pop(worker_id, None)
+            self.restarts += 1
+            self._start_worker(worker_id)
+            if task is None or task[0] not in self._calls:
+                continue
+            if self._attempts[task[0]] >= self.max_task_attempts:
+                self._fail(
+                    self._calls[task[0]],
+                    ModelException(
+                        f"Task {task[1]} crashed {self._attempts[task[0]]} workers, giving up"
+                    ),
+                )
+                continue
+            self._tasks.appendleft(task)
+
+    def _give_up_worker(self, worker_id: int, failures: int) -> None:
+        """Stops restarting a worker that can not create its evaluator, the calls fail once no worker is left"""
+        cause = self._startup_errors.pop(worker_id, None)
+        error = ModelException(
+            f"Worker {worker_id} on {self.devices[worker_id]} could not create its evaluator, it died {failures} times while creating it"
+            + (f": {cause!r}" if cause is not None else "")
+        )
+        logger.error(str(error))
+        del self._processes[worker_id]
+        del self._inboxes[worker_id]
+        self._outboxes.pop(worker_id).close()
+        if not self._processes:
+            self._error = error
+            self._fail_all(error)
@@ -0,0 +1,206 @@
+from collections import OrderedDict
+from dataclasses import dataclass
+from string import Formatter
+from typing import Optional, Union
+
+from mistral_common.protocol.instruct.messages import (
+    ChatMessage,
+    SystemMessage,
+    UserMessage,
+)
+from mistral_common.protocol.instruct.request import ChatCompletionRequest
+from mistral_common.protocol.instruct.tool_calls import Tool, ToolChoice
+from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
+
+from nuclia_eval import logger
+from nuclia_eval.metrics.base import Metric
+
+# Field values used to check a pre-tokenized template against the full encoding
+PROBE_VALUES = [
+    "a",
+    "  leading and trailing spaces  ",
+    "first line\nsecond line\n",
+    "\n\n  indented after blank lines",
+    "",
+    "ünïcödé — {braces} 日本語 🙂",
+]
+
+
+def encode_chat_completion(
+    tokenizer: MistralTokenizer, messages: list[ChatMessage], tool: Tool
+) -> list[int]:
+    """Encodes a conversation that must be answered with a call to `tool`"""
+    request = ChatCompletionRequest(
+        messages=messages,
+        tools=[tool],
+        tool_choice=ToolChoice.any,  # type: ignore
+    )
+    return tokenizer.encode_chat_completion(request).tokens
+
+
+@dataclass
+class _Line:
+    """A line of the prompt content with template fields, tokenized for every request"""
+
+    template: str
+    first: bool
+
+
+@dataclass
+class PromptTemplate:
+    """The prompt of a metric split into pre-tokenized static segments and the lines with template fields"""
+
+    segments: list[Union[list[int], _Line]]
+
+
+class PromptEncoder:
+    """Encodes the prompts of the metrics by splicing pre-tokenized segments instead of tokenizing the whole chat completion of every request.
+
+    SentencePiece never merges tokens across a newline, so the prompt content is split into lines. The tool, the system message and the lines without
+    template fields are tokenized once per metric, the lines with fields are tokenized per request and kept in an LRU cache of up to `cache_size` lines
+    shared by all the metrics, so a context evaluated by several metrics is only tokenized once. The first time a metric is used its spliced prompts
+    are checked against the full encoding on a few probe inputs, metrics that do not match are always encoded in full.
+
+    Args:
+        tokenizer (MistralTokenizer): The tokenizer of the model
+        system_message (SystemMessage): The system message of every prompt
+        cache_size (int, optional): Maximum number of tokenized lines kept in the cache. Defaults to 4096.
+    """
+
+    def __init__(
+        self,
+        tokenizer: MistralTokenizer,
+        system_message: SystemMessage,
+        cache_size: int = 4096,
+    ) -> None:
+        self.tokenizer = tokenizer
+        self.system_message = system_message
+        self.cache_size = cache_size
+        self._templates: dict[str, Optional[PromptTemplate]] = {}
+        self._lines: OrderedDict[str, list[int]] = OrderedDict()
+
+    def encode(self, metric: Metric, tool: Tool, fields: dict[str, str]) -> list[int]:
+        """Returns the same tokens as `encode_chat_completion` for the prompt of a metric with the given template fields"""
+        template = self.get_template(metric, tool)
+        if template is None:
+            return self.encode_chat_completion(metric, tool, fields)
+        return self._splice(template, fields)
+
+    def encode_chat_completion(
+        self, metric: Metric, tool: Tool, fields: dict[str, str]
+    ) -> list[int]:
+        """Encodes the prompt of a metric with the full chat completion encoding"""
+        return encode_chat_completion(
+            self.tokenizer,
+            [
+                self.system_message,
+                UserMessage(content=metric.template.format(**fields)),
+            ],
+            tool,
+        )
+
+    def get_template(self, metric: Metric, tool: Tool) -> Optional[PromptTemplate]:
+        """Returns the pre-tokenized prompt of a metric, None if splicing does not reproduce its full encoding"""
+        if tool.function.name not in self._templates:
+            template = self._build_template(metric, tool)
+            if template is not None and not self._check_template(
+                template, metric, tool
+            ):
+                logger.warning(
+                    f"Pre-tokenized prompt of {tool.function.name} does not match the full encoding, encoding it in full"
+                )
+                template = None
+            self._templates[tool.function.name] = template
+        return self._templates[tool.function.name]
+
+    def _build_template(self, metric: Metric, tool: Tool) -> Optional[PromptTemplate]:
+        fields = [name for _, name, _, _ in Formatter().parse(metric.template) if name]
+        # The tool and the control tokens around the content are taken from the full encoding of a probe
+        probe = self.encode_chat_completion(
+            metric, tool, {field: "a" for field in fields}
+        )
+        instruct_tokenizer = self.tokenizer.instruct_tokenizer
+        begin_inst = getattr(instruct_tokenizer, "BEGIN_INST", None)
+        end_inst = getattr(instruct_tokenizer, "END_INST", None)
+        if begin_inst not in probe or probe[-1] != end_inst:
+            return None
+
+        # The normalizer joins the system prompt and the user message with a blank line
+        escaped_system = (
+            str(self.system_message.content).replace("{", "{{").replace("}", "}}")
+        )
+        lines = f"{escaped_system}\n\n{metric.template}".split("\n")
+        segments: list[Union[list[int], _Line]] = [
+            list(probe[: probe.index(begin_inst) + 1])
+        ]
+        static_text = ""
+        static_first = True
+        for i, line in enumerate(lines):
+            # Every line but the first starts with the newline that separates it from the previous one
+            text = line if i == 0 else "\n" + line
+            if any(name is not None for _, name, _, _ in Formatter().parse(line)):
+                if static_text:
+                    segments.append(self._tokenize(static_text, static_first))
+                    static_text = ""
+                segments.append(_Line(text, first=i == 0))
+                static_first = False
+            else:
+                static_text += text.format()
+        if static_text:
+            segments.append(self._tokenize(static_text, static_first))
+        segments.append([end_inst])
+        return PromptTemplate(segments)
+
+    def _check_template(
+        self, template: PromptTemplate, metric: Metric, tool: Tool
+    ) -> bool:
+        fields = [name for _, name, _, _ in Formatter().parse(metric.template) if name]
+        probes = [{field: value for field in fields} for value in PROBE_VALUES]
+        probes.append(
+            {
+                field: PROBE_VALUES[i % len(PROBE_VALUES)]
+                for i, field in enumerate(fields)
+            }
+        )
+        return all(
+            self._splice(template, probe)
+            == list(self.encode_chat_completion(metric, tool, probe))
+            for probe in probes
+        )
+
+    def _splice(self, template: PromptTemplate, fields: dict[str, str]) -> list[int]:
+        tokens: list[int] = []
+        for segment in template.segments:
+            if isinstance(segment, _Line):
+                tokens.extend(
+                    self._tokenize_line(
+                        segment.template.format(**fields), segment.first
+                    )
+                )
+            else:
+                tokens.extend(segment)
+        return tokens
+
+    def _tokenize_line(self, text: str, first: bool) -> list[int]:
+        key = text if not first else "\0" + text
+        tokens = self._lines.get(key)
+        if tokens is None:
+            tokens = self._tokenize(text, first)
+            self._lines[key] = tokens
+            if len(self._lines) > self.cache_size:
+                self._lines.popitem(last=False)
+        else:
+            self._lines.move_to_end(key)
+        return tokens
+
+    def _tokenize(self, text: str, first: bool) -> list[int]:
+        """Tokenizes a segment as it is tokenized inside the whole content, only the start of the content gets the SentencePiece dummy prefix"""
+        tokens = list(
+            self.tokenizer.instruct_tokenizer.tokenizer.encode(
+                text, bos=False, eos=False
+            )
+        )
+        if first:
+            return tokens
+        # Segments after the first start with a newline, which never merges with the dummy prefix in front of it
+        return tokens[1:]
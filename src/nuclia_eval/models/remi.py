@@ -1,39 +1,97 @@
 import json
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from contextlib import nullcontext
 from pathlib import Path
-from typing import Optional, Tuple, Type, TypeVar
+from string import Formatter
+from typing import (
+    Any,
+    ContextManager,
+    Optional,
+    Sequence,
+    Tuple,
+    Type,
+    TypeVar,
+    Union,
+    cast,
+)
 
 import torch
-from huggingface_hub import snapshot_download
 from mistral_common.protocol.instruct.messages import (
-    ChatMessageType,
+    ChatMessage,
     SystemMessage,
     UserMessage,
 )
-from mistral_common.protocol.instruct.request import ChatCompletionRequest
-from mistral_common.protocol.instruct.tool_calls import FunctionCall, Tool, ToolChoice
+from mistral_common.protocol.instruct.tool_calls import Tool
 from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
-from mistral_inference.generate import generate
 from mistral_inference.transformer import Transformer
-from pydantic import BaseModel, ValidationError
+from pydantic import BaseModel
 
 from nuclia_eval import logger
-from nuclia_eval.exceptions import InvalidToolCallException
+from nuclia_eval.cache import ResultCache, result_key
+from nuclia_eval.dedup import ResultMemo, dedup_key
+from nuclia_eval.exceptions import InvalidToolCallException, ModelNotReadyException
+from nuclia_eval.instrumentation import Callback, CallStats, emit
 from nuclia_eval.metrics import (
     AnswerRelevance,
     ContextRelevance,
     Groundedness,
 )
 from nuclia_eval.metrics.base import (
+    DiscreteScoreDistributionResponse,
     DiscreteScoreReasonResponse,
     DiscreteScoreResponse,
+    InvalidToolCallResponse,
     Metric,
+    PromptBudgetInfo,
+    ScoreReasonResult,
+    ScoreResult,
 )
 from nuclia_eval.models.base import RAGEvaluator
+from nuclia_eval.models.budget import PromptBudget, aggregate_chunks
+from nuclia_eval.models.constraints import (
+    TokenTexts,
+    ToolCallConstraint,
+    ToolCallGrammar,
+)
+from nuclia_eval.models.cpu import (
+    default_cpu_threads,
+    quantize_int8,
+    use_cpu_attention,
+)
+from nuclia_eval.models.engine import GenerationEngine, GenerationRequest
+from nuclia_eval.models.generation import (
+    PrefixCache,
+    common_prefix_length,
+    generate,
+    score,
+)
+from nuclia_eval.models.model_cache import ADAPTER_MODEL, BASE_MODEL, ModelCache
+from nuclia_eval.models.prompts import PromptEncoder, encode_chat_completion
+from nuclia_eval.models.tool_calls import (
+    SYSTEM_PROMPT,
+    parse_tool_calls_text,
+    repair_tool_call,
+)
+from nuclia_eval.prefilter import overlap_scores
 from nuclia_eval.settings import Settings
-from nuclia_eval.utils import inherit_docstrings, load_lora_low_mem
+from nuclia_eval.utils import (
+    inherit_docstrings,
+    load_lora_low_mem,
+    load_transformer_mmap,
+    read_into_page_cache,
+    save_safetensors_atomic,
+)
 
 T = TypeVar("T", bound=BaseModel)
 
+_NO_STAGE = nullcontext()
+
+# Bumped whenever the way the adapter is merged changes, so checkpoints baked before are not used
+MERGED_CHECKPOINT_VERSION = 2
+
 
 class REMiEvaluator(RAGEvaluator):
     """Evaluator that uses a REMi model"""
@@ -43,176 +101,1172 @@ class REMiEvaluator(RAGEvaluator):
         settings: Optional[Settings] = None,
         force_download: bool = False,
         device: str = "cuda",
+        callbacks: Optional[list[Callback]] = None,
     ) -> None:
         super().__init__()
         # Load default settings if not provided
         if settings is None:
             settings = Settings()
         self.settings = settings
+        self.callbacks: list[Callback] = list(callbacks or [])
+        on_cpu = str(device).split(":")[0] == "cpu"
+        if self.settings.quantization != "none" and not on_cpu:
+            raise ValueError(
+                f"{self.settings.quantization} quantization is only supported on CPU, not on {device}"
+            )
+
+        self.device = device
+        self.startup_seconds: dict[str, float] = {}
+        self._model_identity: Optional[dict[str, Any]] = None
+        if on_cpu:
+            threads = self.settings.cpu_threads or default_cpu_threads()
+            torch.set_num_threads(threads)
+            use_cpu_attention()
+            logger.info(f"Running on CPU with {threads} threads")
+
+        # Cache variables
+        self._call_stats: Optional[CallStats] = None
+        self._result_memo = ResultMemo(self.settings.dedup_cache_size)
+        self._tools: dict[str, Tool] = {}
+        self._prompt_encoder: Optional[PromptEncoder] = None
+        self._prompt_budget: Optional[PromptBudget] = None
+        self._system_message: Optional[SystemMessage] = None
+        self._prefix_cache: Optional[PrefixCache] = None
+        if self.settings.prefix_cache_max_bytes > 0:
+            self._prefix_cache = PrefixCache(self.settings.prefix_cache_max_bytes)
+        self._prefix_lengths: dict[str, int] = {}
+        self._score_call_tokens: dict[str, tuple[list[int], list[int]]] = {}
+        self._grammars: dict[str, ToolCallGrammar] = {}
+        self._token_texts: Optional[TokenTexts] = None
+        self._engine: Optional[GenerationEngine] = None
+        self._result_cache: Optional[ResultCache] = None
+        if self.settings.result_cache_path is not None:
+            self._result_cache = ResultCache(
+                self.settings.result_cache_path, self.settings.result_cache_max_bytes
+            )
+
+        self._ready: "Future[REMiEvaluator]" = Future()
+        if self.settings.background_loading:
+            threading.Thread(
+                target=self._load_in_background,
+                args=(force_download,),
+                name="nuclia-eval-load",
+                daemon=True,
+            ).start()
+        else:
+            self._load(force_download)
+            self._ready.set_result(self)
+
+    @property
+    def ready(self) -> bool:
+        """Whether the model is loaded and the evaluator can be used, always True unless the `background_loading` setting is enabled"""
+        return self._ready.done() and self._ready.exception() is None
+
+    @property
+    def ready_future(self) -> "Future[REMiEvaluator]":
+        """Future resolved with the evaluator once its model is loaded, or with the error that stopped the loading, e.g. to await it with `asyncio.wrap_future`"""
+        return self._ready
+
+    def wait_ready(self, timeout: Optional[float] = None) -> "REMiEvaluator":
+        """Blocks until the model is loaded and returns the evaluator.
+
+        Args:
+            timeout (Optional[float], optional): The maximum seconds to wait. Defaults to None, waiting until the model is loaded.
+
+        Raises:
+            ModelNotReadyException: If the model is not loaded within `timeout`
+            Exception: The error that stopped the loading of the model, if any
+        """
+        try:
+            return self._ready.result(timeout)
+        except FutureTimeoutError:
+            raise ModelNotReadyException(
+                f"The REMi model is still loading after waiting {timeout}s"
+            ) from None
+
+    def _load_in_background(self, force_download: bool) -> None:
+        try:
+            self._load(force_download)
+        except BaseException as e:
+            logger.exception("Loading the REMi model failed")
+            self._ready.set_exception(e)
+        else:
+            self._ready.set_result(self)
+
+    def _load(self, force_download: bool) -> None:
+        """Downloads and loads the tokenizer and the model.
+
+        The tokenizer is loaded, and the adapter file read into the page cache, in other threads while the base weights are loaded onto the device.
+        """
+        startup_start = time.perf_counter()
 
         # Download models
-        self._download_base_model(force_download)
-        self._download_adapter_model(force_download)
+        start = time.perf_counter()
+        self._base_model_path, self._adapter_model_path = ModelCache(
+            self.settings.nuclia_model_cache,
+            offline=self.settings.offline,
+            verify=self.settings.model_cache_verify,
+        ).ensure([BASE_MODEL, ADAPTER_MODEL], force_download)
+        self.startup_seconds["model_cache"] = time.perf_counter() - start
+
+        with ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="nuclia-eval-load"
+        ) as executor:
+            tokenizer = executor.submit(self._load_tokenizer)
+            merged_checkpoint_path = self._get_merged_checkpoint_path()
+            if (
+                self.settings.merged_checkpoint != "off"
+                and merged_checkpoint_path is not None
+                and merged_checkpoint_path.is_file()
+            ):
+                # The adapter is already merged, the weights are memory mapped onto the device
+                logger.info(f"Loading merged REMi model from {merged_checkpoint_path}")
+                start = time.perf_counter()
+                self.model = load_transformer_mmap(
+                    self._base_model_path / "params.json",
+                    merged_checkpoint_path,
+                    max_batch_size=self.settings.max_batch_size,
+                    device=self.device,
+                    dtype=torch.float16,
+                )
+                self.startup_seconds["merged_model"] = time.perf_counter() - start
+                logger.info("Merged REMi model loaded successfully")
+            else:
+                adapter_path = self._adapter_model_path / "lora.safetensors"
+                adapter = executor.submit(self._read_adapter, adapter_path)
+
+                # Load model, straight onto the device
+                logger.info("Loading base model")
+                start = time.perf_counter()
+                self.model = Transformer.from_folder(
+                    str(self._base_model_path),
+                    max_batch_size=self.settings.max_batch_size,
+                    dtype=torch.float16,
+                    device=self.device,
+                )
+                self.startup_seconds["base_model"] = time.perf_counter() - start
+                logger.info("Base model loaded successfully")
+
+                # Load LoRA
+                adapter.result()
+                logger.info("Loading REMi adapter model")
+                start = time.perf_counter()
+                load_lora_low_mem(self.model, adapter_path)
+                self.startup_seconds["adapter_merge"] = time.perf_counter() - start
+                logger.info("REMi adapter model loaded successfully")
 
-        # Load tokenizer
+                if (
+                    self.settings.merged_checkpoint == "bake"
+                    and merged_checkpoint_path is not None
+                ):
+                    start = time.perf_counter()
+                    self._bake_merged_checkpoint()
+                    self.startup_seconds["bake"] = time.perf_counter() - start
+            self.tokenizer = tokenizer.result()
+
+        if self.settings.quantization == "int8":
+            start = time.perf_counter()
+            self.model = quantize_int8(self.model)
+            self.startup_seconds["quantize"] = time.perf_counter() - start
+        elif self.settings.dtype != "float16":
+            logger.info(f"Converting model to {self.settings.dtype}")
+            start = time.perf_counter()
+            self.model = self.model.to(dtype=getattr(torch, self.settings.dtype))
+            self.startup_seconds["convert"] = time.perf_counter() - start
+
+        self.startup_seconds["total"] = time.perf_counter() - startup_start
+        logger.info(
+            f"REMi evaluator ready in {self.startup_seconds['total']:.2f}s ("
+            + ", ".join(
+                f"{step} {seconds:.2f}s"
+                for step, seconds in self.startup_seconds.items()
+                if step != "total"
+            )
+            + ")"
+        )
+        if self.callbacks:
+            emit(
+                self.callbacks,
+                CallStats(
+                    "load",
+                    stages={
+                        step: seconds
+                        for step, seconds in self.startup_seconds.items()
+                        if step != "total"
+                    },
+                    seconds=self.startup_seconds["total"],
+                ),
+            )
+
+    def _load_tokenizer(self) -> MistralTokenizer:
         logger.info("Loading tokenizer")
-        self.tokenizer = MistralTokenizer.from_file(
+        start = time.perf_counter()
+        tokenizer = MistralTokenizer.from_file(
             str(self._base_model_path / "tokenizer.model.v3")
         )
+        self.startup_seconds["tokenizer"] = time.perf_counter() - start
         logger.info("Tokenizer loaded successfully")
+        return tokenizer
 
-        # Load model
-        logger.info("Loading base model")
-        self.model = Transformer.from_folder(
-            str(self._base_model_path), dtype=torch.float16, device=device
-        )
-        logger.info("Base model loaded successfully")
+    def _read_adapter(self, path: Path) -> None:
+        start = time.perf_counter()
+        read_into_page_cache(path)
+        self.startup_seconds["adapter_read"] = time.perf_counter() - start
 
-        # Load LoRA
-        logger.info("Loading REMi adapter model")
-        load_lora_low_mem(self.model, self._adapter_model_path / "lora.safetensors")
-        logger.info("REMi adapter model loaded successfully")
+    @property
+    def engine(self) -> Optional[GenerationEngine]:
+        """The continuous batching engine, None until it is first used with the `continuous_batching` setting"""
+        return self._engine
 
-        # Move model to desired device
-        self.device = device
-        logger.info(f"Moving model to {self.device}")
-        self.model = self.model.to(self.device)
-        logger.info(f"Model moved to {self.device}")
+    def add_callback(self, callback: Callback) -> None:
+        """Adds a callback that receives the `CallStats` of every evaluation, with the time spent in each stage, the token counts, the batch sizes and the parse failures"""
+        self.callbacks.append(callback)
 
-        # Cache variables
-        self._tools: Optional[list[Tool]] = None
-        self._system_message: Optional[SystemMessage] = None
+    @property
+    def result_cache(self) -> Optional[ResultCache]:
+        """The persistent result cache, None unless enabled with the `result_cache_path` setting"""
+        return self._result_cache
 
-    def _download_base_model(self, force_download: bool = False):
-        self._base_model_path = (
-            Path(self.settings.nuclia_model_cache) / "Mistral-7B-Instruct-v0.3"
-        )
-        if force_download or not self._base_model_path.exists():
-            logger.info(
-                f"Downloading base model to {self._base_model_path}, to override this behavior, please provide the path in the settings or as an environment variable `NUCLIA_MODEL_CACHE`"
-            )
-            snapshot_download(
-                repo_id="mistralai/Mistral-7B-Instruct-v0.3",
-                allow_patterns=[
-                    "params.json",
-                    "consolidated.safetensors",
-                    "tokenizer.model.v3",
-                ],
-                local_dir=self._base_model_path,
-            )
-            logger.info("Base model downloaded successfully")
-        else:
-            logger.info(
-                f"Base model already exists at {self._base_model_path}, skipping download"
-            )
+    def bake_merged_checkpoint(self) -> Path:
+        """Writes the weights of the model, with the REMi adapter merged, to a checkpoint in the model cache that later evaluators load instead of merging the adapter again.
+
+        The checkpoint is versioned by the base and adapter weights it was made from, the checkpoints of other versions are removed.
 
-    def _download_adapter_model(self, force_download: bool = False):
-        self._adapter_model_path = Path(self.settings.nuclia_model_cache) / "REMi-v0"
-        if force_download or not self._adapter_model_path.exists():
-            logger.info(
-                f"Downloading adapter model to {self._adapter_model_path}, to override this behavior, please provide the path in the settings or as an environment variable `NUCLIA_MODEL_CACHE`"
+        Returns:
+            Path: The path of the merged checkpoint
+        """
+        self.wait_ready()
+        path = self._get_merged_checkpoint_path()
+        # Once loaded, the model is converted to the `dtype` and `quantization` settings
+        if (
+            path is not None
+            and not path.is_file()
+            and (
+                self.settings.quantization != "none" or self.settings.dtype != "float16"
             )
-            snapshot_download(
-                repo_id="nuclia/REMi-v0",
-                local_dir=self._adapter_model_path,
+        ):
+            raise ValueError(
+                "The merged checkpoint is stored in float16, bake it with the default `dtype` and `quantization` settings"
             )
-            logger.info("Adapter model downloaded successfully")
-        else:
-            logger.info(
-                f"Adapter model already exists at {self._adapter_model_path}, skipping download"
+        return self._bake_merged_checkpoint()
+
+    def _bake_merged_checkpoint(self) -> Path:
+        """Writes the merged checkpoint from the model, which must still be in float16"""
+        path = self._get_merged_checkpoint_path()
+        if path is None:
+            raise FileNotFoundError(
+                f"The base or adapter weights are missing from {self.settings.nuclia_model_cache}"
+            )
+        if not path.is_file():
+            logger.info(f"Baking merged REMi model to {path}")
+            save_safetensors_atomic(
+                self.model.state_dict(),
+                path,
+                metadata={
+                    "format_version": str(MERGED_CHECKPOINT_VERSION),
+                    "model": json.dumps(self._get_model_identity(), sort_keys=True),
+                },
             )
+            logger.info("Merged REMi model baked successfully")
+        for stale in path.parent.glob("*.safetensors"):
+            if stale != path:
+                logger.info(f"Removing stale merged REMi model {stale}")
+                stale.unlink(missing_ok=True)
+        return path
 
     @inherit_docstrings
     def evaluate_rag(
         self, query: str, answer: str, contexts: list[str]
-    ) -> Tuple[
-        DiscreteScoreReasonResponse,
-        list[DiscreteScoreResponse],
-        list[DiscreteScoreResponse],
-    ]:
-        # Answer relevance
-        answer_relevance = self.answer_relevance(query, answer)
-        # Context relevance
-        context_relevance = self.context_relevance(query, contexts)
-        # Groundedness
-        groundedness = self.groundedness(answer, contexts)
-        return answer_relevance, context_relevance, groundedness
-
-    def answer_relevance(self, query: str, answer: str) -> DiscreteScoreReasonResponse:
-        system_message = self._get_system_message()
-        answer_relevance_message = self._get_metric_message(
-            AnswerRelevance, query=query, answer=answer
+    ) -> Tuple[ScoreReasonResult, list[ScoreResult], list[ScoreResult]]:
+        return self.evaluate_rag_batch([(query, answer, contexts)])[0]
+
+    @inherit_docstrings
+    def evaluate_rag_batch(
+        self, items: list[Tuple[str, str, list[str]]]
+    ) -> list[Tuple[ScoreReasonResult, list[ScoreResult], list[ScoreResult]]]:
+        # The prompts of each metric are evaluated together for all the items
+        answer_relevances, context_relevances, groundednesses = self._evaluate_metrics(
+            [
+                (
+                    AnswerRelevance,
+                    [{"query": query, "answer": answer} for query, answer, _ in items],
+                ),
+                (
+                    ContextRelevance,
+                    [
+                        {"query": query, "context": context}
+                        for query, _, contexts in items
+                        for context in contexts
+                    ],
+                ),
+                (
+                    Groundedness,
+                    [
+                        {"answer": answer, "context": context}
+                        for _, answer, contexts in items
+                        for context in contexts
+                    ],
+                ),
+            ]
+        )
+        # The results are instances of the response model of their metric, or `InvalidToolCallResponse`
+        results = []
+        start = 0
+        for answer_relevance, (_, _, contexts) in zip(answer_relevances, items):
+            end = start + len(contexts)
+            results.append(
+                (
+                    cast(ScoreReasonResult, answer_relevance),
+                    cast(list[ScoreResult], context_relevances[start:end]),
+                    cast(list[ScoreResult], groundednesses[start:end]),
+                )
+            )
+            start = end
+        return results
+
+    def answer_relevance(self, query: str, answer: str) -> ScoreReasonResult:
+        return cast(
+            ScoreReasonResult,
+            self._evaluate(AnswerRelevance, [{"query": query, "answer": answer}])[0],
         )
-        response = self._chat_completion_request(
-            [system_message, answer_relevance_message],
-            Tool.model_validate(AnswerRelevance.tool),
-            DiscreteScoreReasonResponse,  # type: ignore
+
+    @inherit_docstrings
+    def groundedness(self, answer: str, contexts: list[str]) -> list[ScoreResult]:
+        return cast(
+            list[ScoreResult],
+            self._evaluate(
+                Groundedness,
+                [{"answer": answer, "context": context} for context in contexts],
+            ),
         )
-        return response
 
     @inherit_docstrings
-    def groundedness(
-        self, answer: str, contexts: list[str]
-    ) -> list[DiscreteScoreResponse]:
-        system_message = self._get_system_message()
-        groundedness_messages = [
-            self._get_metric_message(Groundedness, answer=answer, context=context)
-            for context in contexts
-        ]
+    def context_relevance(self, query: str, contexts: list[str]) -> list[ScoreResult]:
+        return cast(
+            list[ScoreResult],
+            self._evaluate(
+                ContextRelevance,
+                [{"query": query, "context": context} for context in contexts],
+            ),
+        )
+
+    def _evaluate(
+        self, metric: Metric, inputs: list[dict[str, str]]
+    ) -> list[BaseModel]:
+        """Computes a metric for each set of template fields, in the same order"""
+        return self._evaluate_metrics([(metric, inputs)])[0]
+
+    def _evaluate_metrics(
+        self, requests: list[tuple[Metric, list[dict[str, str]]]]
+    ) -> list[list[BaseModel]]:
+        """Computes several metrics, each one for a list of template fields, returning the results of each metric in the same order.
+
+        When the result cache is enabled, the results already computed for the same inputs are read from it and only the rest go through the model.
+        When there are callbacks, the stats of the call are sent to them once it finishes.
+        """
+        self.wait_ready(self.settings.ready_timeout)
+        if not self.callbacks:
+            return self._compute_metrics(requests)
+        stats = CallStats("evaluate")
+        for metric, inputs in requests:
+            name = metric.tool["function"]["name"]
+            stats.prompts[name] = stats.prompts.get(name, 0) + len(inputs)
+        self._call_stats = stats
+        start = time.perf_counter()
+        try:
+            return self._compute_metrics(requests)
+        except Exception as e:
+            stats.error = type(e).__name__
+            raise
+        finally:
+            stats.seconds = time.perf_counter() - start
+            self._call_stats = None
+            emit(self.callbacks, stats)
+
+    def _compute_metrics(
+        self, requests: list[tuple[Metric, list[dict[str, str]]]]
+    ) -> list[list[BaseModel]]:
+        all_results: list[list[Optional[BaseModel]]] = []
+        all_keys: list[list[str]] = []
+        misses: list[tuple[Metric, list[dict[str, str]], Type[BaseModel]]] = []
+        for metric, inputs in requests:
+            target_model = self._get_target_model(metric)
+            results: list[Optional[BaseModel]] = [None] * len(inputs)
+            keys: list[str] = []
+            if self._result_cache is not None:
+                with self._stage("cache_lookup"):
+                    keys = [self._get_result_key(metric, fields) for fields in inputs]
+                    for i, value in enumerate(self._result_cache.get_many(keys)):
+                        if value is not None:
+                            results[i] = target_model.model_validate_json(value)
+                if self._call_stats is not None:
+                    self._call_stats.cached += sum(
+                        result is not None for result in results
+                    )
+            all_results.append(results)
+            all_keys.append(keys)
+            misses.append(
+                (
+                    metric,
+                    [
+                        fields
+                        for fields, result in zip(inputs, results)
+                        if result is None
+                    ],
+                    target_model,
+                )
+            )
+
+        computed = self._request_prefiltered(misses)
+        for results, keys, metric_computed in zip(all_results, all_keys, computed):
+            missing = [i for i, result in enumerate(results) if result is None]
+            for i, result in zip(missing, metric_computed):
+                results[i] = result
+            if self._result_cache is not None and missing:
+                self._result_cache.put_many(
+                    {
+                        keys[i]: result.model_dump_json()
+                        for i, result in zip(missing, metric_computed)
+                        if not isinstance(result, InvalidToolCallResponse)
+                        and getattr(result, "prefilter_score", None) is None
+                    }
+                )
+        return all_results  # type: ignore
+
+    def _request_prefiltered(
+        self, requests: list[tuple[Metric, list[dict[str, str]], Type[BaseModel]]]
+    ) -> list[list[BaseModel]]:
+        """Scores 0 the contexts whose lexical overlap with the query or answer is below `prefilter_threshold`, the rest go through the model.
+
+        The overlap of the contexts of a query or answer is computed together, as their inverse document frequencies depend on each other.
+        """
+        threshold = self.settings.prefilter_threshold
+        if threshold == 0:
+            return self._request_deduplicated(requests)
+        kept_requests: list[tuple[Metric, list[dict[str, str]], Type[BaseModel]]] = []
+        all_skipped: list[dict[int, BaseModel]] = []
+        for metric, inputs, target_model in requests:
+            skipped: dict[int, BaseModel] = {}
+            groups: dict[str, list[int]] = {}
+            for i, fields in enumerate(inputs):
+                if "context" in fields:
+                    reference = fields.get("query", fields.get("answer", ""))
+                    groups.setdefault(reference, []).append(i)
+            with self._stage("prefilter"):
+                for reference, indexes in groups.items():
+                    scores = overlap_scores(
+                        reference,
+                        [inputs[i]["context"] for i in indexes],
+                        self.settings.prefilter_ngram,
+                    )
+                    for i, overlap in zip(indexes, scores.tolist()):
+                        if overlap < threshold:
+                            skipped[i] = self._get_prefiltered_result(
+                                target_model, overlap
+                            )
+            if self._call_stats is not None:
+                self._call_stats.prefiltered += len(skipped)
+            kept_requests.append(
+                (
+                    metric,
+                    [fields for i, fields in enumerate(inputs) if i not in skipped],
+                    target_model,
+                )
+            )
+            all_skipped.append(skipped)
+
+        computed = self._request_deduplicated(kept_requests)
         responses = []
-        for message in groundedness_messages:
+        for requested, skipped, metric_computed in zip(requests, all_skipped, computed):
+            kept = iter(metric_computed)
             responses.append(
-                self._chat_completion_request(
-                    [system_message, message],
-                    Tool.model_validate(Groundedness.tool),
-                    DiscreteScoreResponse,  # type: ignore
-                )
+                [
+                    skipped[i] if i in skipped else next(kept)
+                    for i in range(len(requested[1]))
+                ]
             )
         return responses
 
-    @inherit_docstrings
-    def context_relevance(
-        self, query: str, contexts: list[str]
-    ) -> list[DiscreteScoreResponse]:
-        system_message = self._get_system_message()
-        context_relevance_messages = [
-            self._get_metric_message(ContextRelevance, query=query, context=context)
-            for context in contexts
-        ]
+    def _get_prefiltered_result(
+        self, target_model: Type[BaseModel], overlap: float
+    ) -> BaseModel:
+        """The result of a context skipped by the prefilter, a score of 0 that is certain for the score distributions"""
+        values: dict[str, Any] = {"score": 0, "prefilter_score": overlap}
+        if issubclass(target_model, DiscreteScoreDistributionResponse):
+            values["probabilities"] = [1.0] + [0.0] * 5
+            values["expected_score"] = 0.0
+        if issubclass(target_model, DiscreteScoreReasonResponse):
+            values["reason"] = (
+                "Skipped by the prefilter, the context overlaps too little with the input"
+            )
+        return target_model(**values)
+
+    def _request_deduplicated(
+        self, requests: list[tuple[Metric, list[dict[str, str]], Type[BaseModel]]]
+    ) -> list[list[BaseModel]]:
+        """Runs the model once for each distinct input of each metric, the results are copied to the repeated inputs.
+
+        Inputs are compared as set by the `deduplication` setting, and the results of previous calls kept in memory are reused.
+        """
+        if self.settings.deduplication == "off":
+            return self._request_budgeted(requests)
+        normalize = self.settings.deduplication == "normalized"
+        unique_requests: list[tuple[Metric, list[dict[str, str]], Type[BaseModel]]] = []
+        # For each input, the index of its distinct input or a result from memory
+        all_slots: list[list[Union[int, BaseModel]]] = []
+        all_keys: list[list[str]] = []
+        for metric, inputs, target_model in requests:
+            name = metric.tool["function"]["name"]
+            positions: dict[str, int] = {}
+            unique_inputs: list[dict[str, str]] = []
+            slots: list[Union[int, BaseModel]] = []
+            for fields in inputs:
+                key = dedup_key(name, fields, normalize)
+                remembered = self._result_memo.get(key)
+                if remembered is not None:
+                    slots.append(remembered)
+                    continue
+                if key not in positions:
+                    positions[key] = len(unique_inputs)
+                    unique_inputs.append(fields)
+                slots.append(positions[key])
+            unique_requests.append((metric, unique_inputs, target_model))
+            all_slots.append(slots)
+            all_keys.append(list(positions))
+            if self._call_stats is not None:
+                self._call_stats.deduplicated += len(inputs) - len(unique_inputs)
+
+        computed = self._request_budgeted(unique_requests)
         responses = []
-        for message in context_relevance_messages:
-            responses.append(
-                self._chat_completion_request(
-                    [system_message, message],
-                    Tool.model_validate(ContextRelevance.tool),
-                    DiscreteScoreResponse,  # type: ignore
+        for slots, keys, metric_computed in zip(all_slots, all_keys, computed):
+            for key, result in zip(keys, metric_computed):
+                if not isinstance(result, InvalidToolCallResponse):
+                    self._result_memo.put(key, result)
+            used: set[int] = set()
+            metric_responses = []
+            for slot in slots:
+                if isinstance(slot, BaseModel):
+                    metric_responses.append(slot)
+                elif slot in used:
+                    metric_responses.append(metric_computed[slot].model_copy())
+                else:
+                    used.add(slot)
+                    metric_responses.append(metric_computed[slot])
+            responses.append(metric_responses)
+        return responses
+
+    def _request_budgeted(
+        self, requests: list[tuple[Metric, list[dict[str, str]], Type[BaseModel]]]
+    ) -> list[list[BaseModel]]:
+        """Fits the prompts of the metrics in `max_prompt_tokens` before running the model for them.
+
+        The chunks of an input are evaluated together with the other prompts and their results aggregated, the results of the inputs that
+        did not fit record how they were fitted in their `prompt_budget`.
+        """
+        if self.settings.max_prompt_tokens == 0:
+            return self._request_metrics(requests)
+        budget = self._get_prompt_budget()
+        fitted_requests = []
+        all_fits: list[list[tuple[int, Optional[PromptBudgetInfo]]]] = []
+        with self._stage("tokenize"):
+            for metric, inputs, target_model in requests:
+                tool = self._get_tool(metric)
+                fitted_inputs: list[dict[str, str]] = []
+                fits = []
+                for fields in inputs:
+                    chunks, info = budget.fit(metric, tool, fields)
+                    fitted_inputs.extend(chunks)
+                    fits.append((len(chunks), info))
+                fitted_requests.append((metric, fitted_inputs, target_model))
+                all_fits.append(fits)
+
+        computed = self._request_metrics(fitted_requests)
+        responses = []
+        for fits, metric_computed in zip(all_fits, computed):
+            metric_responses = []
+            start = 0
+            for total_chunks, info in fits:
+                results = metric_computed[start : start + total_chunks]
+                start += total_chunks
+                result = (
+                    results[0]
+                    if total_chunks == 1
+                    else aggregate_chunks(results, self.settings.chunk_aggregation)
                 )
-            )
+                if info is not None and not isinstance(result, InvalidToolCallResponse):
+                    if total_chunks > 1:
+                        info.chunk_scores = [
+                            r.score  # type: ignore
+                            for r in results
+                            if not isinstance(r, InvalidToolCallResponse)
+                        ]
+                    result.prompt_budget = info  # type: ignore
+                metric_responses.append(result)
+            responses.append(metric_responses)
         return responses
 
+    def _request_metrics(
+        self, requests: list[tuple[Metric, list[dict[str, str]], Type[BaseModel]]]
+    ) -> list[list[BaseModel]]:
+        """Runs the model for the inputs of each metric.
+
+        With continuous batching, the prompts of all the metrics that have to be decoded are submitted to the generation engine together.
+        """
+        if not self.settings.continuous_batching:
+            return [
+                self._request(metric, inputs, target_model) if inputs else []
+                for metric, inputs, target_model in requests
+            ]
+        responses: list[list[BaseModel]] = [[] for _ in requests]
+        decoded = []
+        for i, (metric, inputs, target_model) in enumerate(requests):
+            if not inputs:
+                continue
+            if target_model is DiscreteScoreDistributionResponse:
+                responses[i] = self._request(metric, inputs, target_model)
+            else:
+                decoded.append(i)
+        engine_responses = self._engine_chat_completion_requests(
+            [
+                (
+                    self._get_prompts(requests[i][0], requests[i][1]),
+                    self._get_tool(requests[i][0]),
+                    requests[i][2],
+                    self._get_prefix_length(requests[i][0]),
+                )
+                for i in decoded
+            ]
+        )
+        for i, metric_responses in zip(decoded, engine_responses):
+            responses[i] = metric_responses
+        return responses
+
+    def _request(
+        self,
+        metric: Metric,
+        inputs: list[dict[str, str]],
+        target_model: Type[BaseModel],
+    ) -> list[BaseModel]:
+        encoded_prompts = self._get_prompts(metric, inputs)
+        tool = self._get_tool(metric)
+        if target_model is DiscreteScoreDistributionResponse:
+            return self._batch_score_request(  # type: ignore
+                encoded_prompts, tool, prefix_length=self._get_prefix_length(metric)
+            )
+        return self._batch_chat_completion_request(
+            encoded_prompts,
+            tool,
+            target_model,
+            prefix_length=self._get_prefix_length(metric),
+        )
+
+    def _get_prompts(
+        self, metric: Metric, inputs: list[dict[str, str]]
+    ) -> list[list[int]]:
+        """Encodes the prompt of a metric for each of the inputs"""
+        tool = self._get_tool(metric)
+        prompt_encoder = self._get_prompt_encoder()
+        with self._stage("tokenize"):
+            return [prompt_encoder.encode(metric, tool, fields) for fields in inputs]
+
+    def _get_prompt_encoder(self) -> PromptEncoder:
+        if self._prompt_encoder is None:
+            self._prompt_encoder = PromptEncoder(
+                self.tokenizer, self._get_system_message()
+            )
+        return self._prompt_encoder
+
+    def _get_prompt_budget(self) -> PromptBudget:
+        if self._prompt_budget is None:
+            self._prompt_budget = PromptBudget(
+                self._get_prompt_encoder(),
+                self.settings.max_prompt_tokens,
+                self.settings.long_input_policy,
+                overlap=self.settings.chunk_overlap_tokens,
+            )
+        return self._prompt_budget
+
+    def _get_tool(self, metric: Metric) -> Tool:
+        name = metric.tool["function"]["name"]
+        if name not in self._tools:
+            self._tools[name] = Tool.model_validate(metric.tool)
+        return self._tools[name]
+
+    def _get_target_model(self, metric: Metric) -> Type[BaseModel]:
+        """Returns the response model of a metric, score-only metrics return their score distribution in the `logits` score mode"""
+        if (
+            self.settings.score_mode == "logits"
+            and metric.response_model is DiscreteScoreResponse
+        ):
+            return DiscreteScoreDistributionResponse
+        return metric.response_model
+
+    def _get_result_key(self, metric: Metric, fields: dict[str, str]) -> str:
+        """Returns the result cache key of a metric evaluation, which depends on everything that can change its result"""
+        mode: dict[str, Any] = {
+            "score_mode": self.settings.score_mode,
+            "constrained_decoding": self.settings.constrained_decoding,
+            "dtype": self.settings.dtype,
+            "quantization": self.settings.quantization,
+            "tool_call_recovery": self.settings.tool_call_recovery,
+        }
+        if self.settings.max_prompt_tokens > 0:
+            mode["prompt_budget"] = [
+                self.settings.max_prompt_tokens,
+                self.settings.long_input_policy,
+                self.settings.chunk_aggregation,
+                self.settings.chunk_overlap_tokens,
+            ]
+        return result_key(
+            metric=metric.tool,
+            template=metric.template,
+            system=self._get_system_message().content,
+            model=self._get_model_identity(),
+            mode=mode,
+            inputs=fields,
+        )
+
+    def _get_model_identity(self) -> dict[str, Any]:
+        """Identifies the weights of the base and adapter models by their repository, size and modification time"""
+        if self._model_identity is None:
+            self._model_identity = {}
+            for path in (
+                self._base_model_path / "consolidated.safetensors",
+                self._adapter_model_path / "lora.safetensors",
+            ):
+                try:
+                    stat = path.stat()
+                except OSError:
+                    stat = None
+                self._model_identity[f"{path.parent.name}/{path.name}"] = (
+                    [stat.st_size, stat.st_mtime_ns] if stat is not None else None
+                )
+        return self._model_identity
+
+    def _get_merged_checkpoint_path(self) -> Optional[Path]:
+        """Path of the merged checkpoint of the current base and adapter weights, None if any of them is missing"""
+        identity = self._get_model_identity()
+        if any(value is None for value in identity.values()):
+            return None
+        version = result_key(
+            version=MERGED_CHECKPOINT_VERSION,
+            model=identity,
+            dtype="float16",
+        )[:16]
+        return (
+            Path(self.settings.nuclia_model_cache)
+            / "REMi-v0-merged"
+            / f"{version}.safetensors"
+        )
+
     def _chat_completion_request(
-        self, messages: list[ChatMessageType], tool: Tool, target_model: Type[T]
+        self,
+        messages: list[ChatMessage],
+        tool: Tool,
+        target_model: Type[T],
+        prefix_length: int = 0,
     ) -> T:
-        request = ChatCompletionRequest(
-            messages=messages,
-            tools=[tool],
-            tool_choice=ToolChoice.any,  # type: ignore
+        return self._batch_chat_completion_request(
+            [self._encode_chat_completion(messages, tool)],
+            tool,
+            target_model,
+            prefix_length=prefix_length,
+        )[0]
+
+    def _batch_chat_completion_request(
+        self,
+        encoded_prompts: list[list[int]],
+        tool: Tool,
+        target_model: Type[T],
+        prefix_length: int = 0,
+    ) -> list[T]:
+        """Generates a tool call for each encoded prompt, decoding up to `max_batch_size` prompts together in each generation call.
+
+        When the prefix cache is enabled, the first `prefix_length` tokens of the prompts, or all the tokens shared by the prompts if there are several of them, are only prefilled once.
+        The responses are returned in the same order as the prompts.
+        """
+        if self._prefix_cache is not None and len(encoded_prompts) > 1:
+            prefix_length = max(prefix_length, common_prefix_length(encoded_prompts))
+        out_tokens = self._generate_batches(
+            encoded_prompts,
+            tool,
+            target_model,
+            prefix_length,
+            constrained=self.settings.constrained_decoding,
         )
-        tokens = self.tokenizer.encode_chat_completion(request).tokens
-        out_tokens, _ = generate(
-            [tokens],
-            self.model,
-            max_tokens=512,
-            temperature=0.0,
-            eos_id=self.tokenizer.instruct_tokenizer.tokenizer.eos_id,
+        responses = [
+            self._check_generation(output, target_model, tool.function.name)
+            for output in out_tokens
+        ]
+        # Also holds the `InvalidToolCallResponse` of the invalid tool calls when `on_invalid_tool_call` is `report`
+        return self._recover_generations(  # type: ignore[return-value]
+            encoded_prompts, responses, tool, target_model, prefix_length
         )
-        response = self._validate_generation(
-            out_tokens, target_model, tool.function.name
+
+    def _generate_batches(
+        self,
+        encoded_prompts: list[list[int]],
+        tool: Tool,
+        target_model: Type[BaseModel],
+        prefix_length: int,
+        constrained: bool,
+    ) -> list[list[int]]:
+        """Generates the tokens of a tool call for each encoded prompt, decoding up to `max_batch_size` prompts together in each generation call"""
+        max_tokens = self._get_max_tokens(tool, target_model, constrained)
+        batch_size = self.settings.max_batch_size
+        out_tokens: list[list[int]] = []
+        for start in range(0, len(encoded_prompts), batch_size):
+            batch = encoded_prompts[start : start + batch_size]
+            constraints = (
+                [self._new_constraint(tool, target_model) for _ in batch]
+                if constrained
+                else None
+            )
+            batch_out_tokens = generate(
+                batch,
+                self.model,
+                max_tokens=max_tokens,
+                eos_id=self.tokenizer.instruct_tokenizer.tokenizer.eos_id,
+                prefix_cache=self._prefix_cache,
+                prefix_length=prefix_length,
+                constraints=constraints,
+                timings=self._get_timings(),
+            )
+            self._record_batch(batch, batch_out_tokens)
+            out_tokens.extend(batch_out_tokens)
+            # A prompt without output is an invalid tool call
+            out_tokens.extend([] for _ in range(len(batch) - len(batch_out_tokens)))
+        return out_tokens
+
+    def _check_generation(
+        self, output: list[int], target_model: Type[T], desired_tool_name: str
+    ) -> Union[T, InvalidToolCallResponse]:
+        """Validates a generated tool call, when recovery or reporting is enabled an invalid one is repaired or returned as an `InvalidToolCallResponse` to recover it later"""
+        try:
+            return self._validate_generation([output], target_model, desired_tool_name)
+        except InvalidToolCallException as e:
+            if (
+                self.settings.tool_call_recovery == "off"
+                and self.settings.on_invalid_tool_call == "raise"
+            ):
+                raise
+            error = e
+        text = self.tokenizer.instruct_tokenizer.tokenizer.decode(output)
+        if self.settings.tool_call_recovery != "off":
+            try:
+                result = repair_tool_call(text, target_model)
+            except InvalidToolCallException:
+                pass
+            else:
+                result.recovery = "repaired"  # type: ignore
+                if self._call_stats is not None:
+                    self._call_stats.recovered += 1
+                return result
+        return InvalidToolCallResponse(error=str(error), output=text)
+
+    def _recover_generations(
+        self,
+        encoded_prompts: list[list[int]],
+        generated: Sequence[Union[BaseModel, InvalidToolCallResponse]],
+        tool: Tool,
+        target_model: Type[BaseModel],
+        prefix_length: int,
+    ) -> list[BaseModel]:
+        """Decodes again, with constrained decoding, the prompts whose tool call could not be repaired when the `tool_call_recovery` setting is `regenerate`.
+
+        The tool calls that are still invalid raise an `InvalidToolCallException`, or are reported as an `InvalidToolCallResponse`, as set by `on_invalid_tool_call`.
+        """
+        responses: list[BaseModel] = list(generated)
+        failed = [
+            i
+            for i, response in enumerate(responses)
+            if isinstance(response, InvalidToolCallResponse)
+        ]
+        # Constrained decoding would generate the same tool calls again
+        if (
+            failed
+            and self.settings.tool_call_recovery == "regenerate"
+            and not self.settings.constrained_decoding
+        ):
+            logger.debug(f"Decoding {len(failed)} invalid tool calls again")
+            out_tokens = self._generate_batches(
+                [encoded_prompts[i] for i in failed],
+                tool,
+                target_model,
+                prefix_length,
+                constrained=True,
+            )
+            for i, output in zip(failed, out_tokens):
+                try:
+                    result = self._validate_generation(
+                        [output], target_model, tool.function.name
+                    )
+                except InvalidToolCallException as e:
+                    responses[i] = InvalidToolCallResponse(
+                        error=str(e),
+                        output=self.tokenizer.instruct_tokenizer.tokenizer.decode(
+                            output
+                        ),
+                    )
+                    continue
+                result.recovery = "regenerated"  # type: ignore
+                responses[i] = result
+                if self._call_stats is not None:
+                    self._call_stats.recovered += 1
+        if self.settings.on_invalid_tool_call == "raise":
+            for response in responses:
+                if isinstance(response, InvalidToolCallResponse):
+                    raise InvalidToolCallException(response.error)
+        return responses
+
+    def _engine_chat_completion_requests(
+        self,
+        requests: list[tuple[list[list[int]], Tool, Type[BaseModel], int]],
+    ) -> list[list[BaseModel]]:
+        """Generates a tool call for each prompt of each (encoded prompts, tool, target model, prefix length) request with the continuous batching engine.
+
+        All the prompts are decoded together, a prompt joins the running batch as soon as another one finishes.
+        Prompts that do not fit in the slots of the engine are decoded on their own.
+        """
+        engine = self._get_engine()
+        eos_id = self.tokenizer.instruct_tokenizer.tokenizer.eos_id
+        generation_requests: list[list[GenerationRequest]] = []
+        for encoded_prompts, tool, target_model, prefix_length in requests:
+            if self._prefix_cache is not None and len(encoded_prompts) > 1:
+                prefix_length = max(
+                    prefix_length, common_prefix_length(encoded_prompts)
+                )
+            max_tokens = self._get_max_tokens(tool, target_model)
+            generation_requests.append(
+                [
+                    GenerationRequest(
+                        tokens,
+                        max_tokens,
+                        eos_id=eos_id,
+                        constraint=self._get_constraint(tool, target_model),
+                        prefix_length=prefix_length,
+                    )
+                    for tokens in encoded_prompts
+                ]
+            )
+        all_requests = [
+            r for metric_requests in generation_requests for r in metric_requests
+        ]
+        fitting = [r for r in all_requests if engine.fits(r.tokens, r.max_tokens)]
+        with self._stage("engine"):
+            engine.run(fitting)
+        self._record_batch([r.tokens for r in fitting], [r.output for r in fitting])
+        for request in all_requests:
+            if not request.done:
+                logger.debug(
+                    f"Prompt of {len(request.tokens)} tokens does not fit in the generation engine, decoding it on its own"
+                )
+                request.output = generate(
+                    [request.tokens],
+                    self.model,
+                    max_tokens=request.max_tokens,
+                    eos_id=eos_id,
+                    prefix_cache=self._prefix_cache,
+                    prefix_length=request.prefix_length,
+                    constraints=None
+                    if request.constraint is None
+                    else [request.constraint],
+                    timings=self._get_timings(),
+                )[0]
+                request.done = True
+                self._record_batch([request.tokens], [request.output])
+
+        responses = []
+        for (encoded_prompts, tool, target_model, _), metric_requests in zip(
+            requests, generation_requests
+        ):
+            metric_responses = []
+            for request in metric_requests:
+                if request.error is not None:
+                    raise request.error
+                metric_responses.append(
+                    self._check_generation(
+                        request.output, target_model, tool.function.name
+                    )
+                )
+            prefix_length = metric_requests[0].prefix_length if metric_requests else 0
+            responses.append(
+                self._recover_generations(
+                    encoded_prompts, metric_responses, tool, target_model, prefix_length
+                )
+            )
+        return responses
+
+    def _get_max_tokens(
+        self,
+        tool: Tool,
+        target_model: Type[BaseModel],
+        constrained: Optional[bool] = None,
+    ) -> int:
+        """Maximum number of tokens of a tool call, bounded by the longest valid one when decoding is constrained, by default as set by the `constrained_decoding` setting"""
+        if constrained is None:
+            constrained = self.settings.constrained_decoding
+        max_tokens = 512
+        if constrained:
+            grammar = self._get_tool_call_grammar(tool, target_model)
+            max_tokens = min(max_tokens, 1 + grammar.max_length)
+        return max_tokens
+
+    def _get_constraint(
+        self,
+        tool: Tool,
+        target_model: Type[BaseModel],
+        constrained: Optional[bool] = None,
+    ) -> Optional[ToolCallConstraint]:
+        if constrained is None:
+            constrained = self.settings.constrained_decoding
+        if not constrained:
+            return None
+        return self._new_constraint(tool, target_model)
+
+    def _new_constraint(
+        self, tool: Tool, target_model: Type[BaseModel]
+    ) -> ToolCallConstraint:
+        return ToolCallConstraint(
+            self._get_tool_call_grammar(tool, target_model),
+            self._get_token_texts(),
+            self.tokenizer.instruct_tokenizer.TOOL_CALLS,  # type: ignore
         )
-        return response
+
+    def _get_engine(self) -> GenerationEngine:
+        if self._engine is None:
+            self._engine = GenerationEngine(
+                self.model,
+                max_batch_size=self.settings.max_batch_size,
+                max_seq_len=self.settings.engine_max_seq_len,
+                prefix_cache=self._prefix_cache,
+            )
+        return self._engine
+
+    def _get_tool_call_grammar(
+        self, tool: Tool, target_model: Type[BaseModel]
+    ) -> ToolCallGrammar:
+        if tool.function.name not in self._grammars:
+            self._grammars[tool.function.name] = ToolCallGrammar(
+                tool.function.name, target_model
+            )
+        return self._grammars[tool.function.name]
+
+    def _get_token_texts(self) -> TokenTexts:
+        if self._token_texts is None:
+            self._token_texts = TokenTexts(self.tokenizer.instruct_tokenizer.tokenizer)
+        return self._token_texts
+
+    def _batch_score_request(
+        self,
+        encoded_prompts: list[list[int]],
+        tool: Tool,
+        prefix_length: int = 0,
+    ) -> list[DiscreteScoreDistributionResponse]:
+        """Scores each encoded prompt in a single forward pass, without decoding.
+
+        The tool call is forced up to the score value, and the score is read from the distribution of the next token over the digits 0 to 5.
+        Only valid for tools whose only argument is the score.
+        """
+        forced_tokens, score_tokens = self._get_score_call_tokens(tool)
+        encoded_prompts = [prompt + forced_tokens for prompt in encoded_prompts]
+        if self._prefix_cache is not None and len(encoded_prompts) > 1:
+            prefix_length = max(prefix_length, common_prefix_length(encoded_prompts))
+        batch_size = self.settings.max_batch_size
+        responses = []
+        for start in range(0, len(encoded_prompts), batch_size):
+            batch = encoded_prompts[start : start + batch_size]
+            with self._stage("score"):
+                probabilities = score(
+                    batch,
+                    self.model,
+                    candidate_tokens=score_tokens,
+                    prefix_cache=self._prefix_cache,
+                    prefix_length=prefix_length,
+                )
+            self._record_batch(batch)
+            for row in probabilities.tolist():
+                responses.append(
+                    DiscreteScoreDistributionResponse(
+                        score=max(range(len(row)), key=row.__getitem__),
+                        probabilities=row,
+                        expected_score=sum(i * p for i, p in enumerate(row)),
+                    )
+                )
+        return responses
+
+    def _get_score_call_tokens(self, tool: Tool) -> tuple[list[int], list[int]]:
+        """Returns the tokens of the tool call up to the score value, and the token of each score from 0 to 5"""
+        if tool.function.name not in self._score_call_tokens:
+            tokenizer = self.tokenizer.instruct_tokenizer.tokenizer
+            score_tokens = [
+                tokenizer.encode(str(value), bos=False, eos=False)[-1]
+                for value in range(6)
+            ]
+            # Tool calls are encoded as the json dump of the list of calls
+            call_tokens = tokenizer.encode(
+                json.dumps([{"name": tool.function.name, "arguments": {"score": 0}}]),
+                bos=False,
+                eos=False,
+            )
+            score_position = (
+                len(call_tokens) - 1 - call_tokens[::-1].index(score_tokens[0])
+            )
+            self._score_call_tokens[tool.function.name] = (
+                [self.tokenizer.instruct_tokenizer.TOOL_CALLS]  # type: ignore
+                + call_tokens[:score_position],
+                score_tokens,
+            )
+        return self._score_call_tokens[tool.function.name]
+
+    def _encode_chat_completion(
+        self, messages: list[ChatMessage], tool: Tool
+    ) -> list[int]:
+        return encode_chat_completion(self.tokenizer, messages, tool)
+
+    def _get_prefix_length(self, metric: Metric) -> int:
+        """Returns how many leading prompt tokens are the same for every request of a metric, those are the system message, the tool and the static part of the template"""
+        if self._prefix_cache is None:
+            return 0
+        tool = self._get_tool(metric)
+        if tool.function.name not in self._prefix_lengths:
+            fields = [
+                name for _, name, _, _ in Formatter().parse(metric.template) if name
+            ]
+            # Any two requests only share the tokens before the first template field
+            encoded_prompts = [
+                self._encode_chat_completion(
+                    [
+                        self._get_system_message(),
+                        self._get_metric_message(
+                            metric, **{field: placeholder for field in fields}
+                        ),
+                    ],
+                    tool,
+                )
+                for placeholder in ("a", "b")
+            ]
+            self._prefix_lengths[tool.function.name] = common_prefix_length(
+                encoded_prompts
+            )
+        return self._prefix_lengths[tool.function.name]
 
     def _validate_generation(
         self, out_tokens: list[list[int]], target_model: Type[T], desired_tool_name: str
+    ) -> T:
+        if self._call_stats is None:
+            return self._parse_generation(out_tokens, target_model, desired_tool_name)
+        with self._call_stats.stage("parse"):
+            try:
+                return self._parse_generation(
+                    out_tokens, target_model, desired_tool_name
+                )
+            except InvalidToolCallException:
+                self._call_stats.parse_failures += 1
+                raise
+
+    def _parse_generation(
+        self, out_tokens: list[list[int]], target_model: Type[T], desired_tool_name: str
     ) -> T:
         if not out_tokens or not out_tokens[0]:
             raise InvalidToolCallException("No output generated")
@@ -221,21 +1275,30 @@ class REMiEvaluator(RAGEvaluator):
             raise InvalidToolCallException("First token is not a tool call")
 
         result = self.tokenizer.instruct_tokenizer.tokenizer.decode(out_tokens[0])
-        try:
-            calls = json.loads(result)
-            call = FunctionCall.model_validate(calls[0])
-            if call.name != desired_tool_name:
-                raise InvalidToolCallException("Unexpected tool call")
-            model = target_model.model_validate_json(call.arguments)
-        except (TypeError, ValueError, KeyError, ValidationError):
-            raise InvalidToolCallException("Could not parse response")
-        return model
+        return parse_tool_calls_text(result, target_model, desired_tool_name)
+
+    def _stage(self, name: str) -> ContextManager[None]:
+        """Times a stage of the current call, does nothing when there are no callbacks"""
+        if self._call_stats is None:
+            return _NO_STAGE
+        return self._call_stats.stage(name)
+
+    def _get_timings(self) -> Optional[dict[str, float]]:
+        return self._call_stats.stages if self._call_stats is not None else None
+
+    def _record_batch(
+        self, prompts: list[list[int]], outputs: Optional[list[list[int]]] = None
+    ) -> None:
+        if self._call_stats is None or not prompts:
+            return
+        self._call_stats.batch_sizes.append(len(prompts))
+        self._call_stats.prompt_tokens += sum(len(prompt) for prompt in prompts)
+        if outputs is not None:
+            self._call_stats.generated_tokens += sum(len(output) for output in outputs)
 
     def _get_system_message(self) -> SystemMessage:
         if self._system_message is None:
-            self._system_message = SystemMessage(
-                content="You are an AI specialized in computing metrics for evaluating Retrieval Augmented Generation (RAG) experiences, use the tools at your disposal to report each of the metrics requested by the user.",
-            )
+            self._system_message = SystemMessage(content=SYSTEM_PROMPT)
         return self._system_message
 
     def _get_metric_message(self, metric: Metric, **template_fields) -> UserMessage:
@@ -0,0 +1,80 @@
+import json
+import re
+from typing import Any, Type, TypeVar
+
+from mistral_common.protocol.instruct.tool_calls import FunctionCall
+from pydantic import BaseModel, ValidationError
+
+from nuclia_eval.exceptions import InvalidToolCallException
+
+T = TypeVar("T", bound=BaseModel)
+
+# The system message REMi was trained with, shared by the evaluators that run the model in process and those that call a server
+SYSTEM_PROMPT = "You are an AI specialized in computing metrics for evaluating Retrieval Augmented Generation (RAG) experiences, use the tools at your disposal to report each of the metrics requested by the user."
+
+
+def parse_tool_calls(calls: Any, target_model: Type[T], desired_tool_name: str) -> T:
+    """Validates the first of a list of tool calls, each one a dict with the `name` of the tool and its `arguments`, as a call to the desired tool and returns its arguments as the target model
+
+    Raises:
+        InvalidToolCallException: If there is no call, it calls another tool or its arguments are not valid
+    """
+    try:
+        call = FunctionCall.model_validate(calls[0])
+        if call.name != desired_tool_name:
+            raise InvalidToolCallException("Unexpected tool call")
+        return target_model.model_validate_json(call.arguments)
+    except (TypeError, ValueError, KeyError, IndexError, ValidationError):
+        raise InvalidToolCallException("Could not parse response")
+
+
+def parse_tool_calls_text(
+    text: str, target_model: Type[T], desired_tool_name: str
+) -> T:
+    """Like `parse_tool_calls`, from the json dump of the list of tool calls
+
+    Raises:
+        InvalidToolCallException: If the text is not a valid call to the desired tool
+    """
+    try:
+        calls = json.loads(text)
+    except ValueError:
+        raise InvalidToolCallException("Could not parse response")
+    return parse_tool_calls(calls, target_model, desired_tool_name)
+
+
+def repair_tool_call(text: str, target_model: Type[T]) -> T:
+    """Salvages the arguments of a tool call from text that is not a valid one, e.g. truncated or malformed json, a call to another tool or a score out of range.
+
+    Each integer argument is the first number that follows its name, clamped to its range, and each string argument the, possibly unterminated,
+    string that follows its name, or empty if there is none.
+
+    Raises:
+        InvalidToolCallException: If an integer argument can not be found
+    """
+    arguments: dict[str, Any] = {}
+    for name, definition in target_model.model_json_schema()["properties"].items():
+        if definition.get("type") == "integer":
+            match = re.search(
+                rf"{re.escape(name)}\W{{0,4}}?(-?\d+)", text, re.IGNORECASE
+            )
+            if match is None:
+                raise InvalidToolCallException(f"Could not repair the {name} argument")
+            number = int(match.group(1))
+            if "minimum" in definition:
+                number = max(number, definition["minimum"])
+            if "maximum" in definition:
+                number = min(number, definition["maximum"])
+            arguments[name] = number
+        elif definition.get("type") == "string":
+            match = re.search(rf'"{re.escape(name)}"\s*:\s*"((?:[^"\\]|\\.)*)', text)
+            string = match.group(1) if match is not None else ""
+            try:
+                string = json.loads(f'"{string}"')
+            except ValueError:
+                pass
+            arguments[name] = string
+    try:
+        return target_model.model_validate(arguments)
+    except ValidationError:
+        raise InvalidToolCallException("Could not repair response")
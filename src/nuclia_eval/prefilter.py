@@ -0,0 +1,111 @@
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, List, Sequence
+
+_WORD = re.compile(r"\w+")
+
+# BM25 term frequency saturation and length normalization
+K1 = 1.2
+B = 0.75
+
+
+def _numpy() -> Any:
+    try:
+        import numpy
+    except ImportError as e:  # pragma: no cover
+        raise ImportError(
+            "The prefilter requires numpy, install it with `pip install numpy`"
+        ) from e
+    return numpy
+
+
+def terms(text: str, ngram: int = 1) -> List[str]:
+    """The lowercased words of a text followed by its word n-grams, up to `ngram` words long"""
+    words = _WORD.findall(text.lower())
+    all_terms = list(words)
+    for n in range(2, ngram + 1):
+        all_terms.extend(" ".join(words[i : i + n]) for i in range(len(words) - n + 1))
+    return all_terms
+
+
+def overlap_scores(reference: str, contexts: Sequence[str], ngram: int = 1) -> Any:
+    """Lexical overlap of each context with a reference text, e.g. the query or the answer, as a numpy array of scores between 0 and 1.
+
+    The score is the BM25 score of the context for the distinct terms of the reference, with the inverse document frequencies of the given
+    contexts, divided by the highest score the terms could reach, so the same threshold applies to references of any length. A context that
+    shares no term with the reference scores 0.
+    """
+    np = _numpy()
+    reference_terms = list(dict.fromkeys(terms(reference, ngram)))
+    if not contexts or not reference_terms:
+        return np.zeros(len(contexts))
+    columns = {term: j for j, term in enumerate(reference_terms)}
+    frequencies = np.zeros((len(contexts), len(columns)))
+    lengths = np.zeros(len(contexts))
+    for i, context in enumerate(contexts):
+        context_terms = terms(context, ngram)
+        lengths[i] = len(context_terms)
+        for term, count in Counter(context_terms).items():
+            j = columns.get(term)
+            if j is not None:
+                frequencies[i, j] = count
+    documents = (frequencies > 0).sum(axis=0)
+    idf = np.log1p((len(contexts) - documents + 0.5) / (documents + 0.5))
+    average_length = max(lengths.mean(), 1.0)
+    saturation = K1 * (1 - B + B * lengths / average_length)
+    weights = frequencies * (K1 + 1) / (frequencies + saturation[:, None])
+    return weights @ idf / (idf.sum() * (K1 + 1))
+
+
+@dataclass
+class ThresholdStats:
+    """What a prefilter threshold would do on a set of recorded pairs, `skip_rate` is the fraction of pairs scored 0 without running the model
+    and `miss_rate` the fraction of the pairs the model scored at least `min_score` that would have been skipped"""
+
+    threshold: float
+    skip_rate: float
+    miss_rate: float
+
+
+def threshold_stats(
+    prefilter_scores: Sequence[float],
+    model_scores: Sequence[int],
+    thresholds: Sequence[float],
+    min_score: int = 1,
+) -> List[ThresholdStats]:
+    """Skip and miss rates of each threshold for the prefilter scores of some pairs and the scores the model gave them"""
+    np = _numpy()
+    prefilter = np.asarray(prefilter_scores, dtype=float)
+    relevant = np.asarray(model_scores) >= min_score
+    skipped = prefilter[None, :] < np.asarray(thresholds, dtype=float)[:, None]
+    skip_rates = skipped.mean(axis=1) if len(prefilter) else np.zeros(len(thresholds))
+    miss_rates = (
+        skipped[:, relevant].mean(axis=1)
+        if relevant.any()
+        else np.zeros(len(thresholds))
+    )
+    return [
+        ThresholdStats(float(threshold), float(skip_rate), float(miss_rate))
+        for threshold, skip_rate, miss_rate in zip(thresholds, skip_rates, miss_rates)
+    ]
+
+
+def tune_threshold(
+    prefilter_scores: Sequence[float],
+    model_scores: Sequence[int],
+    max_miss_rate: float = 0.01,
+    min_score: int = 1,
+) -> ThresholdStats:
+    """The highest threshold that skips at most `max_miss_rate` of the pairs the model scored at least `min_score`"""
+    np = _numpy()
+    prefilter = np.asarray(prefilter_scores, dtype=float)
+    relevant = np.sort(prefilter[np.asarray(model_scores) >= min_score])
+    if len(relevant) == 0:
+        threshold = 1.0
+    else:
+        # Only the pairs strictly below the threshold are skipped, so at most `allowed` relevant pairs are
+        allowed = math.floor(max_miss_rate * len(relevant))
+        threshold = 1.0 if allowed >= len(relevant) else float(relevant[allowed])
+    return threshold_stats(prefilter, model_scores, [threshold], min_score)[0]
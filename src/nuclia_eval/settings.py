@@ -1,4 +1,5 @@
 from pathlib import Path
+from typing import Literal, Optional
 
 from pydantic import Field
 from pydantic_settings import BaseSettings
@@ -11,3 +12,128 @@ class Settings(BaseSettings):
         default=str(Path.home().joinpath(".nuclia-model-cache")),
         description="The path to the model cache directory.",
     )
+    max_batch_size: int = Field(
+        default=8,
+        ge=1,
+        description="The maximum number of prompts that are decoded together in a single generation call, higher values increase the throughput at the cost of more GPU memory.",
+    )
+    prefix_cache_max_bytes: int = Field(
+        default=0,
+        ge=0,
+        description="Memory budget, in bytes, for keeping the KV states of the prompt prefixes shared between requests (system message, tool and metric template, and the query or answer when evaluating several contexts). Cached prefixes are only prefilled once and the least recently used ones are evicted when the budget is exceeded. 0 disables the prefix cache.",
+    )
+    score_mode: Literal["generate", "logits"] = Field(
+        default="generate",
+        description="How the score-only metrics (context relevance and groundedness) are computed. `generate` decodes the whole tool call and parses it, `logits` forces the tool call up to the score value and reads the distribution over the scores 0 to 5 in a single forward pass, returning the probability of each score and the expected score as well.",
+    )
+    constrained_decoding: bool = Field(
+        default=False,
+        description="Restrict the generated tokens to those that keep the output a valid tool call for the requested metric, stop as soon as the tool call is complete and limit the reason to 150 characters. This bounds the number of decoding steps of each request.",
+    )
+    result_cache_path: Optional[str] = Field(
+        default=None,
+        description="Path to a SQLite database where the metric results are stored, so evaluating the same inputs with the same model and settings again is served from disk instead of running the model. It can be shared by several processes. None disables the result cache.",
+    )
+    result_cache_max_bytes: int = Field(
+        default=1024**3,
+        ge=0,
+        description="Size budget, in bytes, of the results stored in the result cache, the least recently used results are evicted when it is exceeded.",
+    )
+    async_batch_window: float = Field(
+        default=0.005,
+        ge=0,
+        description="How long, in seconds, the async evaluator waits for more requests of the same metric before running a micro-batch, longer windows batch more requests under concurrent traffic at the cost of more latency.",
+    )
+    continuous_batching: bool = Field(
+        default=False,
+        description="Decode the prompts with a continuous batching engine, where a prompt joins the running batch as soon as another one finishes instead of waiting for the whole batch, so short score-only generations are not held back by long answer relevance reasons.",
+    )
+    engine_max_seq_len: int = Field(
+        default=4096,
+        ge=1,
+        description="Maximum number of prompt and generated tokens of a sequence in the continuous batching engine, which preallocates a KV cache of `max_batch_size` sequences of this length. Longer prompts are decoded on their own.",
+    )
+    merged_checkpoint: Literal["off", "load", "bake"] = Field(
+        default="load",
+        description="Use of a checkpoint with the REMi adapter already merged into the base model weights, stored in the model cache and versioned by the base and adapter weights. With `load` a baked checkpoint is memory mapped onto the device and the adapter merge is skipped, with `bake` it is also written on startup when missing, and `off` always merges the adapter on startup. It can be baked ahead of time with `nuclia-eval bake`.",
+    )
+    deduplication: Literal["off", "exact", "normalized"] = Field(
+        default="exact",
+        description="Deduplication of the inputs of a metric, the repeated (query, answer), (query, context) or (answer, context) pairs are only evaluated once and the result is returned for every one of them. With `exact` the inputs must be identical, with `normalized` they are compared after NFKC normalization and collapsing whitespace, so chunks that only differ in spacing or unicode forms also match. `off` evaluates every input.",
+    )
+    dedup_cache_size: int = Field(
+        default=0,
+        ge=0,
+        description="Number of recent metric results kept in memory to deduplicate inputs across calls, e.g. the same chunk retrieved for many queries of a dataset. 0 only deduplicates the inputs within a call.",
+    )
+    max_prompt_tokens: int = Field(
+        default=0,
+        ge=0,
+        description="Maximum number of tokens of a metric prompt, which bounds the memory and latency of a request no matter how long the contexts and answers are. The prompts that do not fit are handled as set by `long_input_policy`, and how is recorded in the `prompt_budget` of the result. 0 disables the limit.",
+    )
+    long_input_policy: Literal["truncate", "chunk", "reject"] = Field(
+        default="truncate",
+        description="What to do with the prompts longer than `max_prompt_tokens`. `truncate` removes tokens from the end of the longest context or answer, `chunk` evaluates the context, or the answer if there is no context, in overlapping windows that fit and aggregates their scores as set by `chunk_aggregation`, and `reject` raises a `PromptTooLongException`.",
+    )
+    chunk_aggregation: Literal["max", "mean"] = Field(
+        default="max",
+        description="How the scores of the chunks of a long input are aggregated, `max` keeps the result of the highest scoring chunk and `mean` averages the scores",
+    )
+    chunk_overlap_tokens: int = Field(
+        default=64,
+        ge=0,
+        description="Number of tokens shared by consecutive chunks of a long input",
+    )
+    dtype: Literal["float16", "bfloat16", "float32"] = Field(
+        default="float16",
+        description="Data type the model runs in. The adapter is always merged in float16, the only type the merged checkpoint is stored in, and the model is converted afterwards. `bfloat16` is much faster than `float16` on CPUs with AVX-512 BF16 or AMX.",
+    )
+    quantization: Literal["none", "int8"] = Field(
+        default="none",
+        description="Quantization of the weights of the model, only on CPU. With `int8` the weights of the linear layers are quantized to int8 and their activations are quantized dynamically, which needs about half the memory of float16, the rest of the model runs in float32 and `dtype` is ignored.",
+    )
+    cpu_threads: int = Field(
+        default=0,
+        ge=0,
+        description="Number of threads torch uses when the evaluator runs on CPU. 0 uses the CPUs the process may run on, which unlike the default of torch accounts for the CPU affinity of containers.",
+    )
+    tool_call_recovery: Literal["off", "repair", "regenerate"] = Field(
+        default="off",
+        description="Recovery of the invalid tool calls generated by the model. `repair` parses the score, and the reason, leniently from the generated text, and `regenerate` also decodes the prompts that can not be repaired again with constrained decoding, unless `constrained_decoding` is already enabled. The recovered results record how in their `recovery`.",
+    )
+    on_invalid_tool_call: Literal["raise", "report"] = Field(
+        default="raise",
+        description="What to do with the tool calls that are still invalid after the recovery. `raise` raises an `InvalidToolCallException`, failing the whole call, and `report` returns an `InvalidToolCallResponse` with the error and the generated text in place of the result of the input, so the results of the other inputs are kept.",
+    )
+    prefilter_threshold: float = Field(
+        default=0.0,
+        ge=0.0,
+        le=1.0,
+        description="Lexical overlap below which a context is scored 0 for context relevance and groundedness without running the model, e.g. the chunks a retriever returns that share no words with the query or the answer. The overlap is a BM25 score of the context for the query or answer, normalized between 0 and 1, and the skipped results record it in their `prefilter_score`. Tune it against recorded results with `nuclia-eval tune-prefilter`, contexts in another language than the query or answer overlap little however relevant they are. 0 disables the prefilter. It requires numpy.",
+    )
+    prefilter_ngram: int = Field(
+        default=1,
+        ge=1,
+        description="Longest word n-grams the prefilter matches, besides the single words. Longer n-grams reward contexts that share phrases with the query or answer.",
+    )
+    offline: bool = Field(
+        default=False,
+        description="Never download the models, only use the ones already in the model cache, and fail right away with a `ModelCacheException` if they are missing or do not match their manifest. Also enabled by the `HF_HUB_OFFLINE` environment variable of huggingface_hub.",
+    )
+    model_cache_verify: Literal["size", "checksum"] = Field(
+        default="size",
+        description="How the models in the cache are verified on startup against the manifest written when they were downloaded. `size` compares the size of their files, which is instant, and `checksum` also rehashes them with sha256, which reads the whole models. The models that do not match are downloaded again.",
+    )
+    background_loading: bool = Field(
+        default=False,
+        description="Download and load the model in a background thread, so creating the evaluator returns at once, e.g. for a service to pass its health checks and warm up its other components while the weights are loaded. `ready`, `ready_future` and `wait_ready` tell when the model is loaded, and the metric calls made before wait for it as set by `ready_timeout`.",
+    )
+    ready_timeout: Optional[float] = Field(
+        default=None,
+        ge=0,
+        description="Seconds a metric call waits for the model loaded in the background before raising a `ModelNotReadyException`, 0 fails right away. None waits until the model is loaded. An error that stopped the loading is raised by every call.",
+    )
+    daemon_address: Optional[str] = Field(
+        default=None,
+        description="Address of a `nuclia-eval serve` daemon, `unix:PATH`, `tcp://HOST:PORT` or `HOST:PORT`. When set, `evaluator_from_settings` returns a `DaemonEvaluator` that sends the requests to the daemon, which keeps the model loaded, instead of loading the model in process, e.g. for scripts and test suites that start many short-lived processes.",
+    )
@@ -1,61 +1,200 @@
+import json
+import os
+import struct
+import tempfile
 from pathlib import Path
-from typing import Union
+from typing import Dict, Optional, Union, cast
 
 import safetensors.torch
+import torch
+from mistral_inference.args import TransformerArgs
+from mistral_inference.transformer import Transformer
 from torch import nn
 
+from nuclia_eval import logger
+
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
 
 def load_lora_low_mem(
     model: nn.Module, lora_path: Union[Path, str], scaling: float = 2.0
-):  # pragma: no cover
-    """Loads LoRA checkpoint with a low memory footprint compared to the official implementation"""
+) -> int:
+    """Merges a LoRA checkpoint into the model weights in place, streaming the A and B matrices of one layer at a time from the file.
+
+    Each weight is updated with `addmm_`, so the only extra memory is the low rank matrices of the layer being merged.
+
+    Args:
+        model (nn.Module): The model to merge the LoRA checkpoint into
+        lora_path (Union[Path, str]): The path of the safetensors file of the LoRA checkpoint
+        scaling (float, optional): The factor applied to the LoRA update. Defaults to 2.0.
+
+    Returns:
+        int: The peak memory, in bytes, measured while merging, of the device for CUDA and of the process otherwise
+    """
     lora_path = Path(lora_path)
     assert lora_path.is_file(), f"{lora_path} does not exist or is not a file"
 
-    lora_state_dict = safetensors.torch.load_file(lora_path)
-
-    lora_dtypes = set([p.dtype for p in lora_state_dict.values()])
-    assert (
-        len(lora_dtypes) == 1
-    ), f"LoRA weights have multipe different dtypes {lora_dtypes}. All weights need to have the same dtype"
-    lora_dtype = lora_dtypes.pop()
-    assert (
-        lora_dtype == model.dtype
-    ), f"LoRA weights dtype differs from model's dtype {lora_dtype} != {model.dtype}"
-    assert all("lora" in key for key in lora_state_dict.keys())
-
-    state_dict = model.state_dict()
-
-    if model.args.lora is None:
-        # move tensors to device
-        lora_state_dict = {k: v.to(model.device) for k, v in lora_state_dict.items()}
-        named_modules = dict(model.named_modules())
-        for name, module in named_modules.items():
-            if isinstance(module, nn.Linear) and name != "output":
-                layer_id = name.split(".")[1]
-                if layer_id in model.layers:
-                    weight = (
-                        module.weight
-                        + (
-                            lora_state_dict[name + ".lora_B.weight"]
-                            @ lora_state_dict[name + ".lora_A.weight"]
-                        )
-                        * scaling
-                    )
-                    state_dict[name + ".weight"].copy_(weight)
-    else:
-        for k, v in lora_state_dict.items():
-            state_dict.update(lora_state_dict)
-
-            layer_id = k.split(".")[1]
-            if layer_id in model.layers:
-                state_dict[k] = v
-
-    model.load_state_dict(state_dict, strict=True)
-
-    # Clear any remaining variables to free up memory
-    del lora_state_dict
-    del state_dict
+    weight = next(model.parameters())
+    device, model_dtype = weight.device, weight.dtype
+    model_args = cast(TransformerArgs, model.args)
+    layers: nn.Module = model.get_submodule("layers")
+    layer_ids = {layer_id for layer_id, _ in layers.named_children()}
+    reset_peak_memory(device)
+    with safetensors.safe_open(str(lora_path), framework="pt", device=str(device)) as f:
+        keys = list(f.keys())
+        assert all("lora" in key for key in keys)
+        lora_dtypes = set(
+            _SAFETENSORS_DTYPES[f.get_slice(key).get_dtype()] for key in keys
+        )
+        assert len(lora_dtypes) == 1, (
+            f"LoRA weights have multipe different dtypes {lora_dtypes}. All weights need to have the same dtype"
+        )
+        lora_dtype = lora_dtypes.pop()
+        assert lora_dtype == model_dtype, (
+            f"LoRA weights dtype differs from model's dtype {lora_dtype} != {model_dtype}"
+        )
+
+        with torch.no_grad():
+            if model_args.lora is None:
+                for name, module in model.named_modules():
+                    if isinstance(module, nn.Linear) and name != "output":
+                        layer_id = name.split(".")[1]
+                        if layer_id in layer_ids:
+                            module.weight.addmm_(
+                                f.get_tensor(name + ".lora_B.weight"),
+                                f.get_tensor(name + ".lora_A.weight"),
+                                alpha=scaling,
+                            )
+            else:
+                state_dict = model.state_dict()
+                for key in keys:
+                    layer_id = key.split(".")[1]
+                    if layer_id in layer_ids:
+                        state_dict[key].copy_(f.get_tensor(key))
+    peak = peak_memory(device)
+    logger.info(f"LoRA merged with a peak memory of {peak / 1024**3:.2f} GiB")
+    return peak
+
+
+def reset_peak_memory(device: Union[torch.device, str]) -> None:
+    """Resets the peak memory measured by `peak_memory`, when the platform supports it"""
+    device = torch.device(device)
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        return
+    try:
+        # Resets the resident set size high water mark of the process on Linux
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:  # pragma: no cover
+        pass
+
+
+def peak_memory(device: Union[torch.device, str]) -> int:
+    """Returns the peak memory in bytes, allocated on the device for CUDA and the resident set size of the process otherwise, 0 when it cannot be measured"""
+    device = torch.device(device)
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:  # pragma: no cover
+        pass
+    return 0  # pragma: no cover
+
+
+def save_safetensors_atomic(
+    tensors: Dict[str, torch.Tensor],
+    path: Union[Path, str],
+    metadata: Optional[Dict[str, str]] = None,
+) -> None:
+    """Saves the tensors to a safetensors file through a temporary file in the same directory, so readers never see a partially written file"""
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, suffix=".tmp")
+    os.close(fd)
+    try:
+        safetensors.torch.save_file(
+            {name: tensor.contiguous() for name, tensor in tensors.items()},
+            tmp_path,
+            metadata=metadata,
+        )
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def read_into_page_cache(
+    path: Union[Path, str], chunk_bytes: int = 16 * 1024**2
+) -> None:
+    """Reads a file through a small reused buffer, so it is in the page cache when it is loaded later without holding it in memory"""
+    buffer = bytearray(chunk_bytes)
+    with open(path, "rb", buffering=0) as f:
+        while f.readinto(buffer):
+            pass
+
+
+def load_safetensors_mmap(path: Union[Path, str]) -> Dict[str, torch.Tensor]:
+    """Loads a safetensors file as CPU tensors backed by a private memory map of the file, the weights are only read from disk when they are used"""
+    path = Path(path)
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    storage = torch.UntypedStorage.from_file(
+        str(path), shared=False, nbytes=path.stat().st_size
+    )
+    assert isinstance(storage, torch.UntypedStorage)
+    data_start = 8 + header_size
+    tensors = {}
+    for name, info in header.items():
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        offset = data_start + begin
+        if offset % dtype.itemsize:  # pragma: no cover, safetensors aligns the data
+            raise ValueError(f"Tensor {name} of {path} is not aligned")
+        data = torch.empty(0, dtype=torch.uint8).set_(
+            storage, offset, [end - begin], [1]
+        )
+        tensors[name] = data.view(dtype).view(info["shape"])
+    return tensors
+
+
+def read_safetensors_metadata(path: Union[Path, str]) -> Dict[str, str]:
+    """Reads the metadata stored in the header of a safetensors file"""
+    with safetensors.safe_open(str(path), framework="pt") as f:
+        return f.metadata() or {}
+
+
+def load_transformer_mmap(
+    params_path: Union[Path, str],
+    weights_path: Union[Path, str],
+    max_batch_size: int,
+    device: Union[torch.device, str],
+    dtype: torch.dtype,
+) -> Transformer:
+    """Builds a transformer from its `params.json` and a safetensors file of its weights, memory mapped so they are copied from the page cache straight to the device instead of being loaded in memory first"""
+    with open(params_path, "r") as f:
+        model_args = TransformerArgs.from_dict(json.load(f))
+    model_args.max_batch_size = max_batch_size
+    with torch.device("meta"):
+        model = Transformer(model_args)
+    model.load_state_dict(load_safetensors_mmap(weights_path), assign=True, strict=True)
+    return model.to(device=device, dtype=dtype)
 
 
 def inherit_docstrings(cls):  # pragma: no cover
@@ -1,5 +1,55 @@
 import os
 import sys
 
+import pytest
+import torch
+
 # Add the src directory to the system path
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../src")))
+
+
+def reference_attention(xq, key, val, attn_bias=None):
+    """Plain PyTorch replacement for xformers' `memory_efficient_attention`, which has no CPU kernels"""
+    # Masked cache slots are uninitialized memory, which may hold any value
+    q, k, v = (torch.nan_to_num(x).transpose(1, 2) for x in (xq, key, val))
+    scores = q @ k.transpose(-2, -1) * xq.shape[-1] ** -0.5
+    if attn_bias is not None:
+        bias = attn_bias.materialize(
+            scores.shape, dtype=scores.dtype, device=scores.device
+        )
+        scores = torch.where(torch.isinf(bias), bias, scores + bias)
+    return (scores.softmax(-1) @ v).transpose(1, 2).contiguous()
+
+
+@pytest.fixture(autouse=True)
+def model_cache(monkeypatch, tmp_path_factory):
+    """Points the default model cache to a temporary directory, so the tests never touch the one of the user"""
+    path = tmp_path_factory.mktemp("model-cache")
+    monkeypatch.setenv("NUCLIA_MODEL_CACHE", str(path))
+    return path
+
+
+@pytest.fixture
+def tiny_model(monkeypatch):
+    """A tiny randomly initialized Mistral transformer that runs on CPU, it shares the vocabulary size of the v3 tokenizer"""
+    import mistral_inference.transformer
+    from mistral_inference.args import TransformerArgs
+
+    monkeypatch.setattr(
+        mistral_inference.transformer,
+        "memory_efficient_attention",
+        reference_attention,
+    )
+    torch.manual_seed(0)
+    args = TransformerArgs(
+        dim=32,
+        n_layers=2,
+        head_dim=8,
+        hidden_dim=64,
+        n_heads=4,
+        n_kv_heads=2,
+        norm_eps=1e-5,
+        vocab_size=32768,
+        max_batch_size=8,
+    )
+    return mistral_inference.transformer.Transformer(args).to(torch.float32)
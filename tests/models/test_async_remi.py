@@ -0,0 +1,127 @@
+import asyncio
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+
+from nuclia_eval.exceptions import InvalidToolCallException
+from nuclia_eval.metrics.base import DiscreteScoreReasonResponse, DiscreteScoreResponse
+from nuclia_eval.models.async_remi import AsyncREMiEvaluator
+from nuclia_eval.settings import Settings
+
+
+def fake_evaluator(**settings):
+    """A REMi evaluator that scores each prompt by the length of its context, failing for the `fail` context"""
+    evaluator = MagicMock()
+    evaluator.settings = Settings(**settings)
+    evaluator.calls = []
+    evaluator.threads = set()
+
+    def _evaluate(metric, inputs):
+        evaluator.calls.append((metric.tool["function"]["name"], len(inputs)))
+        evaluator.threads.add(threading.get_ident())
+        # The model blocks the thread it runs in
+        time.sleep(0.01)
+        if any(fields.get("context") == "fail" for fields in inputs):
+            raise InvalidToolCallException("Could not parse response")
+        if "context" not in fields_of(inputs):
+            return [
+                DiscreteScoreReasonResponse(score=1, reason=fields["query"])
+                for fields in inputs
+            ]
+        return [
+            DiscreteScoreResponse(score=min(len(fields["context"]), 5))
+            for fields in inputs
+        ]
+
+    evaluator._evaluate.side_effect = _evaluate
+    return evaluator
+
+
+def fields_of(inputs):
+    return inputs[0] if inputs else {}
+
+
+def test_async_REMi_coalesces_requests():
+    evaluator = fake_evaluator(async_batch_window=0.05, max_batch_size=8)
+
+    async def main():
+        async with AsyncREMiEvaluator(evaluator) as async_evaluator:
+            # Many coroutines ask for context relevances at the same time
+            results = await asyncio.gather(
+                *[
+                    async_evaluator.context_relevance("q", ["c" * i, "c"])
+                    for i in range(1, 4)
+                ]
+            )
+            assert [[cr.score for cr in r] for r in results] == [
+                [1, 1],
+                [2, 1],
+                [3, 1],
+            ]
+            (
+                answer_relevance,
+                context_relevance,
+                groundedness,
+            ) = await async_evaluator.evaluate_rag("query", "answer", ["cc"])
+            assert answer_relevance.reason == "query"
+            assert [cr.score for cr in context_relevance] == [2]
+            assert [g.score for g in groundedness] == [2]
+            assert await async_evaluator.groundedness("answer", []) == []
+
+    asyncio.run(main())
+    # The three requests are evaluated in a single micro-batch, and the metrics of a RAG evaluation in one micro-batch each
+    assert evaluator.calls == [
+        ("context_relevance", 6),
+        ("answer_relevance", 1),
+        ("context_relevance", 1),
+        ("groundedness", 1),
+    ]
+    # Inference runs off the event loop thread
+    assert threading.get_ident() not in evaluator.threads
+
+
+def test_async_REMi_batch_size_and_errors():
+    evaluator = fake_evaluator(async_batch_window=1.0, max_batch_size=2)
+
+    async def main():
+        async_evaluator = AsyncREMiEvaluator(evaluator)
+        start = time.monotonic()
+        first, second = await asyncio.gather(
+            async_evaluator.groundedness("a", ["c"]),
+            async_evaluator.groundedness("a", ["cc"]),
+        )
+        # The micro-batch runs as soon as it is full, without waiting for the window
+        assert time.monotonic() - start < 1.0
+        assert [g.score for g in first] == [1]
+        assert [g.score for g in second] == [2]
+
+        async_evaluator.batch_window = 0.05
+        results = await asyncio.gather(
+            async_evaluator.groundedness("a", ["ccc"]),
+            async_evaluator.groundedness("a", ["fail"]),
+            return_exceptions=True,
+        )
+        # Only the failing request gets the error
+        assert [g.score for g in results[0]] == [3]
+        assert isinstance(results[1], InvalidToolCallException)
+        await async_evaluator.aclose()
+
+    asyncio.run(main())
+    assert evaluator.calls == [
+        ("groundedness", 2),
+        ("groundedness", 2),
+        ("groundedness", 1),
+        ("groundedness", 1),
+    ]
+
+
+def test_async_REMi_multiple_event_loops():
+    evaluator = fake_evaluator(async_batch_window=0.0)
+    async_evaluator = AsyncREMiEvaluator(evaluator)
+    for _ in range(2):
+        results = asyncio.run(async_evaluator.context_relevance("q", ["ccc"]))
+        assert [cr.score for cr in results] == [3]
+    with pytest.raises(InvalidToolCallException):
+        asyncio.run(async_evaluator.context_relevance("q", ["fail"]))
@@ -0,0 +1,109 @@
+import pytest
+from mistral_common.protocol.instruct.messages import SystemMessage
+from mistral_common.protocol.instruct.tool_calls import Tool
+from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
+
+from nuclia_eval.exceptions import PromptTooLongException
+from nuclia_eval.metrics import AnswerRelevance, ContextRelevance, Groundedness
+from nuclia_eval.metrics.base import (
+    DiscreteScoreDistributionResponse,
+    DiscreteScoreReasonResponse,
+)
+from nuclia_eval.models.budget import PromptBudget, aggregate_chunks
+from nuclia_eval.models.prompts import PromptEncoder
+
+SYSTEM_MESSAGE = SystemMessage(content="You are an AI that computes {metrics}.")
+LONG_TEXT = " ".join(f"Sentence number {i} of the document." for i in range(200))
+
+
+@pytest.fixture(scope="module")
+def encoder():
+    return PromptEncoder(MistralTokenizer.v3(), SYSTEM_MESSAGE)
+
+
+def _length(encoder, metric, fields):
+    return len(encoder.encode(metric, Tool.model_validate(metric.tool), fields))
+
+
+def test_prompt_budget_fits(encoder):
+    tool = Tool.model_validate(ContextRelevance.tool)
+    fields = {"query": "q", "context": LONG_TEXT}
+    budget = PromptBudget(encoder, _length(encoder, ContextRelevance, fields), "reject")
+    assert budget.fit(ContextRelevance, tool, fields) == ([fields], None)
+
+
+def test_prompt_budget_truncate(encoder):
+    tool = Tool.model_validate(Groundedness.tool)
+    fields = {"answer": "A short answer.", "context": LONG_TEXT}
+    max_tokens = _length(encoder, Groundedness, fields) - 300
+    budget = PromptBudget(encoder, max_tokens, "truncate")
+    [truncated], info = budget.fit(Groundedness, tool, fields)
+    assert info is not None
+    assert info.policy == "truncate"
+    assert info.prompt_tokens == max_tokens + 300
+    assert info.truncated_tokens >= 300
+    # The longest field is truncated at the end
+    assert truncated["answer"] == fields["answer"]
+    assert LONG_TEXT.startswith(truncated["context"])
+    assert _length(encoder, Groundedness, truncated) <= max_tokens
+
+
+def test_prompt_budget_chunk(encoder):
+    tool = Tool.model_validate(ContextRelevance.tool)
+    fields = {"query": "q", "context": LONG_TEXT}
+    empty_length = _length(encoder, ContextRelevance, {"query": "q", "context": ""})
+    budget = PromptBudget(encoder, empty_length + 500, "chunk", overlap=50)
+    chunks, info = budget.fit(ContextRelevance, tool, fields)
+    assert info is not None
+    assert info.policy == "chunk"
+    assert info.chunks == len(chunks) > 1
+    for chunk in chunks:
+        assert chunk["query"] == "q"
+        assert chunk["context"] in LONG_TEXT
+        assert _length(encoder, ContextRelevance, chunk) <= budget.max_tokens
+    # The chunks cover the whole context
+    assert LONG_TEXT.startswith(chunks[0]["context"])
+    assert LONG_TEXT.endswith(chunks[-1]["context"])
+
+    # Without a context, the answer is chunked
+    tool = Tool.model_validate(AnswerRelevance.tool)
+    chunks, info = budget.fit(
+        AnswerRelevance, tool, {"query": "q", "answer": LONG_TEXT}
+    )
+    assert info is not None and info.chunks == len(chunks) > 1
+
+
+def test_prompt_budget_reject(encoder):
+    tool = Tool.model_validate(ContextRelevance.tool)
+    fields = {"query": "q", "context": LONG_TEXT}
+    budget = PromptBudget(encoder, 100, "reject")
+    with pytest.raises(PromptTooLongException):
+        budget.fit(ContextRelevance, tool, fields)
+    # The query is never truncated
+    budget = PromptBudget(encoder, 100, "truncate")
+    with pytest.raises(PromptTooLongException):
+        budget.fit(ContextRelevance, tool, {"query": LONG_TEXT, "context": "c"})
+
+
+def test_aggregate_chunks():
+    results = [
+        DiscreteScoreReasonResponse(score=1, reason="a"),
+        DiscreteScoreReasonResponse(score=4, reason="b"),
+        DiscreteScoreReasonResponse(score=2, reason="c"),
+    ]
+    assert aggregate_chunks(results, "max") == results[1]
+    assert aggregate_chunks(results, "mean") == DiscreteScoreReasonResponse(
+        score=2, reason="c"
+    )
+    distributions = [
+        DiscreteScoreDistributionResponse(
+            score=0, probabilities=[1, 0, 0, 0, 0, 0], expected_score=0
+        ),
+        DiscreteScoreDistributionResponse(
+            score=2, probabilities=[0, 0, 0.5, 0, 0, 0.5], expected_score=3.5
+        ),
+    ]
+    mean = aggregate_chunks(distributions, "mean")
+    assert mean.score == 0
+    assert mean.probabilities == [0.5, 0, 0.25, 0, 0, 0.25]
+    assert mean.expected_score == 1.75
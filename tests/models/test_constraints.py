@@ -0,0 +1,142 @@
+import json
+
+import pytest
+import torch
+from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
+from pydantic import BaseModel
+
+from nuclia_eval.metrics.base import DiscreteScoreReasonResponse, DiscreteScoreResponse
+from nuclia_eval.models.constraints import (
+    _ESCAPES,
+    TokenTexts,
+    ToolCallConstraint,
+    ToolCallGrammar,
+    token_texts,
+)
+from nuclia_eval.models.generation import generate
+
+
+def test_tool_call_grammar_score():
+    grammar = ToolCallGrammar("groundedness", DiscreteScoreResponse)
+    complete = '[{"name": "groundedness", "arguments": {"score": 3}}]'
+    assert grammar.match(complete) is True
+    assert grammar.match(" " + complete) is True
+    for i in range(len(complete)):
+        assert grammar.match(complete[:i]) is False
+    # Out of range, wrong tool, trailing text or wrong format
+    assert grammar.match('[{"name": "groundedness", "arguments": {"score": 6') is None
+    assert grammar.match('[{"name": "groundedness", "arguments": {"score": 12') is None
+    assert grammar.match('[{"name": "context_relevance"') is None
+    assert grammar.match(complete + "]") is None
+    assert grammar.match('[{"name":"groundedness"') is None
+    assert grammar.max_length == len(complete) + 1
+    assert grammar.next_chars("") == "[ "
+    assert grammar.next_chars(complete[:-4]) == "012345"
+    assert grammar.next_chars(complete) == ""
+
+
+def test_tool_call_grammar_score_reason():
+    grammar = ToolCallGrammar("answer_relevance", DiscreteScoreReasonResponse)
+    for arguments in [
+        {"score": 4, "reason": 'A "good" one'},
+        {"reason": "ok", "score": 1},
+    ]:
+        call = json.dumps([{"name": "answer_relevance", "arguments": arguments}])
+        assert grammar.match(call) is True
+        assert grammar.match(call[:-1]) is False
+
+    start = '[{"name": "answer_relevance", "arguments": {"reason": "'
+    assert grammar.match(start + "a" * 150) is False
+    assert grammar.match(start + "a" * 151) is None
+    assert grammar.match(start + "a" * 150 + '"') is False
+    # Escape sequences count as a single character, raw control characters are not valid json
+    assert grammar.match(start + '\\"' * 150) is False
+    assert grammar.match(start + "\\x") is None
+    assert grammar.match(start + "line\nbreak") is None
+    assert grammar.match(start + "ok\\") is False
+
+    assert grammar.match(start + "a" * 149 + "\\") is False
+    assert grammar.match(start + "a" * 150 + "\\") is None
+    assert grammar.next_chars(start + "ok") is None
+    assert grammar.next_chars(start + "ok\\") == "".join(sorted(_ESCAPES))
+    assert grammar.next_chars(start + "a" * 150) == '"'
+
+    class FloatResponse(BaseModel):
+        value: float
+
+    with pytest.raises(ValueError):
+        ToolCallGrammar("float", FloatResponse)
+
+
+def test_token_texts():
+    tokenizer = MistralTokenizer.v3().instruct_tokenizer.tokenizer
+    texts = token_texts(tokenizer)
+    assert len(texts) == tokenizer.n_words
+    # Control tokens
+    assert texts[tokenizer.eos_id] is None
+    assert texts[5] is None
+    # Pieces and bytes
+    tokens = tokenizer.encode('[{"score": 3}]\n', bos=False, eos=False)
+    assert "".join(texts[t] for t in tokens) == ' [{"score": 3}]\n'  # type: ignore
+    indexed = TokenTexts(tokenizer)
+    assert all(texts[t].startswith('"') for t in indexed.starting_with['"'].tolist())  # type: ignore
+
+
+def test_constrained_generation(tiny_model):
+    tokenizer = MistralTokenizer.v3().instruct_tokenizer.tokenizer
+    texts = TokenTexts(tokenizer)
+    prompts = [[1, 3, 100, 200, 4], [1, 3, 300, 4]]
+    for tool_name, response_model in [
+        ("groundedness", DiscreteScoreResponse),
+        ("answer_relevance", DiscreteScoreReasonResponse),
+    ]:
+        # A short reason keeps the random model from decoding 150 characters
+        grammar = ToolCallGrammar(tool_name, response_model, max_string_length=10)
+        constraints = [ToolCallConstraint(grammar, texts, 5) for _ in prompts]
+        out = generate(
+            prompts,
+            tiny_model,
+            max_tokens=1 + grammar.max_length,
+            eos_id=tokenizer.eos_id,
+            constraints=constraints,
+        )
+        for tokens, constraint in zip(out, constraints):
+            assert constraint.done
+            assert tokens[0] == 5
+            call = json.loads(tokenizer.decode(tokens))[0]
+            assert call["name"] == tool_name
+            response = response_model.model_validate(call["arguments"])
+            assert len(getattr(response, "reason", "")) <= 10
+
+    # The most likely token is kept when it is valid
+    constraint = ToolCallConstraint(
+        ToolCallGrammar("groundedness", DiscreteScoreResponse), texts, 5
+    )
+    assert constraint.next_token(torch.zeros(tokenizer.n_words)) == 5
+    logits = torch.zeros(tokenizer.n_words)
+    first = tokenizer.encode('[{"', bos=False, eos=False)[0]
+    logits[first] = 1.0
+    assert constraint.next_token(logits) == first
+
+
+def test_constrained_generation_dead_end(tiny_model):
+    tokenizer = MistralTokenizer.v3().instruct_tokenizer.tokenizer
+    grammar = ToolCallGrammar("groundedness", DiscreteScoreResponse)
+    # Without the text of any token, the second sequence can not be continued after the tool calls token
+    dead_texts = TokenTexts(tokenizer)
+    dead_texts.texts = [None] * len(dead_texts)
+    dead_texts.starting_with = {}
+    constraints = [
+        ToolCallConstraint(grammar, TokenTexts(tokenizer), 5),
+        ToolCallConstraint(grammar, dead_texts, 5),
+    ]
+    out = generate(
+        [[1, 3, 100, 4], [1, 3, 300, 4]],
+        tiny_model,
+        max_tokens=1 + grammar.max_length,
+        eos_id=tokenizer.eos_id,
+        constraints=constraints,
+    )
+    assert json.loads(tokenizer.decode(out[0]))[0]["name"] == "groundedness"
+    assert out[1] == [5]
+    assert constraints[1].done
@@ -0,0 +1,68 @@
+import copy
+
+import mistral_inference.transformer
+import pytest
+import torch
+from xformers.ops import memory_efficient_attention
+
+from nuclia_eval.exceptions import ModelException
+from nuclia_eval.models.cpu import (
+    cpu_attention,
+    default_cpu_threads,
+    quantize_int8,
+    use_cpu_attention,
+)
+from nuclia_eval.models.generation import generate
+
+
+def test_cpu_attention(tiny_model, monkeypatch):
+    prompts = [[1, 5, 9, 2], [1, 7], [1, 3, 3, 3, 3, 8]]
+    # The tiny model fixture runs the reference attention, which materializes the mask of the whole batch
+    expected = generate(prompts, tiny_model, max_tokens=4, eos_id=None)
+    monkeypatch.setattr(
+        mistral_inference.transformer, "memory_efficient_attention", cpu_attention
+    )
+    assert generate(prompts, tiny_model, max_tokens=4, eos_id=None) == expected
+
+
+def test_use_cpu_attention_keeps_replacements(tiny_model):
+    attention = mistral_inference.transformer.memory_efficient_attention
+    use_cpu_attention()
+    assert mistral_inference.transformer.memory_efficient_attention is attention
+
+
+def test_use_cpu_attention_dispatches_once(monkeypatch):
+    monkeypatch.setattr(
+        mistral_inference.transformer,
+        "memory_efficient_attention",
+        memory_efficient_attention,
+    )
+    use_cpu_attention()
+    attention = mistral_inference.transformer.memory_efficient_attention
+    assert attention is not memory_efficient_attention
+    use_cpu_attention()
+    assert mistral_inference.transformer.memory_efficient_attention is attention
+
+
+def test_use_cpu_attention_unsupported_version(monkeypatch):
+    monkeypatch.delattr(mistral_inference.transformer, "memory_efficient_attention")
+    with pytest.raises(ModelException):
+        use_cpu_attention()
+
+
+def test_quantize_int8(tiny_model):
+    tokens = torch.tensor([1, 5, 9, 2, 7, 3])
+    with torch.no_grad():
+        expected = tiny_model.forward(tokens, seqlens=[2, 4])
+        quantized = quantize_int8(copy.deepcopy(tiny_model).half())
+        logits = quantized.forward(tokens, seqlens=[2, 4])
+    assert isinstance(quantized.output, torch.ao.nn.quantized.dynamic.Linear)
+    assert isinstance(
+        quantized.layers["0"].feed_forward.w1, torch.ao.nn.quantized.dynamic.Linear
+    )
+    assert quantized.dtype == torch.float32
+    assert torch.allclose(logits, expected, atol=0.1)
+
+
+def test_default_cpu_threads():
+    assert default_cpu_threads() >= 1
@@ -0,0 +1,243 @@
+import os
+import socket
+import stat
+import threading
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from nuclia_eval.cli import main
+from nuclia_eval.exceptions import InvalidToolCallException, ModelException
+from nuclia_eval.metrics.base import (
+    DiscreteScoreDistributionResponse,
+    DiscreteScoreReasonResponse,
+    DiscreteScoreResponse,
+)
+from nuclia_eval.models.base import RAGEvaluator
+from nuclia_eval.models.daemon import (
+    DaemonEvaluator,
+    EvaluatorServer,
+    evaluator_from_settings,
+    parse_address,
+)
+from nuclia_eval.settings import Settings
+
+
+class FakeEvaluator(RAGEvaluator):
+    """Scores each context by its length, fails for the queries in `failing` and, while `gate` is set, waits for it to be released"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.batches: list[int] = []
+        self.gate = None
+        self.entered = threading.Event()
+
+    def evaluate_rag_batch(self, items):
+        self.entered.set()
+        if self.gate is not None:
+            self.gate.wait(5)
+        self.batches.append(len(items))
+        return super().evaluate_rag_batch(items)
+
+    def evaluate_rag(self, query, answer, contexts):
+        if query in self.failing:
+            raise InvalidToolCallException("Could not parse response")
+        return (
+            self.answer_relevance(query, answer),
+            self.context_relevance(query, contexts),
+            self.groundedness(answer, contexts),
+        )
+
+    def answer_relevance(self, query, answer):
+        return DiscreteScoreReasonResponse(score=5, reason=query)
+
+    def context_relevance(self, query, contexts):
+        return [DiscreteScoreResponse(score=min(len(c), 5)) for c in contexts]
+
+    def groundedness(self, answer, contexts):
+        return [
+            DiscreteScoreDistributionResponse(
+                score=0, probabilities=[1.0, 0, 0, 0, 0, 0], expected_score=0.0
+            )
+            for _ in contexts
+        ]
+
+
+@pytest.fixture
+def unix_address(tmp_path):
+    return f"unix:{tmp_path / 'eval.sock'}"
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def start(evaluator, address, **kwargs):
+        server = EvaluatorServer(evaluator, address, **kwargs)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.close()
+
+
+def test_parse_address():
+    assert parse_address("unix:/tmp/eval.sock") == (socket.AF_UNIX, "/tmp/eval.sock")
+    assert parse_address("tcp://127.0.0.1:8765") == (
+        socket.AF_INET,
+        ("127.0.0.1", 8765),
+    )
+    assert parse_address("localhost:0") == (socket.AF_INET, ("localhost", 0))
+    assert parse_address("tcp://[::1]:8765") == (socket.AF_INET6, ("::1", 8765))
+    with pytest.raises(ValueError):
+        parse_address("localhost")
+    with pytest.raises(ValueError):
+        parse_address("::1:8765")
+
+
+def test_evaluator_server_loopback_only(serve):
+    with pytest.raises(ValueError, match="Refusing"):
+        EvaluatorServer(FakeEvaluator(), "tcp://0.0.0.0:0")
+    with pytest.raises(ValueError, match="Refusing"):
+        EvaluatorServer(FakeEvaluator(), "example.com:0")
+    server = serve(FakeEvaluator(), "tcp://0.0.0.0:0", allow_remote=True)
+    assert server.address.startswith("tcp://0.0.0.0:")
+
+
+def test_daemon_evaluator_ipv6(serve):
+    server = serve(FakeEvaluator(), "[::1]:0")
+    assert server.address.startswith("tcp://[::1]:")
+    with DaemonEvaluator(server.address, timeout=5) as evaluator:
+        assert evaluator.answer_relevance("q", "a").reason == "q"
+
+
+@pytest.mark.parametrize("transport", ["unix", "tcp"])
+def test_daemon_evaluator(serve, unix_address, transport):
+    address = unix_address if transport == "unix" else "tcp://127.0.0.1:0"
+    server = serve(FakeEvaluator(), address)
+    with DaemonEvaluator(server.address, timeout=5) as evaluator:
+        assert evaluator.is_ready()
+        answer, context, groundedness = evaluator.evaluate_rag("q", "a", ["cc", ""])
+        assert answer == DiscreteScoreReasonResponse(score=5, reason="q")
+        assert [r.score for r in context] == [2, 0]
+        assert isinstance(groundedness[0], DiscreteScoreDistributionResponse)
+        assert groundedness[0].probabilities == [1.0, 0, 0, 0, 0, 0]
+
+        results = evaluator.evaluate_rag_batch([("q1", "a", ["c"]), ("q2", "a", [])])
+        assert [r[0].reason for r in results] == ["q1", "q2"]
+        assert evaluator.answer_relevance("q", "a").reason == "q"
+        assert [r.score for r in evaluator.context_relevance("q", ["ccc"])] == [3]
+        assert [r.score for r in evaluator.groundedness("a", ["c", "c"])] == [0, 0]
+
+
+def test_daemon_evaluator_pipelines_and_coalesces(serve, unix_address):
+    fake = FakeEvaluator()
+    fake.gate = threading.Event()
+    server = serve(fake, unix_address)
+    with DaemonEvaluator(server.address, timeout=5) as evaluator:
+        # The first request holds the worker, the others queue up and are evaluated together
+        first = evaluator.submit("evaluate_rag", query="q0", answer="a", contexts=[])
+        assert fake.entered.wait(5)
+        futures = [
+            evaluator.submit("evaluate_rag", query=f"q{i}", answer="a", contexts=["c"])
+            for i in range(1, 5)
+        ]
+        batch = evaluator.submit("evaluate_rag_batch", items=[["q5", "a", []]])
+        # Answered while the worker is busy
+        assert evaluator.is_ready()
+        fake.gate.set()
+        assert first.result(5)[0].reason == "q0"
+        assert [f.result(5)[0].reason for f in futures] == ["q1", "q2", "q3", "q4"]
+        assert batch.result(5)[0][0].reason == "q5"
+    assert fake.batches == [1, 5]
+
+
+def test_daemon_evaluator_errors_fail_their_own_request(serve, unix_address):
+    fake = FakeEvaluator(failing=["bad"])
+    fake.gate = threading.Event()
+    server = serve(fake, unix_address)
+    with DaemonEvaluator(server.address, timeout=5) as evaluator:
+        blocker = evaluator.submit("evaluate_rag", query="q", answer="a", contexts=[])
+        assert fake.entered.wait(5)
+        good = evaluator.submit("evaluate_rag", query="q", answer="a", contexts=[])
+        bad = evaluator.submit("evaluate_rag", query="bad", answer="a", contexts=[])
+        unknown = evaluator.submit("evaluate_rag", query="q")
+        fake.gate.set()
+        assert blocker.result(5)[0].reason == "q"
+        assert good.result(5)[0].reason == "q"
+        with pytest.raises(InvalidToolCallException, match="Could not parse"):
+            bad.result(5)
+        with pytest.raises(ModelException, match="KeyError"):
+            unknown.result(5)
+        with pytest.raises(ModelException, match="Unknown method"):
+            evaluator.submit("bake_merged_checkpoint").result(5)
+
+
+def test_daemon_evaluator_connection(serve, unix_address):
+    with pytest.raises(ModelException, match="nuclia-eval serve"):
+        DaemonEvaluator(unix_address)
+
+    fake = FakeEvaluator()
+    fake.gate = threading.Event()
+    server = serve(fake, unix_address)
+    evaluator = DaemonEvaluator(server.address, timeout=5)
+    future = evaluator.submit("evaluate_rag", query="q", answer="a", contexts=[])
+    assert fake.entered.wait(5)
+    evaluator.close()
+    fake.gate.set()
+    with pytest.raises(ModelException, match="closed"):
+        future.result(5)
+    with pytest.raises(ModelException, match="closed"):
+        evaluator.answer_relevance("q", "a")
+
+
+def test_evaluator_server_unix_socket(serve, unix_address):
+    path = unix_address[len("unix:") :]
+    # Left behind by a server that was killed
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(path)
+    stale.close()
+    server = serve(FakeEvaluator(), unix_address)
+    with DaemonEvaluator(server.address, timeout=5) as evaluator:
+        assert evaluator.is_ready()
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+    with pytest.raises(OSError, match="already serving"):
+        EvaluatorServer(FakeEvaluator(), unix_address)
+
+
+def test_evaluator_server_ready():
+    evaluator = MagicMock()
+    evaluator.ready = False
+    with EvaluatorServer(evaluator, "tcp://127.0.0.1:0") as server:
+        assert not server.ready
+
+
+def test_evaluator_from_settings(serve, unix_address):
+    server = serve(FakeEvaluator(), unix_address)
+    evaluator = evaluator_from_settings(Settings(daemon_address=server.address))
+    assert isinstance(evaluator, DaemonEvaluator)
+    evaluator.close()
+    with patch("nuclia_eval.models.remi.REMiEvaluator") as remi_mock:
+        settings = Settings()
+        assert evaluator_from_settings(settings, device="cpu") is remi_mock.return_value
+        remi_mock.assert_called_once_with(settings=settings, device="cpu")
+
+
+@patch("nuclia_eval.models.daemon.EvaluatorServer")
+@patch("nuclia_eval.models.remi.REMiEvaluator")
+def test_cli_serve(remi_mock: MagicMock, server_mock: MagicMock, capsys):
+    server = server_mock.return_value.__enter__.return_value
+    server.address = "tcp://127.0.0.1:8765"
+    server.serve_forever.side_effect = KeyboardInterrupt
+    assert main(["serve", "--address", "127.0.0.1:8765", "--device", "cpu"]) == 0
+    assert remi_mock.call_args.kwargs["settings"].background_loading
+    server_mock.assert_called_once_with(
+        remi_mock.return_value,
+        "127.0.0.1:8765",
+        max_batch_requests=32,
+        allow_remote=False,
+    )
+    assert "Serving on tcp://127.0.0.1:8765" in capsys.readouterr().out
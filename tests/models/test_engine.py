@@ -0,0 +1,137 @@
+from typing import Optional
+
+import pytest
+import torch
+
+from nuclia_eval.exceptions import InvalidToolCallException
+from nuclia_eval.models.engine import GenerationEngine, GenerationRequest, SlotCache
+from nuclia_eval.models.generation import PrefixCache, generate
+
+PROMPTS = [
+    [1, 2, 3, 4, 5],
+    [1, 2, 7],
+    [1, 9, 9, 9, 9, 9, 9, 9],
+    [1, 2, 3, 4, 6],
+    [5, 6],
+]
+MAX_TOKENS = [10, 3, 7, 1, 5]
+
+
+def test_engine_matches_generate(tiny_model):
+    expected = [
+        generate([prompt], tiny_model, max_tokens=max_tokens)[0]
+        for prompt, max_tokens in zip(PROMPTS, MAX_TOKENS)
+    ]
+    for prefix_cache in [None, PrefixCache(1 << 20)]:
+        engine = GenerationEngine(
+            tiny_model, max_batch_size=2, max_seq_len=32, prefix_cache=prefix_cache
+        )
+        requests = engine.run(
+            [
+                GenerationRequest(prompt, max_tokens, prefix_length=3)
+                for prompt, max_tokens in zip(PROMPTS, MAX_TOKENS)
+            ]
+        )
+        assert [request.output for request in requests] == expected
+        assert all(request.done for request in requests)
+        if prefix_cache is not None:
+            assert [1, 2, 3] in prefix_cache
+
+
+def test_engine_continuous_batching(tiny_model):
+    engine = GenerationEngine(tiny_model, max_batch_size=2, max_seq_len=32)
+    long, short, waiting = (
+        engine.submit(GenerationRequest(prompt, max_tokens))
+        for prompt, max_tokens in [([1, 2, 3], 6), ([1, 5], 2), ([1, 7], 2)]
+    )
+    assert engine.stats.queue_depth == 3
+    engine.step()
+    assert (engine.stats.queue_depth, engine.stats.running) == (1, 2)
+    assert engine.step() == [short]
+    # The waiting request takes the free slot while the long one keeps decoding
+    engine.step()
+    assert (engine.stats.queue_depth, engine.stats.running) == (0, 2)
+    assert engine.step() == [waiting]
+    while engine.has_work():
+        engine.step()
+    assert long.done and len(long.output) == 6
+    assert waiting.output == generate([[1, 7]], tiny_model, max_tokens=2)[0]
+
+    stats = engine.stats
+    assert (stats.finished, stats.steps) == (3, 6)
+    assert (stats.prompt_tokens, stats.generated_tokens) == (7, 10)
+    assert stats.tokens_per_second > 0
+
+
+def test_slot_cache_decode_in_place():
+    cache = SlotCache(n_layers=1, n_slots=4, max_seq_len=8, n_kv_heads=2, head_dim=4)
+    cache.lengths = [3, 0, 5, 2]
+    xk, xv = torch.randn(2, 2, 4), torch.randn(2, 2, 4)
+
+    # Decoding one token in slots 2 and 0 attends over the cache of the slots 0 to 2
+    cache.select([2, 0])
+    metadata = cache.get_input_metadata([1, 1])
+    assert not metadata.prefill
+    view = cache.get_view(0, metadata)
+    keys, values = view.interleave_kv(xk, xv)
+    assert keys.data_ptr() == cache.cache_k.data_ptr()
+    assert keys.shape == (3 * 8, 2, 4)
+    assert torch.equal(keys[2 * 8 + 5], xk[0]) and torch.equal(values[3], xv[1])
+    assert metadata.mask.k_seqinfo.seqstart_py[:2] == [16, 0]
+    assert metadata.mask.k_seqinfo.seqlen_py == [6, 4]
+
+    # Steps with prompt tokens gather them
+    cache.select([1])
+    metadata = cache.get_input_metadata([2])
+    assert metadata.prefill
+    keys, _ = cache.get_view(0, metadata).interleave_kv(xk, xv)
+    assert torch.equal(keys, xk)
+
+
+def test_engine_stops(tiny_model):
+    # The EOS token ends a sequence and is not part of its output
+    reference = generate([[1, 2, 3]], tiny_model, max_tokens=4)[0]
+    engine = GenerationEngine(tiny_model, max_batch_size=4, max_seq_len=16)
+    (request,) = engine.run([GenerationRequest([1, 2, 3], 4, eos_id=reference[2])])
+    assert request.output == reference[:2]
+    (request,) = engine.run([GenerationRequest([1, 2, 3], 0)])
+    assert request.done and request.output == []
+
+    with pytest.raises(ValueError):
+        engine.submit(GenerationRequest(list(range(10)), 7))
+    assert not engine.fits(list(range(10)), 7)
+
+
+class ForcedConstraint:
+    """Forces a sequence of tokens, and reaches a dead end once they run out, or raises `error` if set"""
+
+    def __init__(self, tokens, error=None):
+        self.tokens = list(tokens)
+        self.error = error
+        self.done = False
+
+    def next_token(self, logits: torch.Tensor) -> Optional[int]:
+        if not self.tokens:
+            if self.error is not None:
+                raise self.error
+            self.done = True
+            return None
+        token = self.tokens.pop(0)
+        self.done = not self.tokens
+        return token
+
+
+def test_engine_constraints(tiny_model):
+    engine = GenerationEngine(tiny_model, max_batch_size=3, max_seq_len=16)
+    error = InvalidToolCallException("Could not parse response")
+    forced, dead_end, failing = engine.run(
+        [
+            GenerationRequest([1, 2], 5, constraint=ForcedConstraint([7, 8])),  # type: ignore
+            GenerationRequest([1, 3], 5, constraint=ForcedConstraint([])),  # type: ignore
+            GenerationRequest([1, 4], 5, constraint=ForcedConstraint([], error)),  # type: ignore
+        ]
+    )
+    assert forced.output == [7, 8] and forced.error is None
+    # A dead end only stops its own sequence, its output is left for the caller to validate
+    assert dead_end.done and dead_end.output == [] and dead_end.error is None
+    assert failing.done and failing.error is error
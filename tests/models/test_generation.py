@@ -0,0 +1,126 @@
+import torch
+
+from nuclia_eval.models.generation import PrefixCache, generate, score
+
+
+def test_generate_batch_matches_single(tiny_model):
+    prompts = [[1, 10, 20, 30], [1, 40, 50], [1, 60, 70, 80, 90, 100]]
+    batched = generate(prompts, tiny_model, max_tokens=8)
+    single = [generate([p], tiny_model, max_tokens=8)[0] for p in prompts]
+    assert batched == single
+    assert all(len(tokens) == 8 for tokens in batched)
+
+
+def test_generate_stops_each_sequence_at_eos(tiny_model):
+    prompts = [[1, 10, 20, 30], [1, 40, 50]]
+    reference = generate(prompts, tiny_model, max_tokens=8)
+    # Use the 3rd token generated for the first prompt as EOS
+    eos_id = reference[0][2]
+    out = generate(prompts, tiny_model, max_tokens=8, eos_id=eos_id)
+    assert out[0] == reference[0][:2]
+    # Other sequences are cut at their own EOS, if any
+    expected = reference[1]
+    if eos_id in expected:
+        expected = expected[: expected.index(eos_id)]
+    assert out[1] == expected
+
+
+def test_generate_timings(tiny_model):
+    prompts = [[1, 10, 20, 30], [1, 40, 50]]
+    timings = {"prefill": 1.0}
+    out = generate(prompts, tiny_model, max_tokens=4, timings=timings)
+    assert out == generate(prompts, tiny_model, max_tokens=4)
+    # Added to the existing entries
+    assert timings["prefill"] > 1.0
+    assert timings["decode"] > 0
+
+
+def test_generate_no_prompts(tiny_model):
+    assert generate([], tiny_model, max_tokens=8) == []
+
+
+def test_generate_with_prefix_cache(tiny_model):
+    prefix = [1, 11, 12, 13, 14, 15]
+    prompts = [prefix + [20, 21], prefix + [30], prefix + [40, 41, 42]]
+    reference = generate(prompts, tiny_model, max_tokens=8)
+
+    prefix_cache = PrefixCache(max_bytes=1 << 20)
+    out = generate(
+        prompts,
+        tiny_model,
+        max_tokens=8,
+        prefix_cache=prefix_cache,
+        prefix_length=len(prefix),
+    )
+    assert out == reference
+    assert len(prefix_cache) == 1 and prefix in prefix_cache
+
+    # A longer prefix is extended from the cached one
+    out = generate(
+        prompts[:1],
+        tiny_model,
+        max_tokens=8,
+        prefix_cache=prefix_cache,
+        prefix_length=len(prefix) + 1,
+    )
+    assert out == reference[:1]
+    assert len(prefix_cache) == 2 and prefix + [20] in prefix_cache
+
+    # The prefix length is capped, so that every prompt has at least one token to prefill
+    out = generate(
+        [prefix], tiny_model, max_tokens=8, prefix_cache=prefix_cache, prefix_length=100
+    )
+    assert out == generate([prefix], tiny_model, max_tokens=8)
+    assert prefix[:-1] in prefix_cache
+
+
+def test_prefix_cache_eviction(tiny_model):
+    prefix_cache = PrefixCache(max_bytes=1 << 20)
+    state_a = prefix_cache.prefill(tiny_model, [1, 2, 3, 4])
+    # n_layers * n_tokens * n_kv_heads * head_dim * 4 bytes, for keys and values
+    entry_size = 2 * (2 * 4 * 2 * 8 * 4)
+    assert prefix_cache.nbytes == entry_size
+    assert prefix_cache.longest_prefix([1, 2, 3, 4, 5]) == (4, state_a)
+    assert prefix_cache.longest_prefix([1, 2, 3]) == (0, None)
+
+    # Only room for two entries
+    prefix_cache.max_bytes = 2 * entry_size
+    prefix_cache.prefill(tiny_model, [5, 6, 7, 8])
+    prefix_cache.longest_prefix([1, 2, 3, 4])  # Mark as recently used
+    prefix_cache.prefill(tiny_model, [9, 10, 11, 12])
+    assert [1, 2, 3, 4] in prefix_cache
+    assert [5, 6, 7, 8] not in prefix_cache
+    assert [9, 10, 11, 12] in prefix_cache
+    assert prefix_cache.nbytes == 2 * entry_size
+
+    # Prefixes larger than the whole budget are not cached
+    prefix_cache.prefill(tiny_model, list(range(1, 20)))
+    assert len(prefix_cache) == 2
+
+    prefix_cache.clear()
+    assert len(prefix_cache) == 0 and prefix_cache.nbytes == 0
+
+
+def test_score(tiny_model):
+    prompts = [[1, 11, 12, 13, 20, 21], [1, 11, 12, 13, 30]]
+    next_tokens = [tokens[0] for tokens in generate(prompts, tiny_model, max_tokens=1)]
+    candidates = [next_tokens[0], next_tokens[1], 100, 200]
+
+    probabilities = score(prompts, tiny_model, candidate_tokens=candidates)
+    assert probabilities.shape == (2, 4)
+    assert torch.allclose(probabilities.sum(dim=-1), torch.ones(2))
+    # The greedy next token is the most likely candidate
+    assert probabilities.argmax(dim=-1).tolist() == [0, 1]
+
+    prefix_cache = PrefixCache(max_bytes=1 << 20)
+    cached_probabilities = score(
+        prompts,
+        tiny_model,
+        candidate_tokens=candidates,
+        prefix_cache=prefix_cache,
+        prefix_length=4,
+    )
+    assert torch.allclose(probabilities, cached_probabilities, atol=1e-5)
+    assert len(prefix_cache) == 1
+
+    assert score([], tiny_model, candidate_tokens=candidates).shape == (0, 4)
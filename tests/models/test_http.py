@@ -0,0 +1,145 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from nuclia_eval.exceptions import InvalidToolCallException, ModelException
+from nuclia_eval.metrics.base import DiscreteScoreReasonResponse
+from nuclia_eval.models.http import HTTPEvaluator
+
+
+class StubServer(ThreadingHTTPServer):
+    """OpenAI compatible chat completions server that scores each prompt by the length of its context"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.requests = []
+        self.connections = set()
+        self.failures = 0
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.content_calls = False
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}/v1"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests.append((self.path, self.headers.get("Authorization"), body))
+            server.connections.add(self.client_address)
+            fail = server.failures > 0
+            server.failures -= fail
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        time.sleep(0.02)
+        with server.lock:
+            server.in_flight -= 1
+        if fail:
+            return self._send(503, {"error": "overloaded"})
+
+        name = body["tools"][0]["function"]["name"]
+        prompt = body["messages"][-1]["content"]
+        if name == "answer_relevance":
+            arguments = {"score": 3, "reason": "Because"}
+        else:
+            # The context is the last quoted field of the template
+            context = prompt.split('"""')[-2].strip("\n")
+            arguments = {"score": min(len(context), 5)}
+        if name == "groundedness" and "wrong" in prompt:
+            name = "context_relevance"
+        call = {"name": name, "arguments": json.dumps(arguments)}
+        if server.content_calls:
+            message = {
+                "role": "assistant",
+                "content": "[TOOL_CALLS] " + json.dumps([call]),
+            }
+        else:
+            message = {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{"id": "a", "type": "function", "function": call}],
+            }
+        self._send(200, {"choices": [{"index": 0, "message": message}]})
+
+    def _send(self, status, data):
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+
+@pytest.fixture
+def server():
+    server = StubServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_evaluator(server):
+    with HTTPEvaluator(
+        server.base_url, api_key="secret", max_concurrency=4
+    ) as evaluator:
+        answer_relevance, context_relevances, groundednesses = evaluator.evaluate_rag(
+            "q", "a", ["c", "cc", "ccc", "cccc", "ccccc"]
+        )
+        assert answer_relevance == DiscreteScoreReasonResponse(
+            score=3, reason="Because"
+        )
+        assert [cr.score for cr in context_relevances] == [1, 2, 3, 4, 5]
+        assert [g.score for g in groundednesses] == [1, 2, 3, 4, 5]
+
+    assert len(server.requests) == 11
+    path, authorization, body = server.requests[0]
+    assert path == "/v1/chat/completions"
+    assert authorization == "Bearer secret"
+    assert body["model"] == "nuclia/REMi-v0"
+    assert body["tool_choice"] == "required"
+    assert body["messages"][0]["role"] == "system"
+    # The contexts are sent concurrently, within the limit, over reused connections
+    assert 1 < server.max_in_flight <= 4
+    assert len(server.connections) <= 4
+
+
+def test_http_evaluator_retries(server):
+    server.failures = 2
+    with HTTPEvaluator(server.base_url, backoff_factor=0.01) as evaluator:
+        assert evaluator.answer_relevance("q", "a").score == 3
+    assert len(server.requests) == 3
+
+    server.failures = 10
+    with HTTPEvaluator(server.base_url, max_retries=1, backoff_factor=0) as evaluator:
+        with pytest.raises(ModelException, match="503"):
+            evaluator.answer_relevance("q", "a")
+
+
+def test_http_evaluator_tool_calls(server):
+    with HTTPEvaluator(server.base_url) as evaluator:
+        with pytest.raises(InvalidToolCallException):
+            evaluator.groundedness("wrong", ["c"])
+        # Servers that do not parse the tool calls return them in the content
+        server.content_calls = True
+        assert [g.score for g in evaluator.groundedness("a", ["cc"])] == [2]
+
+    with HTTPEvaluator("http://127.0.0.1:1/v1", max_retries=0) as evaluator:
+        with pytest.raises(ModelException):
+            evaluator.context_relevance("q", ["c"])
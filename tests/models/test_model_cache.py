@@ -0,0 +1,143 @@
+import hashlib
+import json
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from nuclia_eval.exceptions import ModelCacheException
+from nuclia_eval.models.model_cache import (
+    MANIFEST_NAME,
+    ModelCache,
+    ModelSpec,
+)
+
+BASE = ModelSpec("org/base", "base", ("weights.bin", "tokenizer"), ("*",))
+ADAPTER = ModelSpec("org/adapter", "adapter", ("lora.bin",))
+
+
+def write_files(local_dir, names, content=b"data"):
+    for name in names:
+        (local_dir / name).write_bytes(content)
+
+
+def fake_download(repo_id, local_dir, allow_patterns=None):
+    spec = BASE if repo_id == BASE.repo_id else ADAPTER
+    write_files(local_dir, spec.files)
+
+
+@patch("nuclia_eval.models.model_cache.snapshot_download", side_effect=fake_download)
+def test_model_cache_download(download_mock, tmp_path):
+    cache = ModelCache(str(tmp_path))
+    paths = cache.ensure([BASE, ADAPTER])
+    assert paths == [tmp_path / "base", tmp_path / "adapter"]
+    assert download_mock.call_count == 2
+    manifest = json.loads((tmp_path / "base" / MANIFEST_NAME).read_text())
+    assert manifest["files"]["weights.bin"] == {
+        "size": 4,
+        "sha256": hashlib.sha256(b"data").hexdigest(),
+    }
+    # Only the published models are left in the cache
+    assert sorted(p.name for p in tmp_path.iterdir()) == [".locks", "adapter", "base"]
+
+    # Valid models are not downloaded again, unless forced
+    cache.ensure([BASE, ADAPTER])
+    assert download_mock.call_count == 2
+    cache.ensure([ADAPTER], force_download=True)
+    assert download_mock.call_count == 3
+
+    # A file that does not match the manifest is downloaded again
+    (tmp_path / "base" / "weights.bin").write_bytes(b"truncated")
+    cache.ensure([BASE])
+    assert download_mock.call_count == 4
+    assert (tmp_path / "base" / "weights.bin").read_bytes() == b"data"
+    # Corruption of the same size is only found by the checksums
+    (tmp_path / "base" / "weights.bin").write_bytes(b"dat4")
+    cache.ensure([BASE])
+    assert download_mock.call_count == 4
+    ModelCache(str(tmp_path), verify="checksum").ensure([BASE])
+    assert download_mock.call_count == 5
+
+
+@patch("nuclia_eval.models.model_cache.snapshot_download")
+def test_model_cache_invalid_download(download_mock, tmp_path):
+    cache = ModelCache(str(tmp_path))
+    # Incomplete downloads are not published
+    download_mock.side_effect = lambda repo_id, local_dir, allow_patterns: write_files(
+        local_dir, ["weights.bin"]
+    )
+    with pytest.raises(ModelCacheException):
+        cache.ensure([BASE])
+    assert not (tmp_path / "base").exists()
+
+    # Nor the files that do not match the checksum reported by the hub
+    def download_corrupted(repo_id, local_dir, allow_patterns):
+        write_files(local_dir, BASE.files)
+        metadata = local_dir / ".cache" / "huggingface" / "download"
+        metadata.mkdir(parents=True)
+        (metadata / "weights.bin.metadata").write_text(
+            f"commit\n{hashlib.sha256(b'other').hexdigest()}\n0\n"
+        )
+
+    download_mock.side_effect = download_corrupted
+    with pytest.raises(ModelCacheException):
+        cache.ensure([BASE])
+    assert not (tmp_path / "base").exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [".locks"]
+
+
+@patch("nuclia_eval.models.model_cache.snapshot_download", side_effect=fake_download)
+def test_model_cache_offline(download_mock, tmp_path):
+    with pytest.raises(ModelCacheException):
+        ModelCache(str(tmp_path), offline=True).ensure([BASE, ADAPTER])
+    download_mock.assert_not_called()
+    ModelCache(str(tmp_path)).ensure([BASE, ADAPTER])
+    assert ModelCache(str(tmp_path), offline=True).ensure([BASE]) == [tmp_path / "base"]
+
+
+@patch("nuclia_eval.models.model_cache.snapshot_download", side_effect=fake_download)
+def test_model_cache_adopts_previous_downloads(download_mock, tmp_path):
+    # Downloaded before manifests existed
+    (tmp_path / "base").mkdir()
+    write_files(tmp_path / "base", BASE.files)
+    ModelCache(str(tmp_path), offline=True).ensure([BASE])
+    assert (tmp_path / "base" / MANIFEST_NAME).is_file()
+    # A partial download is replaced
+    (tmp_path / "adapter").mkdir()
+    (tmp_path / "adapter" / "README.md").write_text("")
+    ModelCache(str(tmp_path)).ensure([ADAPTER])
+    assert download_mock.call_count == 1
+    assert (tmp_path / "adapter" / "lora.bin").is_file()
+
+
+@patch("nuclia_eval.models.model_cache.snapshot_download")
+def test_model_cache_concurrent(download_mock, tmp_path):
+    downloading = threading.Barrier(2, timeout=5)
+
+    def slow_download(repo_id, local_dir, allow_patterns):
+        # The base and adapter models are downloaded at the same time
+        downloading.wait()
+        time.sleep(0.1)
+        fake_download(repo_id, local_dir)
+
+    download_mock.side_effect = slow_download
+    errors = []
+
+    def start_worker():
+        try:
+            ModelCache(str(tmp_path)).ensure([BASE, ADAPTER])
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    workers = [threading.Thread(target=start_worker) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    assert errors == []
+    # The workers that waited for the lock use the models the first one published
+    assert sorted(c.kwargs["repo_id"] for c in download_mock.call_args_list) == [
+        "org/adapter",
+        "org/base",
+    ]
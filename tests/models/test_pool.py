@@ -0,0 +1,201 @@
+import os
+import signal
+import threading
+import time
+from pathlib import Path
+from typing import Optional
+
+import pytest
+
+from nuclia_eval.exceptions import InvalidToolCallException, ModelException
+from nuclia_eval.metrics.base import DiscreteScoreReasonResponse, DiscreteScoreResponse
+from nuclia_eval.models.base import RAGEvaluator
+from nuclia_eval.models.pool import EvaluatorPool
+from nuclia_eval.settings import Settings
+
+
+class FakeEvaluator(RAGEvaluator):
+    """Scores contexts by their length, and reports the process that evaluated them as the reason.
+
+    The `crash` context kills the process the first time it is seen, `always crash` every time, and `fail` raises an exception. A `meet`
+    context waits for another process to evaluate the same context, so it only succeeds when two workers run it at the same time.
+    """
+
+    def __init__(self, device: str, crash_marker: Path):
+        self.device = device
+        self.crash_marker = crash_marker
+
+    def evaluate_rag(self, query, answer, contexts):
+        return (
+            self.answer_relevance(query, answer),
+            self.context_relevance(query, contexts),
+            self.groundedness(answer, contexts),
+        )
+
+    def answer_relevance(self, query, answer):
+        return DiscreteScoreReasonResponse(
+            score=len(answer) % 6, reason=f"{self.device}:{os.getpid()}"
+        )
+
+    def context_relevance(self, query, contexts):
+        for context in contexts:
+            if context == "always crash" or (
+                context == "crash" and not self.crash_marker.exists()
+            ):
+                self.crash_marker.touch()
+                os._exit(1)
+            if context == "fail":
+                raise InvalidToolCallException("Could not parse response")
+            if context.startswith("meet"):
+                self._meet(context)
+        return [DiscreteScoreResponse(score=len(c) % 6) for c in contexts]
+
+    def groundedness(self, answer, contexts):
+        return [DiscreteScoreResponse(score=0) for _ in contexts]
+
+    def _meet(self, context):
+        (self.crash_marker.parent / f"{context}-{os.getpid()}").touch()
+        deadline = time.monotonic() + 5
+        while len(list(self.crash_marker.parent.glob(f"{context}-*"))) < 2:
+            if time.monotonic() > deadline:
+                raise InvalidToolCallException(f"Nobody else evaluated {context}")
+            time.sleep(0.01)
+
+
+@pytest.fixture
+def pool(tmp_path):
+    crash_marker = tmp_path / "crashed"
+
+    def factory(device: str, settings: Optional[Settings]):
+        return FakeEvaluator(device, crash_marker)
+
+    pool = EvaluatorPool(
+        ["cpu:0", "cpu:1"],
+        evaluator_factory=factory,
+        chunk_size=2,
+        start_method="fork",
+    )
+    yield pool
+    pool.close()
+
+
+def test_pool_shards_and_merges_in_order(pool):
+    contexts = ["c" * i for i in range(1, 10)]
+    results = pool.context_relevance("query", contexts)
+    assert [r.score for r in results] == [len(c) % 6 for c in contexts]
+
+    items = [(f"q{i}", "a" * i, ["c"] * (i % 3)) for i in range(7)]
+    results = pool.evaluate_rag_batch(items)
+    assert [ar.score for ar, _, _ in results] == [i % 6 for i in range(7)]
+    assert [len(cr) for _, cr, _ in results] == [i % 3 for i in range(7)]
+    # Both workers took part
+    assert {ar.reason.split(":")[1] for ar, _, _ in results} == {"0", "1"}
+    assert len({ar.reason for ar, _, _ in results}) == 2
+
+    answer_relevance, context_relevance, groundedness = pool.evaluate_rag(
+        "q", "aaa", ["cc"]
+    )
+    assert answer_relevance.score == 3
+    assert [cr.score for cr in context_relevance] == [2]
+    assert pool.groundedness("a", []) == []
+
+
+def test_pool_worker_crash(pool):
+    contexts = ["c", "crash", "ccc", "cccc", "ccccc"]
+    results = pool.context_relevance("query", contexts)
+    # The task of the crashed worker is run again by a new worker
+    assert [r.score for r in results] == [1, 5, 3, 4, 5]
+    assert pool.restarts == 1
+
+    with pytest.raises(ModelException, match="crashed 3 workers"):
+        pool.context_relevance("query", ["always crash"])
+    assert pool.restarts == 4
+
+    # Errors are raised to the caller and the pool keeps working
+    with pytest.raises(InvalidToolCallException):
+        pool.context_relevance("query", ["c", "fail", "c", "c"])
+    assert [r.score for r in pool.context_relevance("query", ["cc"])] == [2]
+
+
+def test_pool_factory_error():
+    def factory(device: str, settings: Optional[Settings]):
+        raise RuntimeError("No such device")
+
+    with EvaluatorPool(["gpu"], evaluator_factory=factory, start_method="fork") as pool:
+        with pytest.raises(ModelException, match="could not create its evaluator"):
+            pool.answer_relevance("q", "a")
+    with pytest.raises(ModelException, match="closed"):
+        pool.answer_relevance("q", "a")
+
+
+def test_pool_worker_settings(pool):
+    from nuclia_eval.models.cpu import default_cpu_threads
+
+    # The CPU workers share the cores
+    threads = pool._worker_settings("cpu:1").cpu_threads
+    assert threads == max(1, default_cpu_threads() // 2)
+    pool.settings = Settings(cpu_threads=3, dtype="bfloat16")
+    assert pool._worker_settings("cpu") == pool.settings
+    pool.settings = Settings(dtype="bfloat16")
+    assert pool._worker_settings("cpu").dtype == "bfloat16"
+    assert pool._worker_settings("cuda:0") is pool.settings
+
+
+def test_pool_fans_out_one_request(pool):
+    # The two chunks of contexts can only meet if they run on both workers at once
+    answer_relevance, context_relevance, groundedness = pool.evaluate_rag(
+        "q", "aa", ["meet one", "c", "meet one"]
+    )
+    assert answer_relevance.score == 2
+    assert [cr.score for cr in context_relevance] == [2, 1, 2]
+    assert len(groundedness) == 3
+
+
+def test_pool_concurrent_callers(pool):
+    results = []
+
+    def call():
+        results.append(pool.context_relevance("q", ["meet two"]))
+
+    threads = [threading.Thread(target=call) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    assert [[r.score for r in result] for result in results] == [[2], [2]]
+
+
+def test_pool_idle_worker_killed(pool):
+    assert pool.answer_relevance("q", "a").score == 1
+    # The dispatcher may restart the worker before the test waits for it
+    process = pool._processes[0]
+    os.kill(process.pid, signal.SIGKILL)
+    process.join()
+    assert [r.score for r in pool.context_relevance("q", ["c"] * 6)] == [1] * 6
+    assert pool.restarts == 1
+
+
+def test_pool_worker_startup_crash(tmp_path):
+    def factory(device: str, settings: Optional[Settings]):
+        if device == "broken":
+            os._exit(1)
+        return FakeEvaluator(device, tmp_path / "crashed")
+
+    # The broken device is given up and the other worker takes all the tasks
+    with EvaluatorPool(
+        ["broken", "cpu:0"], evaluator_factory=factory, start_method="fork"
+    ) as pool:
+        assert [r.score for r in pool.context_relevance("q", ["cc"] * 20)] == [2] * 20
+        deadline = time.monotonic() + 10
+        while 0 in pool._processes and time.monotonic() < deadline:
+            time.sleep(0.05)
+        assert pool.restarts == 2
+        assert list(pool._processes) == [1]
+
+    with EvaluatorPool(
+        ["broken"], evaluator_factory=factory, start_method="fork"
+    ) as pool:
+        with pytest.raises(ModelException, match="died 3 times"):
+            pool.answer_relevance("q", "a")
+        with pytest.raises(ModelException, match="died 3 times"):
+            pool.answer_relevance("q", "a")
@@ -0,0 +1,65 @@
+import random
+from unittest.mock import patch
+
+import pytest
+from mistral_common.protocol.instruct.messages import SystemMessage
+from mistral_common.protocol.instruct.tool_calls import Tool
+from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
+
+from nuclia_eval.metrics import AnswerRelevance, ContextRelevance, Groundedness
+from nuclia_eval.models.prompts import PromptEncoder
+
+SYSTEM_MESSAGE = SystemMessage(content="You are an AI that computes {metrics}.")
+
+
+@pytest.fixture(scope="module")
+def tokenizer():
+    return MistralTokenizer.v3()
+
+
+@pytest.mark.parametrize("metric", [AnswerRelevance, ContextRelevance, Groundedness])
+def test_prompt_encoder_matches_full_encoding(tokenizer, metric):
+    encoder = PromptEncoder(tokenizer, SYSTEM_MESSAGE)
+    tool = Tool.model_validate(metric.tool)
+    assert encoder.get_template(metric, tool) is not None
+
+    rng = random.Random(0)
+    alphabet = "ab c\n\t  .,{}\"'`éü日🙂-_:"
+    for _ in range(100):
+        fields = {
+            name: "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 30)))
+            for name in ("query", "answer", "context")
+        }
+        assert encoder.encode(metric, tool, fields) == encoder.encode_chat_completion(
+            metric, tool, fields
+        )
+
+
+def test_prompt_encoder_shares_lines_between_metrics(tokenizer):
+    encoder = PromptEncoder(tokenizer, SYSTEM_MESSAGE, cache_size=8)
+    groundedness = Tool.model_validate(Groundedness.tool)
+    context_relevance = Tool.model_validate(ContextRelevance.tool)
+    encoder.encode(Groundedness, groundedness, {"answer": "a", "context": "x"})
+    encoder.encode(ContextRelevance, context_relevance, {"query": "q", "context": "x"})
+
+    raw_tokenizer = tokenizer.instruct_tokenizer.tokenizer
+    with patch.object(raw_tokenizer, "encode", wraps=raw_tokenizer.encode) as encode:
+        encoder.encode(Groundedness, groundedness, {"answer": "a", "context": "ctx"})
+        encoder.encode(
+            ContextRelevance, context_relevance, {"query": "q", "context": "ctx"}
+        )
+    # The context is tokenized by the first metric only, the other lines were already cached
+    assert [c.args[0] for c in encode.call_args_list] == ["\nctx"]
+    assert len(encoder._lines) <= 8
+
+
+def test_prompt_encoder_falls_back_to_full_encoding(tokenizer):
+    encoder = PromptEncoder(tokenizer, SYSTEM_MESSAGE)
+    tool = Tool.model_validate(Groundedness.tool)
+    fields = {"answer": "a", "context": "b"}
+    # A segment tokenized differently than in the full prompt fails the check
+    with patch.object(encoder, "_tokenize_line", return_value=[1]):
+        assert encoder.get_template(Groundedness, tool) is None
+        assert encoder.encode(Groundedness, tool, fields) == (
+            encoder.encode_chat_completion(Groundedness, tool, fields)
+        )
@@ -1,18 +1,52 @@
 import os
+import threading
 from time import monotonic
 from unittest.mock import ANY, MagicMock, call, patch
 
 import pytest
+import torch
+from mistral_common.protocol.instruct.tool_calls import Tool
+from mistral_common.tokens.tokenizers.mistral import MistralTokenizer
 
 from nuclia_eval import REMi
-from nuclia_eval.exceptions import InvalidToolCallException
+from nuclia_eval.exceptions import (
+    InvalidToolCallException,
+    ModelCacheException,
+    ModelNotReadyException,
+    PromptTooLongException,
+)
+from nuclia_eval.instrumentation import CallStats
+from nuclia_eval.metrics import ContextRelevance, Groundedness
+from nuclia_eval.metrics.base import (
+    DiscreteScoreDistributionResponse,
+    InvalidToolCallResponse,
+)
 from nuclia_eval.settings import Settings
 
 MANUAL_TEST = os.getenv("MANUAL_TEST", False)
 
 
+def fake_generate(out_tokens: list[int]):
+    """Returns a side effect for the generate mock that outputs the same tokens for every prompt"""
+
+    def _generate(encoded_prompts, *args, **kwargs):
+        return [list(out_tokens) for _ in encoded_prompts]
+
+    return _generate
+
+
+def fake_snapshot_download(repo_id, local_dir, allow_patterns=None):
+    """Side effect for the snapshot_download mock that writes empty model files"""
+    for name in ("params.json", "consolidated.safetensors", "tokenizer.model.v3"):
+        (local_dir / name).write_text("")
+    (local_dir / "lora.safetensors").write_text("")
+
+
 @patch("nuclia_eval.models.remi.generate")
-@patch("nuclia_eval.models.remi.snapshot_download")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
 @patch("nuclia_eval.models.remi.load_lora_low_mem")
 @patch("nuclia_eval.models.remi.Transformer")
 @patch("nuclia_eval.models.remi.MistralTokenizer")
@@ -22,6 +56,7 @@ def test_REMi_evaluator_mock(
     lora_load_mock: MagicMock,
     snapshot_download_mock: MagicMock,
     generate_mock: MagicMock,
+    tmp_path,
 ):
     # Setup mocks
     snapshot_download_mock.return_value = None
@@ -33,15 +68,17 @@ def test_REMi_evaluator_mock(
 
     # Create custom settings
     settings = Settings(
-        nuclia_model_cache="my_cache/",
+        nuclia_model_cache=str(tmp_path),
     )
     # Run code
     evaluator = REMi(settings=settings, device="my_device")
     # Check evaluator variables are properly set
     assert evaluator.settings == settings
-    # Check that the paths start with the cache path
-    assert evaluator._base_model_path.match(settings.nuclia_model_cache + "*")
-    assert evaluator._adapter_model_path.match(settings.nuclia_model_cache + "*")
+    # Check that the models are published in the cache path
+    assert evaluator._base_model_path == tmp_path / "Mistral-7B-Instruct-v0.3"
+    assert evaluator._adapter_model_path == tmp_path / "REMi-v0"
+    assert (evaluator._base_model_path / ".nuclia-manifest.json").is_file()
+    assert "model_cache" in evaluator.startup_seconds
 
     # Check mock calls
     # 2 Downloads should have been made, one for the base model and one for the adapter model
@@ -50,11 +87,12 @@ def test_REMi_evaluator_mock(
             call(
                 repo_id="mistralai/Mistral-7B-Instruct-v0.3",
                 allow_patterns=ANY,
-                local_dir=evaluator._base_model_path,
+                local_dir=ANY,
             ),
             call(
                 repo_id="nuclia/REMi-v0",
-                local_dir=evaluator._adapter_model_path,
+                allow_patterns=None,
+                local_dir=ANY,
             ),
         ],
         any_order=True,
@@ -65,15 +103,16 @@ def test_REMi_evaluator_mock(
     transformer_mock.from_folder.assert_called_once()
     # Check that Lora was loaded
     lora_load_mock.assert_called_once()
-    # Check that the model was moved to the device
-    fake_model.to.assert_called_once_with("my_device")
+    # Check that the model was loaded straight onto the device
+    assert transformer_mock.from_folder.call_args.kwargs["device"] == "my_device"
+    fake_model.to.assert_not_called()
 
     # Now load one with default settings
     evaluator = REMi()
 
     # Configure mocks for a rag_evaluation call
     tokenizer_mock.encode_chat_completion.return_value = [1, 2, 3]
-    generate_mock.return_value = ([[5, 123, 123]], [[0.1, 0.2, 0.3]])
+    generate_mock.side_effect = fake_generate([5, 123, 123])
     fake_tokenizer.instruct_tokenizer.tokenizer.decode.side_effect = [
         # Answer relevance
         '[{"name": "answer_relevance", "arguments": {"reason": "fake", "score": 1}}]',
@@ -94,18 +133,17 @@ def test_REMi_evaluator_mock(
     assert [g.score for g in groundednesses] == [4, 5]
 
     # Create another evaluator, so that we can check that the model is not downloaded again
-    with patch("pathlib.Path.exists", return_value=True):
-        evaluator = REMi(settings=settings, device="my_device")
-    # Check that the download calls were not made again
-    # assert len(snapshot_download_mock.mock_calls) == 2
+    snapshot_download_mock.reset_mock()
+    evaluator = REMi(settings=settings, device="my_device")
+    snapshot_download_mock.assert_not_called()
 
     # Check that we raise an error if the first token is not a tool call token
-    generate_mock.return_value = ([[123, 123]], [[0.2, 0.3]])
+    generate_mock.side_effect = fake_generate([123, 123])
     with pytest.raises(InvalidToolCallException):
         evaluator.evaluate_rag("query", "answer", ["context1", "context2"])
 
     # Check that we raise an error if the tool call generated is invalid
-    generate_mock.return_value = ([[5, 123, 123]], [[0.1, 0.2, 0.3]])
+    generate_mock.side_effect = fake_generate([5, 123, 123])
     fake_tokenizer.instruct_tokenizer.tokenizer.decode.side_effect = [
         # Answer relevance with a parameter naming error
         '[{"name": "answer_relevance", "arguments": {"reasoning": "fake", "score": 1}}]',
@@ -114,12 +152,12 @@ def test_REMi_evaluator_mock(
         evaluator.evaluate_rag("query", "answer", ["context1", "context2"])
 
     # Check that we raise an error if no output is generated
-    generate_mock.return_value = ([], [])
+    generate_mock.side_effect = lambda prompts, *args, **kwargs: []
     with pytest.raises(InvalidToolCallException):
         evaluator.evaluate_rag("query", "answer", ["context1", "context2"])
 
     # Check that we raise an error if the tool name is not the expected one
-    generate_mock.return_value = ([[5, 123, 123]], [[0.1, 0.2, 0.3]])
+    generate_mock.side_effect = fake_generate([5, 123, 123])
     fake_tokenizer.instruct_tokenizer.tokenizer.decode.side_effect = [
         # Answer relevance but with a different name
         '[{"name": "answer_rel", "arguments": {"reason": "fake", "score": 1}}]',
@@ -128,6 +166,787 @@ def test_REMi_evaluator_mock(
         evaluator.evaluate_rag("query", "answer", ["context1", "context2"])
 
 
+@patch("nuclia_eval.models.remi.generate")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_batching_mock(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    generate_mock: MagicMock,
+):
+    fake_tokenizer = MagicMock()
+    tokenizer_mock.from_file.return_value = fake_tokenizer
+    fake_tokenizer.encode_chat_completion.side_effect = lambda request: MagicMock(
+        tokens=[len(request.messages[-1].content)]
+    )
+    generate_mock.side_effect = fake_generate([5, 123, 123])
+    fake_tokenizer.instruct_tokenizer.tokenizer.decode.side_effect = [
+        f'[{{"name": "context_relevance", "arguments": {{"score": {score}}}}}]'
+        for score in [0, 1, 2, 3, 4]
+    ]
+
+    evaluator = REMi(settings=Settings(max_batch_size=2))
+    # The model must be able to hold the configured batch size
+    assert transformer_mock.from_folder.call_args.kwargs["max_batch_size"] == 2
+
+    contexts = ["c", "cc", "ccc", "cccc", "ccccc"]
+    context_relevances = evaluator.context_relevance("query", contexts)
+
+    # Results are returned in input order
+    assert [cr.score for cr in context_relevances] == [0, 1, 2, 3, 4]
+    # 5 prompts with a batch size of 2 are decoded in 3 generation calls
+    batch_sizes = [len(c.args[0]) for c in generate_mock.call_args_list]
+    assert batch_sizes == [2, 2, 1]
+    # The prompts are sent in input order
+    prompt_lengths = [p[0] for c in generate_mock.call_args_list for p in c.args[0]]
+    assert prompt_lengths == sorted(prompt_lengths)
+
+
+@patch("nuclia_eval.models.remi.generate")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_rag_batch_mock(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    generate_mock: MagicMock,
+):
+    fake_tokenizer = MagicMock()
+    tokenizer_mock.from_file.return_value = fake_tokenizer
+    generate_mock.side_effect = fake_generate([5, 123, 123])
+    fake_tokenizer.instruct_tokenizer.tokenizer.decode.side_effect = [
+        '[{"name": "answer_relevance", "arguments": {"reason": "r1", "score": 1}}]',
+        '[{"name": "answer_relevance", "arguments": {"reason": "r2", "score": 2}}]',
+        '[{"name": "context_relevance", "arguments": {"score": 3}}]',
+        '[{"name": "context_relevance", "arguments": {"score": 4}}]',
+        '[{"name": "context_relevance", "arguments": {"score": 5}}]',
+        '[{"name": "groundedness", "arguments": {"score": 0}}]',
+        '[{"name": "groundedness", "arguments": {"score": 1}}]',
+        '[{"name": "groundedness", "arguments": {"score": 2}}]',
+    ]
+
+    evaluator = REMi()
+    results = evaluator.evaluate_rag_batch(
+        [("q1", "a1", ["c1", "c2"]), ("q2", "a2", ["c3"])]
+    )
+    # The prompts of each metric are decoded together for all the items
+    assert [len(c.args[0]) for c in generate_mock.call_args_list] == [2, 3, 3]
+    (ar1, cr1, g1), (ar2, cr2, g2) = results
+    assert (ar1.reason, ar2.reason) == ("r1", "r2")
+    assert [cr.score for cr in cr1] == [3, 4] and [cr.score for cr in cr2] == [5]
+    assert [g.score for g in g1] == [0, 1] and [g.score for g in g2] == [2]
+
+
+@patch("nuclia_eval.models.remi.generate")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_callbacks_mock(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    generate_mock: MagicMock,
+):
+    fake_tokenizer = MagicMock()
+    tokenizer_mock.from_file.return_value = fake_tokenizer
+    fake_tokenizer.encode_chat_completion.side_effect = lambda request: MagicMock(
+        tokens=[1] * len(request.messages[-1].content)
+    )
+    generate_mock.side_effect = fake_generate([5, 123, 123])
+    decode_mock = fake_tokenizer.instruct_tokenizer.tokenizer.decode
+    decode_mock.side_effect = lambda tokens: (
+        '[{"name": "context_relevance", "arguments": {"score": 3}}]'
+    )
+
+    received: list[CallStats] = []
+    evaluator = REMi(settings=Settings(max_batch_size=2), callbacks=[received.append])
+    assert received[0].operation == "load"
+    assert received[0].stages.keys() == evaluator.startup_seconds.keys() - {"total"}
+
+    evaluator.context_relevance("q", ["c1", "c2", "c3"])
+    stats = received[-1]
+    assert stats.operation == "evaluate"
+    assert stats.prompts == {"context_relevance": 3}
+    assert stats.batch_sizes == [2, 1]
+    assert stats.generated_tokens == 9
+    assert stats.prompt_tokens > 0
+    assert {"tokenize", "parse"} <= stats.stages.keys()
+    assert stats.seconds >= sum(stats.stages.values())
+    assert stats.error is None
+
+    # Parse failures are counted and the error is reported
+    decode_mock.side_effect = lambda tokens: "not a tool call"
+    with pytest.raises(InvalidToolCallException):
+        evaluator.context_relevance("q", ["c1"])
+    assert received[-1].parse_failures == 1
+    assert received[-1].error == "InvalidToolCallException"
+
+    # Callbacks can also be added once the evaluator is loaded
+    evaluator.callbacks.clear()
+    callback = MagicMock()
+    evaluator.add_callback(callback)
+    decode_mock.side_effect = lambda tokens: (
+        '[{"name": "context_relevance", "arguments": {"score": 3}}]'
+    )
+    evaluator.context_relevance("q", ["c1"])
+    callback.assert_called_once()
+    assert evaluator._call_stats is None
+
+
+@patch("nuclia_eval.models.remi.generate")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_tool_call_recovery_mock(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    generate_mock: MagicMock,
+):
+    fake_tokenizer = MagicMock()
+    tokenizer_mock.from_file.return_value = fake_tokenizer
+    # The prompt tells whether its context is the bad one
+    fake_tokenizer.encode_chat_completion.side_effect = lambda request: MagicMock(
+        tokens=[int("bad" in request.messages[-1].content)]
+    )
+    generate_mock.side_effect = lambda prompts, *args, constraints=None, **kwargs: [
+        [5, prompt[0], int(constraints is not None)] for prompt in prompts
+    ]
+    bad_text = "I can not score this"
+
+    def _decode(tokens):
+        _, bad, constrained = tokens
+        if bad and not constrained:
+            return bad_text
+        return '[{"name": "context_relevance", "arguments": {"score": 3}}]'
+
+    fake_tokenizer.instruct_tokenizer.tokenizer.decode.side_effect = _decode
+    contexts = ["c1", "bad", "c2"]
+
+    # Invalid tool calls fail the whole call by default
+    with pytest.raises(InvalidToolCallException):
+        REMi().context_relevance("q", contexts)
+
+    # Or are reported in place of their result
+    results = REMi(settings=Settings(on_invalid_tool_call="report")).context_relevance(
+        "q", contexts
+    )
+    assert [r.score for r in results[::2]] == [3, 3]
+    assert isinstance(results[1], InvalidToolCallResponse)
+    assert results[1].output == bad_text
+
+    # The score is salvaged from the generated text
+    bad_text = '[{"name": "context_relevance", "arguments": {"score": 4'
+    results = REMi(settings=Settings(tool_call_recovery="repair")).context_relevance(
+        "q", contexts
+    )
+    assert [(r.score, r.recovery) for r in results] == [
+        (3, None),
+        (4, "repaired"),
+        (3, None),
+    ]
+
+    # Or only the failed prompt is decoded again with constrained decoding
+    bad_text = "I can not score this"
+    generate_mock.reset_mock()
+    received: list[CallStats] = []
+    evaluator = REMi(
+        settings=Settings(tool_call_recovery="regenerate"), callbacks=[received.append]
+    )
+    with patch.object(evaluator, "_new_constraint", return_value=MagicMock()):
+        results = evaluator.context_relevance("q", contexts)
+    assert [(r.score, r.recovery) for r in results] == [
+        (3, None),
+        (3, "regenerated"),
+        (3, None),
+    ]
+    assert [len(c.args[0]) for c in generate_mock.call_args_list] == [3, 1]
+    assert received[-1].parse_failures == 1
+    assert received[-1].recovered == 1
+
+
+@patch("nuclia_eval.models.remi.generate")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_result_cache_mock(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    generate_mock: MagicMock,
+    tmp_path,
+):
+    fake_tokenizer = MagicMock()
+    tokenizer_mock.from_file.return_value = fake_tokenizer
+    fake_tokenizer.encode_chat_completion.side_effect = lambda request: MagicMock(
+        tokens=[len(request.messages[-1].content)]
+    )
+    generate_mock.side_effect = fake_generate([5, 123, 123])
+    decode_mock = fake_tokenizer.instruct_tokenizer.tokenizer.decode
+    decode_mock.side_effect = lambda tokens: (
+        '[{"name": "context_relevance", "arguments": {"score": 3}}]'
+    )
+
+    settings = Settings(result_cache_path=str(tmp_path / "results.sqlite"))
+    evaluator = REMi(settings=settings)
+    assert [cr.score for cr in evaluator.context_relevance("q", ["c1", "c2"])] == [3, 3]
+    assert evaluator.result_cache is not None
+    assert evaluator.result_cache.stats()["misses"] == 2
+
+    # Only the new context goes through the model, also from a new evaluator
+    generate_mock.reset_mock()
+    evaluator = REMi(settings=settings)
+    results = evaluator.context_relevance("q", ["c1", "c3", "c2"])
+    assert [cr.score for cr in results] == [3, 3, 3]
+    assert [len(c.args[0]) for c in generate_mock.call_args_list] == [1]
+    assert evaluator.result_cache is not None
+    assert evaluator.result_cache.stats()["hits"] == 2
+
+    # Results depend on the metric, the decoding and the precision of the model
+    generate_mock.reset_mock()
+    decode_mock.side_effect = lambda tokens: (
+        '[{"name": "groundedness", "arguments": {"score": 1}}]'
+    )
+    assert evaluator.groundedness("q", ["c1"])[0].score == 1
+    assert generate_mock.call_count == 1
+    evaluator = REMi(
+        settings=Settings(
+            result_cache_path=settings.result_cache_path, constrained_decoding=True
+        )
+    )
+    evaluator.groundedness("q", ["c1"])
+    assert generate_mock.call_count == 2
+    for update in ({"dtype": "bfloat16"}, {"tool_call_recovery": "repair"}):
+        REMi(settings=settings.model_copy(update=update)).groundedness("q", ["c1"])
+    assert generate_mock.call_count == 4
+
+    # Disabled by default
+    assert REMi().result_cache is None
+
+
+@patch("nuclia_eval.models.remi.generate")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_prefilter_mock(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    generate_mock: MagicMock,
+):
+    fake_tokenizer = MagicMock()
+    tokenizer_mock.from_file.return_value = fake_tokenizer
+    fake_tokenizer.encode_chat_completion.return_value = MagicMock(tokens=[1, 2])
+    generate_mock.side_effect = fake_generate([5, 123, 123])
+    decode_mock = fake_tokenizer.instruct_tokenizer.tokenizer.decode
+    decode_mock.side_effect = lambda tokens: (
+        '[{"name": "groundedness", "arguments": {"score": 4}}]'
+    )
+
+    received: list[CallStats] = []
+    evaluator = REMi(
+        settings=Settings(prefilter_threshold=0.1), callbacks=[received.append]
+    )
+    contexts = ["Paris is the capital of France", "Bananas are yellow"]
+    results = evaluator.groundedness("The capital of France is Paris", contexts)
+    assert [g.score for g in results] == [4, 0]
+    assert results[0].prefilter_score is None
+    assert results[1].prefilter_score == 0
+    # Only the overlapping context goes through the model
+    assert [len(c.args[0]) for c in generate_mock.call_args_list] == [1]
+    assert received[-1].prefiltered == 1
+    assert "prefilter" in received[-1].stages
+
+    # Every context is skipped without calling the model
+    generate_mock.reset_mock()
+    assert [g.score for g in evaluator.groundedness("Yes", contexts)] == [0, 0]
+    generate_mock.assert_not_called()
+
+    # Score distributions are certain of the 0
+    evaluator = REMi(
+        settings=Settings(prefilter_threshold=0.1, score_mode="logits"),
+    )
+    result = evaluator.context_relevance("Who?", ["Bananas are yellow"])[0]
+    assert (result.score, result.expected_score) == (0, 0)
+    assert result.probabilities == [1, 0, 0, 0, 0, 0]
+
+    # Disabled by default
+    generate_mock.reset_mock()
+    evaluator = REMi()
+    assert [g.score for g in evaluator.groundedness("Yes", contexts)] == [4, 4]
+
+
+@patch("nuclia_eval.models.remi.generate")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_deduplication_mock(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    generate_mock: MagicMock,
+):
+    fake_tokenizer = MagicMock()
+    tokenizer_mock.from_file.return_value = fake_tokenizer
+    fake_tokenizer.encode_chat_completion.side_effect = lambda request: MagicMock(
+        tokens=[len(request.messages[-1].content)]
+    )
+    generate_mock.side_effect = fake_generate([5, 123, 123])
+    decode_mock = fake_tokenizer.instruct_tokenizer.tokenizer.decode
+    decode_mock.side_effect = lambda tokens: (
+        '[{"name": "context_relevance", "arguments": {"score": 3}}]'
+    )
+
+    received: list[CallStats] = []
+    evaluator = REMi(callbacks=[received.append])
+    results = evaluator.context_relevance("q", ["c1", "c2", "c1", "c1"])
+    assert [cr.score for cr in results] == [3, 3, 3, 3]
+    # Repeated contexts go through the model once, and each gets its own result
+    assert [len(c.args[0]) for c in generate_mock.call_args_list] == [2]
+    assert len({id(cr) for cr in results}) == 4
+    assert received[-1].deduplicated == 2
+    assert received[-1].prompts == {"context_relevance": 4}
+
+    # Whitespace and unicode variants only match when normalizing
+    generate_mock.reset_mock()
+    contexts = ["a  b", "a b\n", "\uff41 b"]
+    evaluator.context_relevance("q", contexts)
+    assert [len(c.args[0]) for c in generate_mock.call_args_list] == [3]
+    evaluator = REMi(settings=Settings(deduplication="normalized"))
+    generate_mock.reset_mock()
+    evaluator.context_relevance("q", contexts)
+    assert [len(c.args[0]) for c in generate_mock.call_args_list] == [1]
+
+    # Across calls only with the in memory cache of results
+    generate_mock.reset_mock()
+    evaluator.context_relevance("q", ["a b"])
+    assert generate_mock.call_count == 1
+    evaluator = REMi(settings=Settings(dedup_cache_size=2))
+    generate_mock.reset_mock()
+    evaluator.context_relevance("q", ["c1", "c2"])
+    evaluator.context_relevance("q", ["c2", "c3"])
+    evaluator.context_relevance("q2", ["c2"])
+    assert [len(c.args[0]) for c in generate_mock.call_args_list] == [2, 1, 1]
+
+    # Everything is evaluated when disabled
+    evaluator = REMi(settings=Settings(deduplication="off"))
+    generate_mock.reset_mock()
+    evaluator.context_relevance("q", ["c1", "c1"])
+    assert [len(c.args[0]) for c in generate_mock.call_args_list] == [2]
+
+
+@patch("nuclia_eval.models.remi.generate")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_prefix_cache_mock(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    generate_mock: MagicMock,
+):
+    tokenizer = MistralTokenizer.v3()
+    tokenizer_mock.from_file.return_value = tokenizer
+    raw_tokenizer = tokenizer.instruct_tokenizer.tokenizer
+    generate_mock.side_effect = fake_generate(
+        [5]
+        + raw_tokenizer.encode(
+            '[{"name": "groundedness", "arguments": {"score": 4}}]',
+            bos=False,
+            eos=False,
+        )
+    )
+
+    # Disabled by default
+    evaluator = REMi()
+    evaluator.groundedness("answer", ["context1", "context2"])
+    assert generate_mock.call_args.kwargs["prefix_cache"] is None
+
+    evaluator = REMi(settings=Settings(prefix_cache_max_bytes=1 << 30))
+    static_length = evaluator._get_prefix_length(Groundedness)
+    prompts = [
+        evaluator._encode_chat_completion(
+            [
+                evaluator._get_system_message(),
+                evaluator._get_metric_message(Groundedness, answer=a, context=c),
+            ],
+            Tool.model_validate(Groundedness.tool),
+        )
+        for a, c in [("one", "two"), ("three", "four")]
+    ]
+    # The static prefix is shared by any two requests, and ends before the answer
+    assert prompts[0][:static_length] == prompts[1][:static_length]
+    assert prompts[0][static_length] != prompts[1][static_length]
+    assert raw_tokenizer.decode(prompts[0][:static_length]).endswith(
+        'STATEMENT: \n```\n"""\n'
+    )
+
+    # A single context only uses the static prefix
+    evaluator.groundedness("the answer", ["context1"])
+    assert generate_mock.call_args.kwargs["prefix_cache"] is evaluator._prefix_cache
+    assert generate_mock.call_args.kwargs["prefix_length"] == static_length
+
+    # With several contexts the answer is part of the shared prefix
+    result = evaluator.groundedness("the answer", ["context1", "context2"])
+    assert [g.score for g in result] == [4, 4]
+    prefix_length = generate_mock.call_args.kwargs["prefix_length"]
+    prompt = generate_mock.call_args.args[0][0]
+    assert prefix_length > static_length
+    assert "the answer" in raw_tokenizer.decode(prompt[:prefix_length])
+    assert "context1" not in raw_tokenizer.decode(prompt[:prefix_length])
+
+
+@patch("nuclia_eval.models.remi.generate")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_logits_score_mode(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    generate_mock: MagicMock,
+    tiny_model,
+):
+    tokenizer = MistralTokenizer.v3()
+    tokenizer_mock.from_file.return_value = tokenizer
+    transformer_mock.from_folder.return_value = tiny_model
+
+    evaluator = REMi(settings=Settings(score_mode="logits"), device="cpu")
+    forced_tokens, score_tokens = evaluator._get_score_call_tokens(
+        Tool.model_validate(Groundedness.tool)
+    )
+    assert forced_tokens[0] == 5
+    assert (
+        tokenizer.instruct_tokenizer.tokenizer.decode(forced_tokens)
+        == '[{"name": "groundedness", "arguments": {"score": '
+    )
+    assert [
+        tokenizer.instruct_tokenizer.tokenizer.decode([t]) for t in score_tokens
+    ] == ["0", "1", "2", "3", "4", "5"]
+
+    contexts = ["context1", "context2", "context3"]
+    for results in [
+        evaluator.groundedness("answer", contexts),
+        evaluator.context_relevance("query", contexts),
+    ]:
+        assert len(results) == len(contexts)
+        for result in results:
+            assert isinstance(result, DiscreteScoreDistributionResponse)
+            assert len(result.probabilities) == 6
+            assert sum(result.probabilities) == pytest.approx(1.0)
+            assert result.score == result.probabilities.index(max(result.probabilities))
+            assert result.expected_score == pytest.approx(
+                sum(i * p for i, p in enumerate(result.probabilities))
+            )
+    # Nothing is decoded
+    generate_mock.assert_not_called()
+
+
+@patch("nuclia_eval.models.remi.generate")
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_prompt_budget_mock(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    generate_mock: MagicMock,
+):
+    tokenizer = MistralTokenizer.v3()
+    tokenizer_mock.from_file.return_value = tokenizer
+    raw_tokenizer = tokenizer.instruct_tokenizer.tokenizer
+
+    def _generate(encoded_prompts, *args, **kwargs):
+        # Chunks that mention the answer score higher
+        outputs = []
+        for prompt in encoded_prompts:
+            score = 4 if "Paris" in raw_tokenizer.decode(prompt) else 1
+            call = (
+                f'[{{"name": "context_relevance", "arguments": {{"score": {score}}}}}]'
+            )
+            outputs.append([5] + raw_tokenizer.encode(call, bos=False, eos=False))
+        return outputs
+
+    generate_mock.side_effect = _generate
+    context = "Filler text about nothing. " * 100 + "The capital is Paris."
+    evaluator = REMi(
+        settings=Settings(
+            max_prompt_tokens=700, long_input_policy="chunk", chunk_overlap_tokens=16
+        )
+    )
+    short, long = evaluator.context_relevance("Capital?", ["Paris", context])
+    assert short.score == 4
+    assert short.prompt_budget is None
+    assert long.score == 4
+    assert long.prompt_budget is not None
+    assert long.prompt_budget.policy == "chunk"
+    assert long.prompt_budget.chunk_scores == [1, 1, 4]
+    prompts = [p for c in generate_mock.call_args_list for p in c.args[0]]
+    assert len(prompts) == 1 + long.prompt_budget.chunks
+    assert max(len(p) for p in prompts) <= 700
+    assert (
+        "prompt_budget" not in evaluator._get_tool(ContextRelevance).model_dump_json()
+    )
+
+    evaluator = REMi(settings=Settings(max_prompt_tokens=700))
+    [result] = evaluator.context_relevance("Capital?", [context])
+    assert result.score == 1
+    assert result.prompt_budget is not None
+    assert result.prompt_budget.policy == "truncate"
+
+    evaluator = REMi(
+        settings=Settings(max_prompt_tokens=700, long_input_policy="reject")
+    )
+    with pytest.raises(PromptTooLongException):
+        evaluator.context_relevance("Capital?", [context])
+
+
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.load_lora_low_mem")
+@patch("nuclia_eval.models.remi.Transformer")
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_continuous_batching(
+    tokenizer_mock: MagicMock,
+    transformer_mock: MagicMock,
+    lora_load_mock: MagicMock,
+    snapshot_download_mock: MagicMock,
+    tiny_model,
+):
+    tokenizer_mock.from_file.return_value = MistralTokenizer.v3()
+    transformer_mock.from_folder.return_value = tiny_model
+    contexts = ["context1", "context2", "context3"]
+
+    # The random model only generates valid tool calls with constrained decoding
+    static = REMi(
+        settings=Settings(constrained_decoding=True, max_batch_size=2), device="cpu"
+    )
+    expected = static.context_relevance("query", contexts)
+    assert static.engine is None
+
+    evaluator = REMi(
+        settings=Settings(
+            constrained_decoding=True, continuous_batching=True, max_batch_size=2
+        ),
+        device="cpu",
+    )
+    assert evaluator.context_relevance("query", contexts) == expected
+    assert evaluator.engine is not None
+    assert evaluator.engine.stats.finished == 3
+
+    # Prompts that do not fit in the engine are decoded on their own
+    evaluator = REMi(
+        settings=Settings(
+            constrained_decoding=True, continuous_batching=True, engine_max_seq_len=64
+        ),
+        device="cpu",
+    )
+    assert evaluator.context_relevance("query", contexts) == expected
+    assert evaluator.engine is not None
+    assert evaluator.engine.stats.finished == 0
+
+
+def _write_tiny_model_cache(cache_path):
+    """Writes a tiny base model and a REMi adapter for it to a model cache"""
+    import json
+
+    import safetensors.torch
+    import torch
+    from mistral_inference.args import TransformerArgs
+    from mistral_inference.transformer import Transformer
+
+    torch.manual_seed(0)
+    params = dict(
+        dim=16,
+        n_layers=2,
+        head_dim=4,
+        hidden_dim=32,
+        n_heads=4,
+        n_kv_heads=2,
+        norm_eps=1e-5,
+        vocab_size=64,
+    )
+    model = Transformer(TransformerArgs(**params)).to(torch.float16)
+    base_path = cache_path / "Mistral-7B-Instruct-v0.3"
+    adapter_path = cache_path / "REMi-v0"
+    base_path.mkdir(parents=True)
+    adapter_path.mkdir(parents=True)
+    # The tokenizer is mocked, but the model cache expects its file
+    (base_path / "tokenizer.model.v3").write_text("")
+    (base_path / "params.json").write_text(json.dumps(params))
+    safetensors.torch.save_file(
+        {k: v.contiguous() for k, v in model.state_dict().items()},
+        base_path / "consolidated.safetensors",
+    )
+    lora = {}
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.Linear) and name != "output":
+            lora[f"{name}.lora_A.weight"] = torch.randn(2, module.in_features).half()
+            lora[f"{name}.lora_B.weight"] = torch.randn(module.out_features, 2).half()
+    safetensors.torch.save_file(lora, adapter_path / "lora.safetensors")
+
+
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_merged_checkpoint(
+    tokenizer_mock: MagicMock, snapshot_download_mock: MagicMock, tmp_path
+):
+    _write_tiny_model_cache(tmp_path)
+    settings = Settings(nuclia_model_cache=str(tmp_path), merged_checkpoint="bake")
+    # The first evaluator merges the adapter and bakes the merged checkpoint
+    merged = REMi(settings=settings, device="cpu")
+    snapshot_download_mock.assert_not_called()
+    assert "adapter_merge" in merged.startup_seconds
+    assert "bake" in merged.startup_seconds
+    baked = list((tmp_path / "REMi-v0-merged").glob("*.safetensors"))
+    assert len(baked) == 1
+    assert merged.bake_merged_checkpoint() == baked[0]
+
+    # The next ones load it, with the same weights
+    settings = Settings(nuclia_model_cache=str(tmp_path))
+    with patch("nuclia_eval.models.remi.load_lora_low_mem") as lora_load_mock:
+        loaded = REMi(settings=settings, device="cpu")
+    lora_load_mock.assert_not_called()
+    assert "merged_model" in loaded.startup_seconds
+    assert loaded.model.dtype == torch.float16
+    expected = merged.model.state_dict()
+    for name, tensor in loaded.model.state_dict().items():
+        assert torch.equal(tensor, expected[name]), name
+
+    # Merging is not skipped if disabled
+    with patch("nuclia_eval.models.remi.load_lora_low_mem") as lora_load_mock:
+        REMi(
+            settings=Settings(
+                nuclia_model_cache=str(tmp_path), merged_checkpoint="off"
+            ),
+            device="cpu",
+        )
+    lora_load_mock.assert_called_once()
+
+    # Nor if the adapter changed, and baking a new version removes the stale one
+    adapter = tmp_path / "REMi-v0" / "lora.safetensors"
+    os.utime(adapter, ns=(0, 0))
+    with patch("nuclia_eval.models.remi.load_lora_low_mem") as lora_load_mock:
+        changed = REMi(settings=settings, device="cpu")
+    lora_load_mock.assert_called_once()
+    new_path = changed.bake_merged_checkpoint()
+    assert new_path != baked[0]
+    assert list((tmp_path / "REMi-v0-merged").glob("*.safetensors")) == [new_path]
+
+
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_cpu_precision(
+    tokenizer_mock: MagicMock, snapshot_download_mock: MagicMock, tmp_path
+):
+    _write_tiny_model_cache(tmp_path)
+    threads = torch.get_num_threads()
+    try:
+        settings = Settings(nuclia_model_cache=str(tmp_path), cpu_threads=1)
+        evaluator = REMi(
+            settings=settings.model_copy(update={"dtype": "bfloat16"}), device="cpu"
+        )
+        assert evaluator.model.dtype == torch.bfloat16
+        assert "convert" in evaluator.startup_seconds
+        assert torch.get_num_threads() == 1
+        # The merged checkpoint is only baked in float16
+        with pytest.raises(ValueError):
+            evaluator.bake_merged_checkpoint()
+        REMi(settings=settings, device="cpu").bake_merged_checkpoint()
+
+        # Also from the merged checkpoint
+        evaluator = REMi(
+            settings=settings.model_copy(update={"quantization": "int8"}), device="cpu"
+        )
+        assert "merged_model" in evaluator.startup_seconds
+        assert isinstance(evaluator.model.output, torch.ao.nn.quantized.dynamic.Linear)
+        assert evaluator.model.dtype == torch.float32
+
+        with pytest.raises(ValueError):
+            REMi(settings=Settings(quantization="int8"), device="cuda")
+
+        # Baking while loading happens before the conversion
+        other_path = tmp_path / "other"
+        _write_tiny_model_cache(other_path)
+        evaluator = REMi(
+            settings=settings.model_copy(
+                update={
+                    "nuclia_model_cache": str(other_path),
+                    "merged_checkpoint": "bake",
+                    "quantization": "int8",
+                }
+            ),
+            device="cpu",
+        )
+        assert "bake" in evaluator.startup_seconds
+        assert evaluator.model.dtype == torch.float32
+        baked = list((other_path / "REMi-v0-merged").glob("*.safetensors"))
+        assert evaluator.bake_merged_checkpoint() == baked[0]
+    finally:
+        torch.set_num_threads(threads)
+
+
 @pytest.mark.skipif(
     not MANUAL_TEST,
     reason="This test requires a GPU and the downloaded models and is skipped by default.",
@@ -179,3 +998,55 @@ On the Oxygen Pro 49 and 61 the Preset button LED will be lit to show that Prese
     )  # 1
     print("Context relevances ", [cr.score for cr in context_relevances])  # [5, 1, 0]
     print("Groundedness: ", [g.score for g in groundednesses])  # [0, 2, 0]
+
+
+@patch(
+    "nuclia_eval.models.model_cache.snapshot_download",
+    side_effect=fake_snapshot_download,
+)
+@patch("nuclia_eval.models.remi.MistralTokenizer")
+def test_REMi_evaluator_background_loading(
+    tokenizer_mock: MagicMock, snapshot_download_mock: MagicMock, tmp_path
+):
+    _write_tiny_model_cache(tmp_path)
+    merging = threading.Event()
+    merged = threading.Event()
+
+    def slow_merge(model, path):
+        merging.set()
+        assert merged.wait(5)
+
+    settings = Settings(
+        nuclia_model_cache=str(tmp_path), background_loading=True, ready_timeout=0
+    )
+    with patch("nuclia_eval.models.remi.load_lora_low_mem", side_effect=slow_merge):
+        evaluator = REMi(settings=settings, device="cpu")
+        # The constructor returns while the model is loading
+        assert merging.wait(5)
+        assert not evaluator.ready
+        with pytest.raises(ModelNotReadyException):
+            evaluator.wait_ready(timeout=0)
+        with pytest.raises(ModelNotReadyException):
+            evaluator.context_relevance("q", ["c"])
+        merged.set()
+        assert evaluator.wait_ready(timeout=5) is evaluator
+    assert evaluator.ready
+    assert evaluator.ready_future.result() is evaluator
+    # The tokenizer and the adapter file are read while the base model loads
+    assert {"tokenizer", "adapter_read", "base_model", "adapter_merge"} <= set(
+        evaluator.startup_seconds
+    )
+    assert evaluator.tokenizer is tokenizer_mock.from_file.return_value
+
+    # Loading errors are raised by every call
+    settings = Settings(
+        nuclia_model_cache=str(tmp_path / "empty"),
+        background_loading=True,
+        offline=True,
+    )
+    evaluator = REMi(settings=settings, device="cpu")
+    with pytest.raises(ModelCacheException):
+        evaluator.wait_ready(timeout=5)
+    with pytest.raises(ModelCacheException):
+        evaluator.groundedness("a", ["c"])
+    assert not evaluator.ready
@@ -0,0 +1,65 @@
+import pytest
+
+from nuclia_eval.exceptions import InvalidToolCallException
+from nuclia_eval.metrics.base import DiscreteScoreReasonResponse, DiscreteScoreResponse
+from nuclia_eval.models.tool_calls import (
+    parse_tool_calls,
+    parse_tool_calls_text,
+    repair_tool_call,
+)
+
+
+def test_parse_tool_calls():
+    calls = [{"name": "groundedness", "arguments": {"score": 3}}]
+    assert parse_tool_calls(calls, DiscreteScoreResponse, "groundedness").score == 3
+    assert (
+        parse_tool_calls_text(
+            '[{"name": "groundedness", "arguments": "{\\"score\\": 2}"}]',
+            DiscreteScoreResponse,
+            "groundedness",
+        ).score
+        == 2
+    )
+    for invalid in [
+        [],
+        [{"name": "context_relevance", "arguments": {"score": 3}}],
+        [{"name": "groundedness", "arguments": {"score": 7}}],
+        {"name": "groundedness"},
+        None,
+    ]:
+        with pytest.raises(InvalidToolCallException):
+            parse_tool_calls(invalid, DiscreteScoreResponse, "groundedness")
+    with pytest.raises(InvalidToolCallException):
+        parse_tool_calls_text("[{", DiscreteScoreResponse, "groundedness")
+
+
+@pytest.mark.parametrize(
+    "text, expected",
+    [
+        # Truncated
+        ('[{"name": "groundedness", "arguments": {"score": 4', {"score": 4}),
+        # Out of range
+        ('[{"name": "groundedness", "arguments": {"score": 9}}]', {"score": 5}),
+        ('[{"name": "groundedness", "arguments": {"score": -1}}]', {"score": 0}),
+        # Another tool, and a quoted score
+        ('[{"name": "other", "arguments": {"score": "2"}}]', {"score": 2}),
+        # Not json
+        ("The Score: 3, because", {"score": 3}),
+    ],
+)
+def test_repair_tool_call(text, expected):
+    assert (
+        repair_tool_call(text, DiscreteScoreResponse).model_dump(exclude_none=True)
+        == expected
+    )
+
+
+def test_repair_tool_call_reason():
+    result = repair_tool_call(
+        '[{"name": "answer_relevance", "arguments": {"score": 2, "reason": "It says \\"hi',
+        DiscreteScoreReasonResponse,
+    )
+    assert (result.score, result.reason) == (2, 'It says "hi')
+    assert repair_tool_call('{"score": 1}', DiscreteScoreReasonResponse).reason == ""
+    with pytest.raises(InvalidToolCallException):
+        repair_tool_call('{"reason": "no score"}', DiscreteScoreReasonResponse)
@@ -0,0 +1,90 @@
+import multiprocessing
+import sqlite3
+
+from nuclia_eval.cache import ResultCache, result_key
+
+
+def test_result_key():
+    key = result_key(metric="groundedness", inputs={"answer": "a", "context": "c"})
+    # Independent of the order of the parts
+    assert key == result_key(
+        inputs={"context": "c", "answer": "a"}, metric="groundedness"
+    )
+    assert key != result_key(
+        metric="groundedness", inputs={"answer": "a", "context": "d"}
+    )
+
+
+def test_result_cache(tmp_path):
+    path = str(tmp_path / "cache" / "results.sqlite")
+    cache = ResultCache(path, max_bytes=1000)
+    assert cache.get("a") is None
+    cache.put_many({"a": "1", "b": "22"})
+    assert cache.get_many(["a", "b", "c", "a"]) == ["1", "22", None, "1"]
+    assert cache.stats() == {"hits": 3, "misses": 2, "entries": 2, "bytes": 3}
+    # Values larger than the budget are not stored
+    cache.put("big", "x" * 1001)
+    assert cache.get("big") is None
+    cache.close()
+
+    # Results persist across instances
+    cache = ResultCache(path, max_bytes=1000)
+    assert cache.get("b") == "22"
+    assert (cache.hits, cache.misses) == (1, 0)
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_result_cache_eviction(tmp_path):
+    cache = ResultCache(str(tmp_path / "results.sqlite"), max_bytes=30)
+    cache.put("a", "x" * 10)
+    cache.put("b", "x" * 10)
+    cache.put("c", "x" * 10)
+    # Reading a refreshes it, so b is the least recently used
+    assert cache.get("a") is not None
+    cache.put("d", "x" * 10)
+    assert cache.get_many(["a", "b", "c", "d"]) == ["x" * 10, None, "x" * 10, "x" * 10]
+    assert cache.nbytes == 30
+    # Replacing a value counts its new size only
+    cache.put("a", "x" * 5)
+    assert cache.nbytes == 25
+    cache.clear()
+    assert cache.nbytes == 0
+
+
+def test_result_cache_size_of_existing_database(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    connection = sqlite3.connect(path)
+    connection.execute(
+        "CREATE TABLE results (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+    )
+    connection.execute("INSERT INTO results VALUES ('a', 'xx', 2, 0)")
+    connection.commit()
+    connection.close()
+    cache = ResultCache(path, max_bytes=1000)
+    assert cache.nbytes == 2
+    cache.put("b", "yyy")
+    assert cache.stats()["bytes"] == 5
+
+
+def _write_results(path: str, worker: int) -> None:
+    cache = ResultCache(path, max_bytes=1 << 20)
+    for i in range(50):
+        cache.put(f"{worker}-{i}", str(i))
+        cache.get(f"{(worker + 1) % 4}-{i}")
+
+
+def test_result_cache_concurrent_processes(tmp_path):
+    path = str(tmp_path / "results.sqlite")
+    ResultCache(path, max_bytes=1 << 20).close()
+    context = multiprocessing.get_context("fork")
+    processes = [
+        context.Process(target=_write_results, args=(path, worker))
+        for worker in range(4)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    assert all(process.exitcode == 0 for process in processes)
+    assert len(ResultCache(path, max_bytes=1 << 20)) == 200
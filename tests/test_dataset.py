@@ -0,0 +1,228 @@
+import csv
+import json
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from nuclia_eval.cli import main
+from nuclia_eval.dataset import DatasetRow, evaluate_dataset, read_rows
+from nuclia_eval.exceptions import InvalidToolCallException
+from nuclia_eval.metrics.base import DiscreteScoreReasonResponse, DiscreteScoreResponse
+from nuclia_eval.models.base import RAGEvaluator
+
+
+class FakeEvaluator(RAGEvaluator):
+    """Scores each context by its length and fails for the queries in `failing`"""
+
+    def __init__(self, failing=()):
+        self.failing = set(failing)
+        self.batches: list[int] = []
+
+    def evaluate_rag_batch(self, items):
+        self.batches.append(len(items))
+        return super().evaluate_rag_batch(items)
+
+    def evaluate_rag(self, query, answer, contexts):
+        if query in self.failing:
+            raise InvalidToolCallException("Could not parse response")
+        return (
+            self.answer_relevance(query, answer),
+            self.context_relevance(query, contexts),
+            self.groundedness(answer, contexts),
+        )
+
+    def answer_relevance(self, query, answer):
+        return DiscreteScoreReasonResponse(score=5, reason=query)
+
+    def context_relevance(self, query, contexts):
+        return [DiscreteScoreResponse(score=min(len(c), 5)) for c in contexts]
+
+    def groundedness(self, answer, contexts):
+        return [DiscreteScoreResponse(score=0) for _ in contexts]
+
+
+def make_rows(n):
+    return [
+        DatasetRow(query=f"q{i}", answer="a", contexts=["c" * (i % 6)], id=i)
+        for i in range(n)
+    ]
+
+
+def read_output(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f]
+
+
+def test_read_rows(tmp_path):
+    records = [
+        {"query": "q", "answer": "a", "contexts": ["c1", "c2"], "id": "x"},
+        {"query": "q2", "answer": "a2", "contexts": []},
+    ]
+    jsonl = tmp_path / "data.jsonl"
+    jsonl.write_text("\n".join(json.dumps(r) for r in records) + "\n\n")
+    rows = list(read_rows(str(jsonl)))
+    assert rows == [
+        DatasetRow("q", "a", ["c1", "c2"], "x"),
+        DatasetRow("q2", "a2", [], None),
+    ]
+
+    # Contexts are stored as a json list in csv files
+    with open(tmp_path / "data.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["query", "answer", "contexts", "id"])
+        writer.writeheader()
+        for r in records:
+            writer.writerow({**r, "contexts": json.dumps(r["contexts"])})
+    assert [(r.query, r.contexts) for r in read_rows(str(tmp_path / "data.csv"))] == [
+        ("q", ["c1", "c2"]),
+        ("q2", []),
+    ]
+
+    with pytest.raises(ValueError):
+        list(read_rows(str(tmp_path / "data.txt")))
+
+
+def test_read_rows_parquet(tmp_path):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    table = pa.Table.from_pylist(
+        [{"query": "q", "answer": "a", "contexts": ["c1", "c2"]}]
+    )
+    pq.write_table(table, tmp_path / "data.parquet")
+    assert list(read_rows(str(tmp_path / "data.parquet"))) == [
+        DatasetRow("q", "a", ["c1", "c2"])
+    ]
+
+
+def test_evaluate_dataset(tmp_path):
+    output = tmp_path / "out" / "results.jsonl"
+    evaluator = FakeEvaluator(failing={"q3"})
+    stats = evaluate_dataset(evaluator, make_rows(10), str(output), chunk_size=4)
+    assert (stats.evaluated, stats.failed, stats.skipped) == (9, 1, 0)
+    # The chunk with the failing row is evaluated again one row at a time
+    assert evaluator.batches == [4, 1, 1, 1, 1, 4, 2]
+
+    results = read_output(output)
+    assert [r["row"] for r in results] == list(range(10))
+    assert [r["id"] for r in results] == list(range(10))
+    assert "Could not parse response" in results[3]["error"]
+    assert results[4]["context_relevance"] == [{"score": 4}]
+    assert results[4]["answer_relevance"] == {"score": 5, "reason": "q4"}
+
+    # Nothing left to do
+    stats = evaluate_dataset(FakeEvaluator(), make_rows(10), str(output), chunk_size=4)
+    assert (stats.evaluated, stats.skipped) == (0, 10)
+    assert read_output(output) == results
+
+
+def test_evaluate_dataset_resume(tmp_path):
+    output = tmp_path / "results.jsonl"
+
+    class Crash(Exception):
+        pass
+
+    class CrashingEvaluator(FakeEvaluator):
+        def evaluate_rag(self, query, answer, contexts):
+            if query == "q5":
+                raise Crash()
+            return super().evaluate_rag(query, answer, contexts)
+
+    with pytest.raises(Crash):
+        evaluate_dataset(CrashingEvaluator(), make_rows(8), str(output), chunk_size=2)
+    assert len(read_output(output)) == 4
+    # A partial line written after the last checkpoint is dropped on resume
+    with open(output, "a") as f:
+        f.write('{"row": 4, "id"')
+
+    evaluator = FakeEvaluator()
+    stats = evaluate_dataset(evaluator, make_rows(8), str(output), chunk_size=2)
+    assert (stats.evaluated, stats.skipped) == (4, 4)
+    assert evaluator.batches == [2, 2]
+    assert [r["row"] for r in read_output(output)] == list(range(8))
+
+    # Without resuming everything is evaluated again
+    stats = evaluate_dataset(
+        FakeEvaluator(), make_rows(3), str(output), chunk_size=2, resume=False
+    )
+    assert (stats.evaluated, stats.skipped) == (3, 0)
+    assert len(read_output(output)) == 3
+
+
+def test_evaluate_dataset_refuses_to_resume_another_run(tmp_path):
+    output = tmp_path / "results.jsonl"
+    evaluate_dataset(FakeEvaluator(), make_rows(4), str(output), chunk_size=2)
+    checkpoint = tmp_path / "results.jsonl.checkpoint"
+    saved = checkpoint.read_text()
+
+    # Another input
+    other_rows = [DatasetRow(query="other", answer="a", contexts=[], id=0)]
+    with pytest.raises(ValueError, match="another input"):
+        evaluate_dataset(FakeEvaluator(), other_rows, str(output))
+
+    # The output lost results the checkpoint counts as done
+    output.write_text(output.read_text()[:10])
+    with pytest.raises(ValueError, match="checkpoint"):
+        evaluate_dataset(FakeEvaluator(), make_rows(4), str(output))
+    output.unlink()
+    checkpoint.write_text(saved)
+    with pytest.raises(ValueError, match="0 bytes"):
+        evaluate_dataset(FakeEvaluator(), make_rows(4), str(output))
+
+    stats = evaluate_dataset(FakeEvaluator(), make_rows(4), str(output), resume=False)
+    assert stats.evaluated == 4
+    assert len(read_output(output)) == 4
+
+
+@patch("nuclia_eval.models.remi.REMiEvaluator")
+def test_cli_evaluate(remi_mock: MagicMock, tmp_path):
+    remi_mock.return_value = FakeEvaluator()
+    dataset = tmp_path / "data.jsonl"
+    dataset.write_text(
+        json.dumps({"query": "q", "answer": "a", "contexts": ["ccc"]}) + "\n"
+    )
+    output = tmp_path / "results.jsonl"
+    assert main(["evaluate", str(dataset), str(output), "--device", "cpu"]) == 0
+    remi_mock.assert_called_once_with(device="cpu")
+    assert read_output(output)[0]["context_relevance"] == [{"score": 3}]
+
+
+@patch("nuclia_eval.models.remi.REMiEvaluator")
+def test_cli_bake(remi_mock: MagicMock):
+    assert main(["bake", "--device", "cpu"]) == 0
+    assert remi_mock.call_args.kwargs["settings"].merged_checkpoint == "bake"
+    assert remi_mock.call_args.kwargs["device"] == "cpu"
+    remi_mock.return_value.bake_merged_checkpoint.assert_called_once()
+
+
+def test_cli_tune_prefilter(tmp_path, capsys):
+    dataset = tmp_path / "data.jsonl"
+    results = tmp_path / "results.jsonl"
+    rows = [
+        {
+            "id": 1,
+            "query": "capital of France",
+            "answer": "Paris",
+            "contexts": ["Paris is the capital of France", "Bananas are yellow"],
+        },
+        {"id": 2, "query": "q", "answer": "a", "contexts": ["c"]},
+    ]
+    records = [
+        {
+            "id": 1,
+            "answer_relevance": {"score": 5, "reason": "r"},
+            "context_relevance": [{"score": 5}, {"score": 0}],
+            "groundedness": [{"score": 4}, {"score": 0, "prefilter_score": 0.0}],
+        },
+        {"id": 2, "error": "ModelException: failed"},
+    ]
+    dataset.write_text("".join(json.dumps(row) + "\n" for row in rows))
+    results.write_text("".join(json.dumps(record) + "\n" for record in records))
+    assert main(["tune-prefilter", str(dataset), str(results)]) == 0
+    output = capsys.readouterr().out
+    # The contexts already skipped by the prefilter are not counted
+    assert "context_relevance: 2 pairs" in output
+    assert "groundedness: 1 pairs" in output
+    assert "Recommended prefilter_threshold" in output
+
+    results.write_text(json.dumps({**records[0], "id": 3}) + "\n")
+    with pytest.raises(ValueError):
+        main(["tune-prefilter", str(dataset), str(results)])
@@ -0,0 +1,42 @@
+from nuclia_eval.dedup import ResultMemo, dedup_key, normalize_text
+from nuclia_eval.metrics.base import DiscreteScoreResponse
+
+
+def test_normalize_text():
+    assert normalize_text("  a  b\n\tc ") == "a b c"
+    assert normalize_text("ａﬁ") == "afi"
+    assert normalize_text("") == ""
+
+
+def test_dedup_key():
+    fields = {"query": "q", "context": "a  b"}
+    assert dedup_key("m", fields, False) == dedup_key("m", dict(fields), False)
+    assert dedup_key("m", fields, False) != dedup_key("other", fields, False)
+    assert dedup_key("m", fields, False) != dedup_key(
+        "m", {"query": "q", "context": "a b"}, False
+    )
+    assert dedup_key("m", fields, True) == dedup_key(
+        "m", {"context": "a b ", "query": "q"}, True
+    )
+
+
+def test_result_memo():
+    memo = ResultMemo(2)
+    memo.put("a", DiscreteScoreResponse(score=1))
+    memo.put("b", DiscreteScoreResponse(score=2))
+    assert memo.get("a").score == 1
+    # The least recently used result is evicted
+    memo.put("c", DiscreteScoreResponse(score=3))
+    assert memo.get("b") is None
+    assert len(memo) == 2
+
+    # Changing the results stored or returned does not change the memo
+    result = DiscreteScoreResponse(score=4)
+    memo.put("d", result)
+    result.score = 5
+    memo.get("d").score = 0
+    assert memo.get("d").score == 4
+
+    disabled = ResultMemo(0)
+    disabled.put("a", DiscreteScoreResponse(score=1))
+    assert disabled.get("a") is None
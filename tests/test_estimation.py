@@ -0,0 +1,132 @@
+import json
+from statistics import fmean
+from unittest.mock import MagicMock, patch
+
+import pytest
+
+from nuclia_eval.cli import main
+from nuclia_eval.dataset import DatasetRow
+from nuclia_eval.estimation import (
+    _MetricSampler,
+    _wilson_interval,
+    estimate_metrics,
+)
+from nuclia_eval.metrics import ContextRelevance
+from nuclia_eval.metrics.base import DiscreteScoreResponse, InvalidToolCallResponse
+
+
+class FakeEvaluator:
+    """Scores each input by the number in its context or answer, and reports an invalid tool call for the contexts in `invalid`"""
+
+    def __init__(self, invalid=()):
+        self.invalid = set(invalid)
+        self.calls: list[list[int]] = []
+
+    def _evaluate_metrics(self, requests):
+        self.calls.append([len(inputs) for _, inputs in requests])
+        return [[self._score(fields) for fields in inputs] for _, inputs in requests]
+
+    def _score(self, fields):
+        text = fields["context"] if "context" in fields else fields["answer"]
+        if text in self.invalid:
+            return InvalidToolCallResponse(error="invalid", output="")
+        return DiscreteScoreResponse(score=int(text.split()[-1]))
+
+
+def make_rows(n):
+    return [
+        DatasetRow(
+            query=f"q{i}",
+            answer=f"a {i % 6}",
+            contexts=[f"c{i} {(i + j) % 6}" for j in range(3)],
+            id=i,
+        )
+        for i in range(n)
+    ]
+
+
+def test_wilson_interval():
+    low, high = _wilson_interval(0.5, 100, 0.95)
+    assert low == pytest.approx(0.4038, abs=1e-4)
+    assert high == pytest.approx(0.5962, abs=1e-4)
+    assert _wilson_interval(0.0, 10, 0.95)[0] == pytest.approx(0)
+
+
+def test_sampler_proportional_allocation():
+    strata = {"big": [(i,) for i in range(30)], "small": [(i,) for i in range(10)]}
+    sampler = _MetricSampler(ContextRelevance, strata)
+    drawn = sampler.draw(8)
+    assert sum(stratum.size == 30 for stratum, _ in drawn) == 6
+    assert len(sampler.draw(100)) == 32
+    assert sampler.exhausted
+
+
+def test_estimate_metrics():
+    rows = make_rows(2000)
+    evaluator = FakeEvaluator()
+    snapshots = list(
+        estimate_metrics(evaluator, rows, target_width=0.5, batch_size=64, seed=0)
+    )
+    final = snapshots[-1]
+    assert all(estimate.done for estimate in final.values())
+    # Only a fraction of the dataset is scored
+    assert final["answer_relevance"].population == 2000
+    assert final["groundedness"].population == 6000
+    assert final["groundedness"].samples < 1000
+    true_mean = fmean(range(6))
+    for estimate in final.values():
+        assert estimate.width <= 0.5
+        assert estimate.low <= true_mean <= estimate.high
+    # The running estimates narrow down
+    first = snapshots[0]["context_relevance"]
+    assert first.width > final["context_relevance"].width
+    # The prompts of the metrics are batched together
+    assert evaluator.calls[0] == [64, 64, 64]
+
+
+def test_estimate_metrics_exhausted():
+    rows = make_rows(5)
+    evaluator = FakeEvaluator(invalid={"c0 0"})
+    final = list(estimate_metrics(evaluator, rows, target_width=0.01))[-1]
+    # Every item is scored, so the mean is exact, the invalid tool call is left out
+    answer_relevance = final["answer_relevance"]
+    assert answer_relevance.mean == pytest.approx(fmean(i % 6 for i in range(5)))
+    assert answer_relevance.width == 0
+    assert final["context_relevance"].samples == 14
+    assert final["context_relevance"].done
+    assert list(estimate_metrics(evaluator, [])) == []
+
+
+def test_estimate_metrics_bootstrap():
+    rows = make_rows(500)
+    final = list(
+        estimate_metrics(
+            FakeEvaluator(),
+            rows,
+            target_width=0.6,
+            method="bootstrap",
+            stratify=lambda row: row.id % 2,
+            max_rows=400,
+            seed=1,
+        )
+    )[-1]
+    assert final["answer_relevance"].population == 400
+    for estimate in final.values():
+        assert estimate.done
+        assert estimate.low <= estimate.mean <= estimate.high
+
+
+@patch("nuclia_eval.models.remi.REMiEvaluator")
+def test_cli_estimate(remi_mock: MagicMock, tmp_path, capsys):
+    remi_mock.return_value = FakeEvaluator()
+    dataset = tmp_path / "data.jsonl"
+    dataset.write_text(
+        "".join(
+            json.dumps({"query": r.query, "answer": r.answer, "contexts": r.contexts})
+            + "\n"
+            for r in make_rows(10)
+        )
+    )
+    assert main(["estimate", str(dataset), "--device", "cpu", "--seed", "0"]) == 0
+    remi_mock.assert_called_once_with(device="cpu")
+    assert "answer_relevance" in capsys.readouterr().out
@@ -0,0 +1,84 @@
+import json
+import os
+import subprocess
+import sys
+
+import nuclia_eval
+
+HEAVY_MODULES = ["torch", "mistral_inference", "huggingface_hub", "safetensors"]
+
+# Generous bound, the lightweight modules import in a fraction of it, the model stack takes several times longer
+MAX_IMPORT_SECONDS = 2.0
+
+_IMPORT_SCRIPT = f"""
+import json, sys, time
+start = time.perf_counter()
+import nuclia_eval
+import nuclia_eval.metrics
+import nuclia_eval.models
+import nuclia_eval.models.base
+import nuclia_eval.settings
+from nuclia_eval.metrics.base import DiscreteScoreResponse
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "heavy": [m for m in {HEAVY_MODULES!r} if m in sys.modules]}}))
+"""
+
+
+def _run(script: str) -> dict:
+    env = dict(os.environ)
+    src = os.path.dirname(os.path.dirname(nuclia_eval.__file__))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [src, env.get("PYTHONPATH")]))
+    output = subprocess.run(
+        [sys.executable, "-c", script],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def test_import_does_not_load_the_model_stack():
+    result = _run(_IMPORT_SCRIPT)
+    assert result["heavy"] == []
+    assert result["seconds"] < MAX_IMPORT_SECONDS, (
+        f"Importing nuclia_eval took {result['seconds']:.2f}s"
+    )
+
+
+def test_lazy_attributes():
+    result = _run(
+        "import json, sys\n"
+        "from nuclia_eval import REMi\n"
+        "from nuclia_eval.models import EvaluatorPool, REMiEvaluator\n"
+        "print(json.dumps({'same': REMi is REMiEvaluator, 'torch': 'torch' in sys.modules}))"
+    )
+    assert result == {"same": True, "torch": True}
+    assert "REMi" in dir(nuclia_eval)
+
+
+def test_http_evaluator_does_not_load_the_model_stack():
+    result = _run(
+        "import json, sys\n"
+        "from nuclia_eval.models import HTTPEvaluator\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    assert result == []
+
+
+def test_daemon_evaluator_does_not_load_the_model_stack():
+    result = _run(
+        "import json, sys\n"
+        "from nuclia_eval.models import DaemonEvaluator\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    assert result == []
+
+
+def test_cli_does_not_load_the_model_stack():
+    result = _run(
+        "import json, sys\n"
+        "import nuclia_eval.cli\n"
+        f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+    )
+    assert result == []
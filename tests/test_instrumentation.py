@@ -0,0 +1,92 @@
+from unittest.mock import MagicMock
+
+from nuclia_eval.instrumentation import (
+    CallStats,
+    OpenTelemetryExporter,
+    PrometheusExporter,
+    emit,
+)
+
+
+def _stats(**kwargs) -> CallStats:
+    defaults = dict(
+        operation="evaluate",
+        prompts={"groundedness": 3},
+        cached=1,
+        batch_sizes=[2],
+        prompt_tokens=90,
+        generated_tokens=10,
+        parse_failures=1,
+        stages={"tokenize": 0.1, "prefill": 0.3, "decode": 0.2, "parse": 0.01},
+        seconds=0.7,
+    )
+    defaults.update(kwargs)
+    return CallStats(**defaults)  # type: ignore
+
+
+def test_call_stats():
+    stats = _stats()
+    assert stats.tokens_per_second == 100 / 0.5
+    with stats.stage("parse"):
+        pass
+    assert stats.stages["parse"] > 0.01
+    assert CallStats("evaluate").tokens_per_second == 0
+
+
+def test_emit_isolates_failing_callbacks():
+    received = []
+
+    def failing(stats):
+        raise RuntimeError("boom")
+
+    emit([failing, received.append], _stats())
+    assert len(received) == 1
+
+
+def test_prometheus_exporter():
+    exporter = PrometheusExporter()
+    exporter(_stats())
+    exporter(_stats(batch_sizes=[8, 1], error="InvalidToolCallException"))
+    text = exporter.render()
+    lines = text.splitlines()
+    assert "# TYPE nuclia_eval_calls_total counter" in lines
+    assert 'nuclia_eval_calls_total{operation="evaluate"} 2' in lines
+    assert (
+        'nuclia_eval_errors_total{operation="evaluate",error="InvalidToolCallException"} 1'
+        in lines
+    )
+    assert 'nuclia_eval_prompts_total{metric="groundedness"} 6' in lines
+    assert "nuclia_eval_prompt_tokens_total 180" in lines
+    assert "nuclia_eval_parse_failures_total 2" in lines
+    assert (
+        'nuclia_eval_stage_seconds_total{operation="evaluate",stage="prefill"} 0.6'
+        in lines
+    )
+    assert "# TYPE nuclia_eval_batch_size histogram" in lines
+    assert 'nuclia_eval_batch_size_bucket{le="1"} 1' in lines
+    assert 'nuclia_eval_batch_size_bucket{le="2"} 2' in lines
+    assert 'nuclia_eval_batch_size_bucket{le="+Inf"} 3' in lines
+    assert "nuclia_eval_batch_size_count 3" in lines
+    assert 'nuclia_eval_call_seconds_count{operation="evaluate"} 2' in lines
+    assert text.endswith("\n")
+
+
+def test_opentelemetry_exporter():
+    meter = MagicMock()
+    instruments: dict = {}
+    meter.create_counter.side_effect = lambda name, **kwargs: instruments.setdefault(
+        name, MagicMock()
+    )
+    meter.create_histogram.side_effect = lambda name, **kwargs: instruments.setdefault(
+        name, MagicMock()
+    )
+    exporter = OpenTelemetryExporter(meter)
+    exporter(_stats())
+    instruments["nuclia_eval.calls"].add.assert_called_once_with(
+        1, {"operation": "evaluate"}
+    )
+    instruments["nuclia_eval.tokens"].add.assert_any_call(90, {"kind": "prompt"})
+    instruments["nuclia_eval.stage.duration"].record.assert_any_call(
+        0.3, {"operation": "evaluate", "stage": "prefill"}
+    )
+    instruments["nuclia_eval.batch_size"].record.assert_called_once_with(2)
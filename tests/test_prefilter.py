@@ -0,0 +1,45 @@
+import pytest
+
+from nuclia_eval.prefilter import overlap_scores, terms, threshold_stats, tune_threshold
+
+
+def test_terms():
+    assert terms("The Eiffel tower, Paris!") == ["the", "eiffel", "tower", "paris"]
+    assert terms("a b c", ngram=2) == ["a", "b", "c", "a b", "b c"]
+    assert terms("") == []
+
+
+def test_overlap_scores():
+    contexts = [
+        "Paris is the capital of France",
+        "The Louvre is a museum",
+        "Bananas are yellow",
+    ]
+    scores = overlap_scores("What is the capital of France?", contexts)
+    assert scores.shape == (3,)
+    assert scores[0] > scores[1] > scores[2] == 0
+    assert all(0 <= score < 1 for score in scores)
+    # Shared phrases only add up with n-grams
+    phrase = overlap_scores("capital of France", ["capital of France"], ngram=2)
+    shuffled = overlap_scores("capital of France", ["France of capital"], ngram=2)
+    assert phrase[0] > shuffled[0]
+    assert overlap_scores("?", contexts).tolist() == [0, 0, 0]
+    assert overlap_scores("q", []).tolist() == []
+
+
+def test_threshold_stats():
+    stats = threshold_stats([0.0, 0.1, 0.3, 0.6], [0, 2, 0, 5], [0.2, 0.5])
+    assert [(s.skip_rate, s.miss_rate) for s in stats] == [(0.5, 0.5), (0.75, 0.5)]
+
+
+def test_tune_threshold():
+    overlaps = [0.0, 0.02, 0.05, 0.2, 0.3, 0.4, 0.5]
+    model_scores = [0, 0, 0, 3, 1, 4, 5]
+    best = tune_threshold(overlaps, model_scores, max_miss_rate=0)
+    assert best.threshold == 0.2
+    assert best.miss_rate == 0
+    assert best.skip_rate == pytest.approx(3 / 7)
+    # Missing one of the four relevant pairs is allowed
+    assert tune_threshold(overlaps, model_scores, max_miss_rate=0.25).threshold == 0.3
+    assert tune_threshold(overlaps, model_scores, min_score=4).threshold == 0.4
+    assert tune_threshold(overlaps, [0] * 7).threshold == 1.0
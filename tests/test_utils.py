@@ -0,0 +1,71 @@
+import pytest
+import safetensors.torch
+import torch
+
+from nuclia_eval.utils import load_lora_low_mem, load_safetensors_mmap
+
+
+def _write_lora(model, path, dtype=torch.float16):
+    lora = {}
+    for name, module in model.named_modules():
+        if isinstance(module, torch.nn.Linear) and name != "output":
+            lora[f"{name}.lora_A.weight"] = torch.randn(2, module.in_features).to(dtype)
+            lora[f"{name}.lora_B.weight"] = torch.randn(module.out_features, 2).to(
+                dtype
+            )
+    safetensors.torch.save_file(lora, path)
+    return lora
+
+
+def test_load_lora_low_mem(tiny_model, tmp_path):
+    model = tiny_model.to(torch.float16)
+    lora_path = tmp_path / "lora.safetensors"
+    lora = _write_lora(model, lora_path)
+    expected = {
+        name: (
+            module.weight
+            + lora[f"{name}.lora_B.weight"] @ lora[f"{name}.lora_A.weight"] * 2.0
+        )
+        if isinstance(module, torch.nn.Linear) and name != "output"
+        else module.weight.clone()
+        for name, module in model.named_modules()
+        if hasattr(module, "weight")
+    }
+    weights = {
+        name: module.weight.data_ptr()
+        for name, module in model.named_modules()
+        if hasattr(module, "weight")
+    }
+
+    peak = load_lora_low_mem(model, lora_path)
+
+    assert peak > 0
+    for name, module in model.named_modules():
+        if hasattr(module, "weight"):
+            # Merged in place
+            assert module.weight.data_ptr() == weights[name]
+            torch.testing.assert_close(
+                module.weight, expected[name], atol=1e-2, rtol=1e-2
+            )
+
+
+def test_load_lora_low_mem_dtype_mismatch(tiny_model, tmp_path):
+    lora_path = tmp_path / "lora.safetensors"
+    _write_lora(tiny_model, lora_path, dtype=torch.float16)
+    with pytest.raises(AssertionError, match="dtype"):
+        load_lora_low_mem(tiny_model, lora_path)
+
+
+def test_load_safetensors_mmap(tmp_path):
+    tensors = {
+        "a": torch.randn(3, 4).half(),
+        "b": torch.arange(5),
+        "c": torch.tensor(1.5),
+    }
+    path = tmp_path / "tensors.safetensors"
+    safetensors.torch.save_file(tensors, path, metadata={"version": "1"})
+    loaded = load_safetensors_mmap(path)
+    assert loaded.keys() == tensors.keys()
+    for name, tensor in tensors.items():
+        assert loaded[name].dtype == tensor.dtype
+        assert torch.equal(loaded[name], tensor)